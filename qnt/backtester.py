@@ -5,6 +5,12 @@ import numpy as np
 import os, sys
 import inspect
 import copy
+import gzip, pickle
+import hashlib
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty
 
 import datetime
 import progressbar
@@ -14,7 +20,9 @@ import qnt.state as qnstate
 import qnt.data as qndata
 import qnt.data.common as qndc
 import qnt.stats as qnstat
+import qnt.profiler as qnprof
 from qnt.graph import is_notebook, make_major_plots, is_interact
+import qnt.log as qnlog
 from qnt.log import log_info, log_err
 
 DataSet = tp.Union[xr.DataArray, dict]
@@ -42,6 +50,12 @@ def backtest_ml(
         build_plots: bool = True,
         collect_all_states: bool = False,
         check_correlation: bool = False,
+        states_path: tp.Union[str, None] = None,
+        train_workers: int = 1,
+        model_cache_dir: tp.Union[str, None] = None,
+        model_version: str = "",
+        model_cache_size: int = 1024 ** 3,
+        profile: tp.Union[bool, qnprof.Profiler, None] = None,
 ):
     """
     Runs a backtest of a machine learning trading strategy over historical data.
@@ -115,6 +129,35 @@ def backtest_ml(
         check_correlation (bool, optional): If True, perform a correlation check during analysis.
             Default is False.
 
+        states_path (str, optional): The file for the states collected with `collect_all_states`.
+            The states are written to this file one by one and a lazy qnt.state.StateHistory is returned
+            instead of a list.
+            Default is None.
+
+        train_workers (int, optional): The number of worker processes for the training.
+            The models for all retrain windows are trained concurrently before the prediction,
+            the prediction runs in order in the main process. The models must be picklable.
+            Default is 1 (the models are trained one by one during the backtest).
+
+        model_cache_dir (str, optional): The directory for the persistent model cache.
+            The trained models are pickled there with the key calculated from the training slice
+            (coordinates and values) and `model_version`. When the key matches, the model is loaded
+            instead of calling `train`. The models must be picklable.
+            Default is None (no cache).
+
+        model_version (str, optional): The version of the `train` function. Change it when `train` changes,
+            otherwise the cache returns the models trained by the previous version.
+            Default is "".
+
+        model_cache_size (int, optional): The maximum size of the model cache in bytes.
+            The least recently used models are removed when the cache is larger.
+            Default is 1 GiB.
+
+        profile (bool or qnt.profiler.Profiler, optional): If True, the wall time, the call count and
+            the allocated bytes are recorded per stage of the multi-pass backtest (load_data, window, train,
+            predict, clean, write, analyze), see `backtest`.
+            Default is None (enabled by the environment variable QNT_PROFILE=1).
+
     Returns:
         result (xr.DataArray): The backtest output data.
 
@@ -125,6 +168,8 @@ def backtest_ml(
 
     qndc.track_event("ML_BACKTEST")
 
+    profiler = qnprof.create(profile)
+
     if load_data is None:
         load_data = lambda tail: qndata.load_data_by_type(competition_type, tail=tail)
 
@@ -137,6 +182,10 @@ def backtest_ml(
     args_count = len(inspect.getfullargspec(predict).args)
     predict_wrap = (lambda m, d, s: predict(m, d)) if args_count < 3 else predict
 
+    model_cache = None
+    if model_cache_dir is not None:
+        model_cache = ModelCache(model_cache_dir, model_version, model_cache_size)
+
     retrain_interval_cur = retrain_interval_after_submit if is_submitted() else retrain_interval
     if retrain_interval_cur is None:
         retrain_interval_cur = retrain_interval
@@ -159,7 +208,7 @@ def backtest_ml(
                    or data_ts[-1] >= created + np.timedelta64(retrain_interval_cur, 'D')
     if need_retrain:
         train_data_slice = copy_window(data, data_ts[-1], train_period)
-        model = train(train_data_slice)
+        model = train_model(train, train_data_slice, model_cache)
         created = data_ts[-1]
 
     test_data_slice = copy_window(data, data_ts[-1], lookback_period)
@@ -201,7 +250,7 @@ def backtest_ml(
         data, data_ts = extract_time_series(data)
 
         train_data_slice = copy_window(data, data_ts[-1], train_period)
-        model = train(train_data_slice)
+        model = train_model(train, train_data_slice, model_cache)
 
         test_data_slice = copy_window(data, data_ts[-1], lookback_period)
         state = None
@@ -214,74 +263,95 @@ def backtest_ml(
         log_info("Run all iterations...")
         log_info('Load data...')
 
-        train_data = load_data(test_period + train_period + lookback_period)
+        with profiler.stage('load_data'):
+            train_data = load_data(test_period + train_period + lookback_period)
         train_data, train_ts = extract_time_series(train_data)
 
-        test_data = load_data(test_period)
+        with profiler.stage('load_data'):
+            test_data = load_data(test_period)
         test_ts = extract_time_series(test_data)[1]
 
+        min_date = test_ts[0] - np.timedelta64(60, 'D')
+        # with the training workers, the loading starts after the workers are forked (see Prefetch)
+        cleanup_data = Prefetch(qndata.load_data_by_type, competition_type, min_date=str(min_date)[:10])
+
+        retrain_windows = calc_retrain_windows(test_ts, retrain_interval_cur)
+        models = None
+        if train_workers > 1 and len(retrain_windows) > 1 and can_fork():
+            log_info('Train models...')
+            with profiler.stage('train (parallel)'):
+                models = train_models_parallel(train, train_data, window, train_period,
+                                               [test_ts[t_i] for t_i, end_i in retrain_windows], train_workers,
+                                               model_cache, cleanup_data.start)
+            if models is None:
+                return
+        cleanup_data.start()
+
         log_info('Backtest...')
-        outputs = None
-        t = test_ts[0]
+        outputs = OutputBuffer(test_ts)
         state = None
         model = None
-        states = []
+        states = new_state_history(collect_all_states, states_path)
         with progressbar.ProgressBar(max_value=len(test_ts), poll_interval=1) as p:
-            go = True
-            while go:
-                end_t = t + np.timedelta64(max(retrain_interval_cur - 1, 0), 'D')
-                end_t = test_ts[test_ts <= end_t][-1]
+            for k, (t_i, end_i) in enumerate(retrain_windows):
+                t = test_ts[t_i]
+                end_t = test_ts[end_i - 1]
 
-                train_data_slice = copy_window(train_data, t, train_period)
-                model = train(train_data_slice)
+                if models is not None:
+                    model = models[k]
+                    models[k] = None
+                else:
+                    with profiler.stage('window'):
+                        train_data_slice = copy_window(train_data, t, train_period)
+                    with profiler.stage('train'):
+                        model = train_model(train, train_data_slice, model_cache)
                 if predict_each_day:
-                    for test_t in test_ts[np.logical_and(test_ts >= t, test_ts <= end_t)]:
-                        test_data_slice = copy_window(train_data, test_t, lookback_period)
-                        output = predict_wrap(model, test_data_slice, state)
+                    for i in range(t_i, end_i):
+                        test_t = test_ts[i]
+                        profiler.start_iteration(i, test_t)
+                        with profiler.stage('window'):
+                            test_data_slice = copy_window(train_data, test_t, lookback_period)
+                        with profiler.stage('predict'):
+                            output = predict_wrap(model, test_data_slice, state)
                         output, state = unpack_result(output)
+                        profiler.end_iteration()
                         if collect_all_states:
                             states.append(state)
                         if test_t in output.time:
-                            output = output.sel(time=[test_t])
-                            if outputs is None:
-                                coords = output.coords.copy()
-                                coords['time'] = test_ts
-                                outputs = xr.DataArray(np.nan, dims=output.dims, coords=coords)
-                            outputs.loc[dict(time=[test_t])] = output
-                            p.update(np.where(test_ts == test_t)[0].item())
+                            outputs.put(i, output.sel(time=test_t))
+                            p.update(i)
                 else:
-                    test_data_slice = copy_window(train_data, end_t, lookback_period + retrain_interval_cur)
-                    output = predict_wrap(model, test_data_slice, state)
+                    with profiler.stage('window'):
+                        test_data_slice = copy_window(train_data, end_t, lookback_period + retrain_interval_cur)
+                    with profiler.stage('predict'):
+                        output = predict_wrap(model, test_data_slice, state)
                     output, state = unpack_result(output)
                     if collect_all_states:
                         states.append(state)
-                    output = output.where(output.time >= t).where(output.time <= end_t).dropna('time', how='all')
-                    if outputs is None:
-                        coords = output.coords.copy()
-                        coords['time'] = test_ts
-                        outputs = xr.DataArray(np.nan, dims=output.dims, coords=coords)
-                    outputs.loc[dict(time=output.time)] = output
-
-                p.update(np.where(test_ts == end_t)[0].item())
-
-                next_t = test_ts[test_ts > end_t]
-                if len(next_t) > 0:
-                    t = next_t[0]
-                else:
-                    go = False
-
-            result = outputs
-            min_date = test_ts[0] - np.timedelta64(60, 'D')
-            data = qndata.load_data_by_type(competition_type, min_date=str(min_date)[:10])
-            result = qnout.clean(result, data, competition_type)
+                    output = output.sel(time=slice(t, end_t)).transpose('time', 'asset')
+                    rows = np.searchsorted(test_ts, output.time.values)
+                    found = test_ts[np.minimum(rows, len(test_ts) - 1)] == output.time.values
+                    outputs.put_rows(rows[found], output.asset.values, output.values[found])
+
+                p.update(end_i - 1)
+
+            result = outputs.to_xarray()
+            with profiler.stage('load_data'):
+                data = cleanup_data.result()
+            with profiler.stage('clean'):
+                result = qnout.clean(result, data, competition_type)
             result.name = competition_type
-            qnout.write(result)
-            qnstate.write((t, model, state))
+            with profiler.stage('write'):
+                qnout.write(result)
+                qnstate.write((t, model, state))
+            if model_cache is not None:
+                log_info(model_cache.summary())
             if analyze:
                 log_info("---")
-                analyze_results(output=result, data=data, kind=competition_type, build_plots=build_plots,
-                                start=start_date,
-                                check_correlation=check_correlation)
+                with profiler.stage('analyze'):
+                    analyze_results(output=result, data=data, kind=competition_type, build_plots=build_plots,
+                                    start=start_date,
+                                    check_correlation=check_correlation)
 
             if state is None:
                 return result
@@ -291,6 +361,285 @@ def backtest_ml(
                 return result, state
     finally:
         qndc.set_max_datetime(None)
+        profiler.finish()
+
+
+class Prefetch:
+    """
+    The function (usually the data loading) in a background thread which is started by start().
+    If the worker processes are forked, the thread has to be started after the fork:
+    a lock held by the thread at the moment of the fork (logging, imports, sockets) stays locked in the worker.
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = None
+
+    def start(self):
+        if self.future is None:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qnt_prefetch")
+            self.future = executor.submit(self.func, *self.args, **self.kwargs)
+            executor.shutdown(wait=False)
+        return self
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    def result(self):
+        """
+        Waits for the function (it is started if it is not started yet) and returns its result.
+        """
+        return self.start().future.result()
+
+
+def prefetch(func, *args, **kwargs):
+    """
+    Starts the function (usually the data loading) in a background thread.
+    :return: Prefetch, result() waits for the function and returns its result
+    """
+    return Prefetch(func, *args, **kwargs).start()
+
+
+def calc_retrain_windows(test_ts, retrain_interval):
+    """
+    Splits the test dates into retrain windows.
+    :return: list of (start_idx, end_idx) positions in test_ts
+    """
+    windows = []
+    t_i = 0
+    while t_i < len(test_ts):
+        end_t = test_ts[t_i] + np.timedelta64(max(retrain_interval - 1, 0), 'D')
+        end_i = max(np.searchsorted(test_ts, end_t, side='right'), t_i + 1)
+        windows.append((t_i, end_i))
+        t_i = end_i
+    return windows
+
+
+def can_fork():
+    """
+    The worker processes get the strategies (usually lambdas and closures) without pickling,
+    so they are started with fork. The callers run sequentially if fork is unavailable (Windows).
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return True
+    log_info("WARNING! fork is unavailable, the workers are disabled.")
+    return False
+
+
+def get_worker_message(queue, processes, timeout=1):
+    """
+    Waits for the next message of the worker processes.
+    :param processes: the workers which have to send more messages
+    :return: the message or ('error', None, reason) if a worker exited without its messages (killed, out of memory)
+    """
+    while True:
+        # the messages of an exited worker are in the queue already, so the exit is checked before the read
+        exited = [w for w in processes if not w.is_alive()]
+        try:
+            return queue.get(timeout=timeout)
+        except Empty:
+            if len(exited) > 0:
+                return 'error', None, exited[0].name + " exited with the code " + str(exited[0].exitcode)
+
+
+def train_models_parallel(train, data, window, train_period, dates, workers, model_cache=None, on_start=None):
+    """
+    Trains the models for the dates in worker processes.
+    The training slices are cut from the data shared via shared memory.
+    The workers are forked (see can_fork), the training fails if a worker exits without its models.
+    :param on_start: called after the workers are forked (for example, Prefetch.start)
+    :return: list of the models in the order of the dates or None if the training failed
+    """
+    segments = []
+    models = [None] * len(dates)
+    failed = False
+    try:
+        shared = share_data(data, segments)
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        tasks = [[(k, dates[k]) for k in range(i, len(dates), workers)] for i in range(min(workers, len(dates)))]
+        processes = [
+            context.Process(
+                name="train_worker#" + str(i),
+                target=train_models_worker,
+                args=(tasks[i], shared, window, train_period, train, queue, model_cache)
+            ) for i in range(len(tasks))
+        ]
+        for w in processes:
+            w.daemon = True
+            w.start()
+        if on_start is not None:
+            on_start()
+
+        remaining = [len(t) for t in tasks]
+        with progressbar.ProgressBar(max_value=len(dates), poll_interval=1) as p:
+            for done in range(len(dates)):
+                msg = get_worker_message(queue, [w for w, r in zip(processes, remaining) if r > 0])
+                if msg[0] == 'error':
+                    log_err("ERROR! The training worker failed:", msg[2])
+                    failed = True
+                    break
+                models[msg[1]] = msg[2]
+                remaining[msg[1] % len(tasks)] -= 1
+                if model_cache is not None:
+                    model_cache.count(msg[3])
+                p.update(done + 1)
+
+        for w in processes:
+            if failed:
+                w.terminate()
+            w.join()
+    finally:
+        for shm in segments:
+            shm.close()
+            shm.unlink()
+    sys.stderr.flush()
+    return None if failed else models
+
+
+def train_models_worker(tasks, shared, window, train_period, train, queue, model_cache=None):
+    segments = []
+    k = None
+    try:
+        data = attach_data(shared, segments)
+        for k, t in tasks:
+            train_data_slice = copy.deepcopy(window(data, t, train_period))
+            hits = model_cache.hits if model_cache is not None else 0
+            model = train_model(train, train_data_slice, model_cache)
+            hit = model_cache is not None and model_cache.hits > hits
+            queue.put(('result', k, model, hit))
+    except Exception as e:
+        import logging
+        logging.exception("exception in worker")
+        queue.put(('error', k, repr(e)))
+
+
+def train_model(train, train_data_slice, model_cache=None):
+    if model_cache is None:
+        return train(train_data_slice)
+    key = model_cache.key(train_data_slice)
+    model = model_cache.get(key)
+    if model is None:
+        model = train(train_data_slice)
+        model_cache.put(key, model)
+    return model
+
+
+class ModelCache:
+    """
+    Persistent cache of the trained models.
+    The key is the hash of the training slice and the model version.
+    The models are stored as gzipped pickles, the least recently used ones are removed
+    when the total size exceeds max_size.
+    """
+
+    def __init__(self, path, version="", max_size=1024 ** 3):
+        self.path = path
+        self.version = version
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, data):
+        h = hashlib.sha256()
+        h.update(str(self.version).encode())
+        hash_data(h, data)
+        return h.hexdigest()
+
+    def file_name(self, key):
+        return os.path.join(self.path, key + ".model.pickle.gz")
+
+    def get(self, key):
+        """
+        :return: the model or None
+        """
+        file_name = self.file_name(key)
+        try:
+            with gzip.open(file_name, 'rb') as gz:
+                model = pickle.load(gz)
+            os.utime(file_name)  # the modification time is used for the eviction
+        except FileNotFoundError:
+            model = None
+        except Exception as e:
+            log_err("WARNING! Can't load the cached model.", e)
+            model = None
+        self.count(model is not None)
+        return model
+
+    def put(self, key, model):
+        file_name = self.file_name(key)
+        tmp_name = file_name + "." + str(os.getpid()) + ".tmp"
+        with gzip.open(tmp_name, 'wb') as gz:
+            pickle.dump(model, gz)
+        os.replace(tmp_name, file_name)
+        self.evict()
+
+    def evict(self):
+        files = []
+        for n in os.listdir(self.path):
+            if not n.endswith(".model.pickle.gz"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, n))
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, n))
+        files.sort()
+        size = sum(f[1] for f in files)
+        for mtime, file_size, n in files[:-1]:  # the newest model is kept
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, n))
+            except FileNotFoundError:
+                pass
+            size -= file_size
+
+    def count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def summary(self):
+        size = 0
+        for n in os.listdir(self.path):
+            if n.endswith(".model.pickle.gz"):
+                size += os.path.getsize(os.path.join(self.path, n))
+        return "Model cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses, " \
+               + str(round(size / 1024 ** 2, 1)) + " MiB"
+
+
+def hash_data(h, data):
+    """
+    Updates the hash with the coordinates and the values of the DataSet.
+    """
+    if isinstance(data, xr.DataArray):
+        h.update(str(data.dims).encode())
+        for name in sorted(data.coords):
+            h.update(str(name).encode())
+            hash_array(h, data.coords[name].values)
+        hash_array(h, data.values)
+    elif isinstance(data, dict):
+        for k in sorted(data.keys(), key=str):
+            h.update(str(k).encode())
+            hash_data(h, data[k])
+    elif isinstance(data, (tuple, list)):
+        for i in data:
+            hash_data(h, i)
+    else:
+        h.update(pickle.dumps(data))
+
+
+def hash_array(h, values):
+    h.update(str(values.dtype).encode() + str(values.shape).encode())
+    if values.dtype == object:
+        h.update(pickle.dumps(values.tolist()))
+    else:
+        h.update(np.ascontiguousarray(values).tobytes())
 
 
 def backtest(
@@ -311,6 +660,17 @@ def backtest(
         build_plots: bool = True,
         collect_all_states: bool = False,
         check_correlation: bool = False,
+        mutable_data: bool = False,
+        workers: int = 1,
+        checkpoint_dir: tp.Union[str, None] = None,
+        checkpoint_every: int = 100,
+        single_load: bool = False,
+        states_path: tp.Union[str, None] = None,
+        profile: tp.Union[bool, qnprof.Profiler, None] = None,
+        mode: str = "iterations",
+        lookahead_checks: int = 5,
+        output_store: tp.Union[str, None] = None,
+        output_chunk_size: int = 1000,
 ):
     """
     Runs a backtest of a given trading strategy over specified data and time period.
@@ -349,6 +709,7 @@ def backtest(
         window (Callable, optional): A function that isolates a subset of data for each iteration.
             It should accept data (DataSet), current datetime (np.datetime64), and tail (int),
             and return a DataSet for the current iteration.
+            If it accepts the 4th argument, the iterations pass the precomputed WindowIndex there.
             If None, a default windowing function is used.
 
         step (int, optional): The step size in days between each iteration.
@@ -367,8 +728,66 @@ def backtest(
         check_correlation (bool, optional): If True, perform a correlation check during analysis.
             Default is False.
 
+        mutable_data (bool, optional): If True, the strategy receives a deep copy of the data window
+            on every iteration and may modify it in place.
+            If False, the strategy receives read-only views of the loaded data (no copying),
+            any attempt to modify them raises an error.
+            Default is False.
+
+        workers (int, optional): The number of worker processes for the multi-pass backtest.
+            Only for strategies without a state. The iterations are split into contiguous date blocks,
+            the data is shared with the workers via shared memory.
+            Default is 1 (sequential run).
+
+        checkpoint_dir (str, optional): The directory for the checkpoints of the multi-pass backtest.
+            The partial output, the iteration index and the last state are saved every `checkpoint_every` iterations.
+            If the backtest was interrupted, the next call with the same arguments resumes from the last checkpoint.
+            The checkpoint is removed when the iterations complete. Not used with `workers` > 1.
+            Default is None (no checkpoints).
+
+        checkpoint_every (int, optional): The number of iterations between checkpoints.
+            Default is 100.
+
+        single_load (bool, optional): If True, the data for the whole period is loaded once.
+            The data for the last pass, the first pass, the cleanup and the analysis is cut from it in memory
+            instead of loading it again. Note that the first pass gets the current data cut at start_date,
+            not the data snapshot available at start_date.
+            Default is False.
+
+        states_path (str, optional): The file for the states collected with `collect_all_states`.
+            Every state is written to this file as soon as it is produced and the function returns
+            a lazy indexable sequence (qnt.state.StateHistory) instead of a list, so the states are not kept in memory.
+            Default is None (the states are kept in a list).
+
+        profile (bool or qnt.profiler.Profiler, optional): If True, the wall time, the call count and
+            the allocated bytes are recorded per stage (load_data, window, copy, strategy, unpack_result,
+            clean, write, analyze). A short table is logged and a JSON report is written at the end,
+            see qnt.profiler.create.
+            Default is None (enabled by the environment variable QNT_PROFILE=1).
+
+        mode (str, optional): "iterations" calls the strategy for every date of the multi-pass backtest.
+            "vectorized" calls the strategy once on the whole dataset, it must return the weights for all dates.
+            Then the strategy is called again on the data truncated at `lookahead_checks` sampled dates
+            and the overlapping rows are compared (qnt.forward_looking.check_forward_looking).
+            If a look-ahead is detected, the backtest falls back to the iterations.
+            Default is "iterations".
+
+        lookahead_checks (int, optional): The number of the truncation points for the look-ahead verification
+            in the vectorized mode.
+            Default is 5.
+
+        output_store (str, optional): The directory of qnt.output.OutputStore for the output of the multi-pass backtest.
+            The output rows are written to the disk in chunks of `output_chunk_size` rows instead of the memory,
+            the store written before to the directory is replaced (it is reused when the backtest resumes
+            from the checkpoint). The store is read chunk by chunk into qnt.output.SparseOutput for the cleaning
+            and the writing, so the result is SparseOutput. Only for the sequential run.
+            Default is None (the output is kept in memory).
+
+        output_chunk_size (int, optional): The number of the rows in the chunks of `output_store`.
+            Default is 1000.
+
     Returns:
-        result (xr.DataArray): The backtest output data.
+        result (xr.DataArray): The backtest output data (qnt.output.SparseOutput with `output_store`).
         state (Any): The final state of the strategy (if applicable).
             If collect_all_states is True, a list of states from all iterations is returned.
 
@@ -391,6 +810,12 @@ def backtest(
 
     qndc.track_event("BACKTEST")
 
+    if mode not in ("iterations", "vectorized"):
+        log_err("ERROR! Unknown mode: " + str(mode) + ". Possible values: iterations, vectorized.")
+        return
+
+    profiler = qnprof.create(profile)
+
     if window is None:
         window = standard_window
 
@@ -400,31 +825,71 @@ def backtest(
     args_count = len(inspect.getfullargspec(strategy).args)
     strategy_wrap = (lambda d, s: strategy(d)) if args_count < 2 else strategy
 
+    if workers > 1 and args_count > 1:
+        log_err("WARNING! The strategy uses a state, it can't be run in parallel. The sequential run is used.")
+        workers = 1
+
+    if workers > 1 and output_store is not None:
+        log_err("WARNING! The output store is supported only by the sequential run. The sequential run is used.")
+        workers = 1
+
+    single_pass = is_submitted() and not is_multi_pass_mode_enabled()
+
+    full_data = None
+    if single_load and not single_pass:
+        log_info("Load full data...")
+        try:
+            qndc.set_max_datetime(end_date)
+            start_date, test_period = calc_start_date(start_date, test_period)
+            with profiler.stage('load_data'):
+                full_data = load_data(test_period + lookback_period + 60)
+        finally:
+            qndc.set_max_datetime(None)
+        validate_data(full_data)
+        full_data, full_time_series = extract_time_series(full_data)
+        if len(full_time_series) < 1:
+            log_err("Time series is empty")
+            return
+        log_info("---")
+
     # ---
     log_info("Run last pass...")
-    log_info("Load data...")
-
-    data = load_data(lookback_period)
-    validate_data(data)
-    data, time_series = extract_time_series(data)
+    if full_data is None:
+        log_info("Load data...")
+        with profiler.stage('load_data'):
+            data = load_data(lookback_period)
+        validate_data(data)
+        data, time_series = extract_time_series(data)
+    else:
+        with profiler.stage('window'):
+            data = call_window(window, full_data, full_time_series[-1], lookback_period)
 
     log_info("Run strategy...")
     state = None
-    if is_submitted() and args_count > 1 and not is_multi_pass_mode_enabled():
+    if single_pass and args_count > 1:
         state = qnstate.read()
-    result = strategy_wrap(data, state)
-    result, state = unpack_result(result)
+    with profiler.stage('strategy'):
+        result = strategy_wrap(data, state)
+    with profiler.stage('unpack_result'):
+        result, state = unpack_result(result)
 
-    log_info("Load data for cleanup...")
-    data = qndata.load_data_by_type(competition_type, assets=result.asset.values.tolist(), tail=60)
+    if isinstance(full_data, xr.DataArray):
+        data = full_data.sel(time=slice(full_time_series[-1] - np.timedelta64(60, 'D'), None))
+    else:
+        log_info("Load data for cleanup...")
+        with profiler.stage('load_data'):
+            data = qndata.load_data_by_type(competition_type, assets=result.asset.values.tolist(), tail=60)
 
-    result = qnout.clean(result, data)
+    with profiler.stage('clean'):
+        result = qnout.clean(result, data)
     result.name = competition_type
     log_info("Write result...")
-    qnout.write(result)
-    qnstate.write(state)
+    with profiler.stage('write'):
+        qnout.write(result)
+        qnstate.write(state)
 
-    if is_submitted() and not is_multi_pass_mode_enabled():
+    if single_pass:
+        profiler.finish()
         if args_count > 1:
             return result, [state] if collect_all_states else state
         else:
@@ -434,57 +899,88 @@ def backtest(
     log_info("---")
     try:
         qndc.set_max_datetime(end_date)
-        last_date = np.datetime64(qndc.parse_date(datetime.date.today()))
-        if start_date is None:
-            start_date = last_date - np.timedelta64(test_period - 1, 'D')
-        else:
-            start_date = pd.Timestamp(start_date).to_datetime64()
-            test_period = (last_date - start_date) // np.timedelta64(1, 'D')
+        if full_data is None:
+            start_date, test_period = calc_start_date(start_date, test_period)
 
         # ---
 
         log_info("Run first pass...")
-        qndc.set_max_datetime(start_date)
-
-        print("Load data...")
-        data = load_data(lookback_period)
-        data, time_series = extract_time_series(data)
+        if full_data is None:
+            qndc.set_max_datetime(start_date)
+            print("Load data...")
+            with profiler.stage('load_data'):
+                data = load_data(lookback_period)
+            data, time_series = extract_time_series(data)
+        else:
+            with profiler.stage('window'):
+                data = call_window(window, full_data, start_date, lookback_period)
         print("Run strategy...")
-        result = strategy_wrap(data, None)
-        result, state = unpack_result(result)
+        with profiler.stage('strategy'):
+            result = strategy_wrap(data, None)
+        with profiler.stage('unpack_result'):
+            result, state = unpack_result(result)
         log_info("---")
 
         qndc.set_max_datetime(end_date)
 
-        log_info("Load full data...")
-        data = load_data(test_period + lookback_period)
-        data, time_series = extract_time_series(data)
-        if len(time_series) < 1:
-            log_err("Time series is empty")
-            return
+        if full_data is None:
+            log_info("Load full data...")
+            with profiler.stage('load_data'):
+                data = load_data(test_period + lookback_period)
+            data, time_series = extract_time_series(data)
+            if len(time_series) < 1:
+                log_err("Time series is empty")
+                return
+        else:
+            data, time_series = full_data, full_time_series
+
+        cleanup_data = None
+        if not isinstance(full_data, xr.DataArray):
+            min_date = time_series[0] - np.timedelta64(60, 'D')
+            # with workers, the loading starts after the workers are forked (see Prefetch)
+            cleanup_data = Prefetch(qndata.load_data_by_type, competition_type, min_date=str(min_date)[:10])
+            if workers <= 1:
+                cleanup_data.start()
 
         # ---
 
         log_info("---")
-        result, state = run_iterations(time_series, data, window, start_date, lookback_period, strategy_wrap, step,
-                                       collect_all_states)
+        result = None
+        if mode == "vectorized":
+            result, state = run_vectorized(time_series, data, window, start_date, lookback_period, strategy_wrap,
+                                           step, lookahead_checks, profiler)
+            if result is None:
+                log_err("WARNING! The vectorized run failed. The iterations are used.")
+            elif collect_all_states:
+                state = [state]
+        if result is None:
+            result, state = run_iterations(time_series, data, window, start_date, lookback_period, strategy_wrap,
+                                           step, collect_all_states, mutable_data, workers, checkpoint_dir,
+                                           checkpoint_every, states_path, profiler=profiler,
+                                           output_store=output_store, output_chunk_size=output_chunk_size,
+                                           output_store_overwrite=True,
+                                           on_start=None if cleanup_data is None else cleanup_data.start)
         if result is None:
             return
 
-        log_info("Load data for cleanup and analysis...")
-        min_date = time_series[0] - np.timedelta64(60, 'D')
-        data = qndata.load_data_by_type(competition_type, min_date=str(min_date)[:10])
-        result = qnout.clean(result, data, competition_type)
+        if cleanup_data is not None:
+            log_info("Load data for cleanup and analysis...")
+            with profiler.stage('load_data'):
+                data = cleanup_data.result()
+        with profiler.stage('clean'):
+            result = qnout.clean(result, data, competition_type)
         result.name = competition_type
         log_info("Write result...")
-        qnout.write(result)
-        qnstate.write(state)
+        with profiler.stage('write'):
+            qnout.write(result)
+            qnstate.write(state)
 
         if analyze:
             log_info("---")
-            analyze_results(output=result, data=data, kind=competition_type, build_plots=build_plots,
-                            start=start_date,
-                            check_correlation=check_correlation)
+            with profiler.stage('analyze'):
+                analyze_results(output=qnout.to_dense(result), data=data, kind=competition_type,
+                                build_plots=build_plots, start=start_date,
+                                check_correlation=check_correlation)
 
         if args_count > 1:
             return result, state
@@ -492,69 +988,933 @@ def backtest(
             return result
     finally:
         qndc.set_max_datetime(None)
+        profiler.finish()
 
 
-def run_iterations(time_series, data, window, start_date, lookback_period, strategy, step, collect_all_states):
-    def copy_window(data, dt, tail):
-        return copy.deepcopy(window(data, dt, tail))
+def backtest_incremental(
+        *,
+        competition_type: str,
+        strategy: tp.Union[
+            tp.Callable[[DataSet], xr.DataArray],
+            tp.Callable[[DataSet, tp.Any], tp.Tuple[xr.DataArray, tp.Any]],
+        ],
+        previous_output: tp.Union[xr.DataArray, str, None] = None,
+        previous_state: tp.Any = None,
+        load_data: tp.Union[tp.Callable[[int], tp.Union[DataSet, tp.Tuple[DataSet, np.ndarray]]], None] = None,
+        lookback_period: int = 365,
+        end_date: tp.Union[np.datetime64, str, datetime.datetime, datetime.date, None] = None,
+        window: tp.Union[tp.Callable[[DataSet, np.datetime64, int], DataSet], None] = None,
+        mutable_data: bool = False,
+        calc_stats: bool = True,
+        previous_stat: tp.Union[qnstat.IncrementalStat, None] = None,
+):
+    """
+    Appends the new days to the output of a previous backtest.
+
+    Only the data for the new days (plus the lookback period) is loaded and the strategy runs
+    only for the dates after the last date of the previous output, starting from the previous state.
+    So the daily run time is proportional to the number of the new days, not to the length of the history.
+    The result is written with qnt.output.write and qnt.state.write, so it can be passed to the next call.
+
+    Parameters:
+        competition_type (str): Specifies the type of competition or dataset to use.
+
+        strategy (Callable): The same strategy as for `backtest`, with or without the state.
+
+        previous_output (xr.DataArray or str, optional): The output of the previous backtest
+            or the path to the file written by qnt.output.write.
+            If None, the output is read from OUTPUT_PATH.
+
+        previous_state (Any, optional): The last state of the previous backtest.
+            If None and the strategy uses a state, the state is read with qnt.state.read.
+
+        load_data (Callable, optional): A function to load the data, see `backtest`.
+
+        lookback_period (int, optional): The number of calendar days to include in each iteration.
+            Default is 365.
+
+        end_date (datetime-like, optional): The end date of the backtest. If None, the end date is today.
+
+        window (Callable, optional): A function that isolates a subset of data for each iteration, see `backtest`.
+
+        mutable_data (bool, optional): see `backtest`.
+
+        calc_stats (bool, optional): If True, the statistics are updated with the new days and returned.
+            Default is True.
+
+        previous_stat (qnt.stats.IncrementalStat, optional): The statistics of the previous backtest
+            (for example, `stat` returned by the previous call). It is updated in place with the new days only.
+            If None, the statistics start with the loaded data (the new days and the lookback period).
+
+    Returns:
+        result (xr.DataArray): The previous output with the new days appended.
+        state (Any): The last state of the strategy (if applicable).
+        stat (qnt.stats.IncrementalStat): The updated statistics (if calc_stats is True),
+            stat.get() returns the statistics for the whole history.
+    """
+    qndc.track_event("BACKTEST_INCREMENTAL")
+
+    if load_data is None:
+        load_data = lambda tail: qndata.load_data_by_type(competition_type, tail=tail)
+
+    if window is None:
+        window = standard_window
+
+    args_count = len(inspect.getfullargspec(strategy).args)
+    strategy_wrap = (lambda d, s: strategy(d)) if args_count < 2 else strategy
+
+    def make_result(result, state, stat):
+        result = (result, state) if args_count > 1 else (result,)
+        result = result + (stat,) if calc_stats else result
+        return result if len(result) > 1 else result[0]
+
+    if previous_output is None or isinstance(previous_output, str):
+        previous_output = qnout.read(previous_output)
+    if previous_state is None and args_count > 1:
+        previous_state = qnstate.read()
+
+    previous_output = previous_output.transpose('time', 'asset')
+    previous_last_date = previous_output.time.values.max()
+
+    try:
+        qndc.set_max_datetime(end_date)
+        last_date = np.datetime64(qndc.parse_date(datetime.date.today()))
+        new_days = (last_date - previous_last_date) // np.timedelta64(1, 'D')
+        if new_days < 1:
+            log_info("No new days.")
+            return make_result(previous_output, previous_state, previous_stat)
+
+        log_info("Load data...")
+        data = load_data(new_days + lookback_period + 1)
+    finally:
+        qndc.set_max_datetime(None)
+
+    data, time_series = extract_time_series(data)
+    new_time_series = time_series[time_series > previous_last_date]
+    if len(new_time_series) < 1:
+        log_info("No new days.")
+        return make_result(previous_output, previous_state, previous_stat)
+
+    result, state = run_iterations(time_series, data, window, new_time_series.min(), lookback_period, strategy_wrap,
+                                   1, False, mutable_data, initial_state=copy.deepcopy(previous_state))
+    if result is None:
+        return
+
+    if not isinstance(data, xr.DataArray):
+        log_info("Load data for cleanup...")
+        min_date = new_time_series.min() - np.timedelta64(60, 'D')
+        data = qndata.load_data_by_type(competition_type, min_date=str(min_date)[:10])
+    result = qnout.clean(result, data, competition_type).transpose('time', 'asset')
+
+    # only the new rows and the columns of the new assets are filled
+    assets = np.union1d(previous_output.asset.values, result.asset.values)
+    if len(assets) > len(previous_output.asset):
+        previous_output = previous_output.reindex(asset=assets, fill_value=0)
+    result = result.reindex(asset=assets).fillna(0)
+
+    stat = None
+    if calc_stats:
+        log_info("Update stats...")
+        stat = previous_stat
+        stat_output = result
+        if stat is None:
+            stat = qnstat.IncrementalStat()
+            stat_output = xr.concat([previous_output.sel(time=slice(data.time.values.min(), None)), result], 'time')
+        new_stat = stat.update(data, stat_output)
+        if new_stat is not None:
+            log_info(new_stat.sel(field=[qnstat.stf.SHARPE_RATIO, qnstat.stf.MEAN_RETURN, qnstat.stf.MAX_DRAWDOWN])
+                     .isel(time=-1).to_pandas())
+
+    result = xr.concat([previous_output, result], 'time')
+    result.name = competition_type
+    log_info("Write result...")
+    qnout.write(result)
+    qnstate.write(state)
+
+    return make_result(result, state, stat)
 
+
+def backtest_many(
+        *,
+        competition_type: str,
+        strategies: tp.Dict[str, tp.Union[
+            tp.Callable[[DataSet], xr.DataArray],
+            tp.Callable[[DataSet, tp.Any], tp.Tuple[xr.DataArray, tp.Any]],
+        ]],
+        load_data: tp.Union[tp.Callable[[int], tp.Union[DataSet, tp.Tuple[DataSet, np.ndarray]]], None] = None,
+        lookback_period: int = 365,
+        test_period: int = 365 * 15,
+        start_date: tp.Union[np.datetime64, str, datetime.datetime, datetime.date, None] = None,
+        end_date: tp.Union[np.datetime64, str, datetime.datetime, datetime.date, None] = None,
+        window: tp.Union[tp.Callable[[DataSet, np.datetime64, int], DataSet], None] = None,
+        step: int = 1,
+        collect_all_states: bool = False,
+        mutable_data: bool = False,
+        workers: int = 1,
+        calc_stats: bool = True,
+):
+    """
+    Runs the multi-pass backtest of a family of strategies against one loaded dataset.
+
+    The data is loaded once and every window is cut once and passed to all strategies.
+    The outputs are not written, use qnt.output.write for the selected one.
+
+    Parameters:
+        competition_type (str): Specifies the type of competition or dataset to use.
+
+        strategies (dict): The strategies by name. Every strategy has the same signature as for `backtest`.
+
+        load_data, lookback_period, test_period, start_date, end_date, window, step,
+        collect_all_states, mutable_data: see `backtest`.
+
+        workers (int, optional): The number of worker processes. The date blocks are split between the workers
+            (see `backtest`); this is possible only when none of the strategies uses a state.
+            Default is 1 (sequential run).
+
+        calc_stats (bool, optional): If True, the statistics are calculated for all outputs.
+            Default is True.
+
+    Returns:
+        outputs (dict): The cleaned outputs by name.
+        states (dict): The states by name (None for the strategies without a state),
+            the lists of the states if collect_all_states is True.
+        stats (xr.DataArray): The statistics with the additional dimension `strategy` or None if calc_stats is False.
+    """
+    qndc.track_event("BACKTEST_MANY")
+
+    if window is None:
+        window = standard_window
+
+    if load_data is None:
+        load_data = lambda tail: qndata.load_data_by_type(competition_type, tail=tail)
+
+    strategies_wrap = dict()
+    stateful = False
+    for name, strategy in strategies.items():
+        if len(inspect.getfullargspec(strategy).args) < 2:
+            strategies_wrap[name] = (lambda st: lambda d, s: st(d))(strategy)
+        else:
+            strategies_wrap[name] = strategy
+            stateful = True
+
+    if workers > 1 and stateful:
+        log_err("WARNING! Some strategies use a state, they can't be run in parallel. The sequential run is used.")
+        workers = 1
+
+    try:
+        qndc.set_max_datetime(end_date)
+        start_date, test_period = calc_start_date(start_date, test_period)
+        log_info("Load data...")
+        data = load_data(test_period + lookback_period + 60)
+    finally:
+        qndc.set_max_datetime(None)
+
+    data, time_series = extract_time_series(data)
+    if len(time_series) < 1:
+        log_err("Time series is empty")
+        return
+
+    cleanup_data = None
+    if not isinstance(data, xr.DataArray):
+        min_date = time_series[0] - np.timedelta64(60, 'D')
+        # the loading starts after the workers are forked (see Prefetch)
+        cleanup_data = Prefetch(qndata.load_data_by_type, competition_type, min_date=str(min_date)[:10])
+
+    outputs, states = run_iterations_many(time_series, data, window, start_date, lookback_period, strategies_wrap,
+                                          step, collect_all_states, mutable_data, workers,
+                                          None if cleanup_data is None else cleanup_data.start)
+    if outputs is None:
+        return
+
+    if cleanup_data is not None:
+        log_info("Load data for cleanup and analysis...")
+        data = cleanup_data.result()
+
+    for name in outputs.keys():
+        log_info("Clean output:", name)
+        outputs[name] = qnout.clean(outputs[name], data, competition_type)
+        outputs[name].name = competition_type
+
+    stats = None
+    if calc_stats:
+        log_info("Calc stats...")
+        portfolio_histories = xr.concat([qnout.align(output, data, start_date) for output in outputs.values()],
+                                        pd.Index(list(outputs.keys()), name='strategy'), join='outer')
+        stats = qnstat.calc_stat_batch(data, portfolio_histories.transpose('strategy', 'time', 'asset'))
+        stats = stats.loc[:, portfolio_histories.time[0]:]
+        log_info(stats.sel(field=[qnstat.stf.SHARPE_RATIO, qnstat.stf.MEAN_RETURN, qnstat.stf.MAX_DRAWDOWN])
+                 .isel(time=-1).to_pandas())
+
+    return outputs, states, stats
+
+
+def calc_start_date(start_date, test_period):
+    """
+    Calculates the start date and the test period (calendar days) of the backtest.
+    The last date is today limited by qnt.data.common.set_max_datetime.
+    """
+    last_date = np.datetime64(qndc.parse_date(datetime.date.today()))
+    if start_date is None:
+        start_date = last_date - np.timedelta64(test_period - 1, 'D')
+    else:
+        start_date = pd.Timestamp(start_date).to_datetime64()
+        test_period = (last_date - start_date) // np.timedelta64(1, 'D')
+    return start_date, test_period
+
+
+def run_iterations(time_series, data, window, start_date, lookback_period, strategy, step, collect_all_states,
+                   mutable_data=False, workers=1, checkpoint_dir=None, checkpoint_every=100, states_path=None,
+                   initial_state=None, profiler=None, output_store=None, output_chunk_size=1000,
+                   output_store_overwrite=False, on_start=None):
+    """
+    :param output_store: the directory of qnout.OutputStore.
+        If it is set, the output rows are written to the disk in chunks of output_chunk_size rows
+        and the store is returned instead of xr.DataArray (the sequential mode only).
+    :param output_store_overwrite: if True, the store written before to output_store is replaced,
+        otherwise it raises FileExistsError (the store is reused when the iterations resume from the checkpoint).
+    :param on_start: called when the iterations start, after the worker processes are forked
+        (for example, Prefetch.start, the threads started before the fork may deadlock the workers)
+    """
     log_info("Run iterations...\n")
 
+    if profiler is None:
+        profiler = qnprof.disabled
+
     ts = np.sort(time_series)
-    all_states = []
 
     output_time_coord = ts[ts >= start_date]
     output_time_coord = output_time_coord[::step]
 
+    window_index = None
+    if window_accepts_index(window):
+        window_index = WindowIndex(data, output_time_coord, lookback_period)
+
     sys.stdout.flush()
 
-    state = None
+    if workers > 1 and len(output_time_coord) > 1 and can_fork():
+        with profiler.stage('iterations (parallel)'):
+            output_data = run_iterations_parallel(output_time_coord, data, window, lookback_period, {None: strategy},
+                                                  mutable_data, workers, window_index, on_start)
+        sys.stderr.flush()
+        if output_data is None:
+            return None, None
+        log_info("Iterations complete.")
+        return output_data[None], [None] * len(output_time_coord) if collect_all_states else None
+
+    if on_start is not None:
+        on_start()
+
+    all_states = None
+    state = initial_state
     num_times = len(output_time_coord)
     output_data = None
+    first_i = 0
+
+    checkpoint_path = None
+    output_rows = None  # the rows of OutputBuffer written to the checkpoints
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        checkpoint_path = os.path.join(checkpoint_dir, CHECKPOINT_FILE_NAME)
+        checkpoint = read_checkpoint(checkpoint_path, output_time_coord, lookback_period)
+        if checkpoint is not None:
+            first_i = checkpoint['i']
+            output_data = checkpoint['output_data']
+            output_rows = checkpoint['output_rows']
+            state = checkpoint['state']
+            all_states = checkpoint['all_states']
+            log_info("Resume from the checkpoint:", str(output_time_coord[first_i - 1])[:10])
+        if output_store is None:
+            if output_rows is None:
+                output_rows = qnstate.StateHistory(os.path.join(checkpoint_dir, CHECKPOINT_ROWS_FILE_NAME))
+            else:
+                output_data = read_checkpoint_rows(output_rows, output_time_coord)
+    checkpoint_i = first_i
+    if all_states is None:
+        all_states = new_state_history(collect_all_states, states_path)
+    if output_data is None:
+        if output_store is not None:
+            output_data = qnout.OutputStore(output_store, output_time_coord, output_chunk_size,
+                                            overwrite=output_store_overwrite)
+        else:
+            output_data = OutputBuffer(output_time_coord)
 
     with progressbar.ProgressBar(max_value=num_times, poll_interval=1) as p:
-        for i, t in enumerate(output_time_coord):
-            tail = copy_window(data, t, lookback_period)
-            result = strategy(tail, copy.deepcopy(state))
-            output, state = unpack_result(result)
-
-            if not isinstance(output, xr.DataArray):
-                log_err("Output is not an xarray DataArray!")
-                return
-            if set(output.dims) not in [{'asset'}, {'asset', 'time'}]:
-                log_err("Wrong output dimensions. ", output.dims, " Should contain only:", {'asset', 'time'})
-                return
-            if 'time' in output.dims:
-                output = output.sel(time=t)
-            output = output.drop_vars(['field', 'time'], errors='ignore')
-
-            if output_data is None:
-                asset_coord = output['asset']
-                output_shape = (num_times, len(asset_coord))
-                output_coords = {'time': output_time_coord, 'asset': asset_coord}
-                output_data = xr.DataArray(
-                    np.empty(output_shape, dtype=output.dtype),
-                    coords=output_coords,
-                    dims=('time', 'asset')
-                )
-            output_data[i] = output.values
+        for i in range(first_i, num_times):
+            t = output_time_coord[i]
+            profiler.start_iteration(i, t)
+            with profiler.stage('window'):
+                tail = call_window(window, data, t, lookback_period, window_index)
+            with profiler.stage('copy'):
+                tail = copy.deepcopy(tail) if mutable_data else readonly_view(tail)
+                state_copy = copy.deepcopy(state)
+            with profiler.stage('strategy'):
+                result = strategy(tail, state_copy)
+            with profiler.stage('unpack_result'):
+                output, state = unpack_result(result)
+                output = prepare_iteration_output(output, t)
+            profiler.end_iteration()
+            if output is None:
+                return None, None
+
+            output_data.put(i, output)
 
             if collect_all_states:
                 all_states.append(state)
 
+            if checkpoint_path is not None and (i + 1) % checkpoint_every == 0 and i + 1 < num_times:
+                if output_rows is not None:
+                    # only the rows after the previous checkpoint are appended
+                    output_rows.append((checkpoint_i,) + output_data.get_rows(checkpoint_i, i + 1))
+                write_checkpoint(checkpoint_path, dict(
+                    output_time_coord=output_time_coord,
+                    lookback_period=lookback_period,
+                    i=i + 1,
+                    output_data=output_data if output_rows is None else None,
+                    output_rows=output_rows,
+                    state=state,
+                    all_states=all_states,
+                ))
+                checkpoint_i = i + 1
+
             p.update(i + 1)
 
     sys.stderr.flush()
     log_info("Iterations complete.")
 
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    if output_rows is not None and os.path.exists(output_rows.path):
+        os.remove(output_rows.path)
+
+    if num_times == 0:
+        output_data = None
+    elif output_store is not None:
+        output_data.flush()
+    else:
+        output_data = output_data.to_xarray()
     return output_data, all_states if collect_all_states else state
 
 
-def standard_window(data, max_date: np.datetime64, lookback_period: int):
+def new_state_history(collect_all_states, states_path):
+    """
+    :return: qnt.state.StateHistory if the states have to be written to states_path, otherwise list
+    """
+    if collect_all_states and states_path is not None:
+        return qnstate.StateHistory(states_path)
+    return []
+
+
+def run_vectorized(time_series, data, window, start_date, lookback_period, strategy, step, lookahead_checks,
+                   profiler=None):
+    """
+    Calls the strategy once on the whole data and verifies that it doesn't look ahead:
+    the strategy is called again on the data truncated at the sampled output dates
+    and the overlapping rows are compared.
+    :return: output for the output dates and the state or (None, None) if the output is wrong or looks ahead
+    """
+    if profiler is None:
+        profiler = qnprof.disabled
+
+    ts = np.sort(time_series)
+    output_time_coord = ts[ts >= start_date][::step]
+    if len(output_time_coord) < 1:
+        return None, None
+
+    log_info("Run strategy on the whole data...")
+    with profiler.stage('strategy'):
+        whole_output = strategy(readonly_view(data), None)
+    whole_output, state = unpack_result(whole_output)
+    if not isinstance(whole_output, xr.DataArray) or set(whole_output.dims) != {'asset', 'time'}:
+        log_err("ERROR! The vectorized strategy must return xr.DataArray with the dimensions time and asset.")
+        return None, None
+    whole_output = whole_output.drop_vars('field', errors='ignore').transpose('time', 'asset')
+
+    with profiler.stage('look-ahead check'):
+        if check_look_ahead(ts, data, window, output_time_coord, strategy, whole_output, lookahead_checks):
+            return None, None
+
+    output = whole_output.reindex(time=output_time_coord)
+    return output, state
+
+
+def check_look_ahead(time_series, data, window, output_time_coord, strategy, whole_output, checks):
+    """
+    Checks the output of the strategy calculated on the whole data for the look-ahead.
+    The strategy is called on the data truncated at the sampled dates,
+    the outputs are compared with qnt.forward_looking.check_forward_looking.
+    :return: True if the strategy looks ahead
+    """
+    with qnlog.Settings(err=False):  # qnt.forward_looking is deprecated, it logs the notice on import
+        import qnt.forward_looking as qnfl
+
+    points = output_time_coord[:-1]
+    if len(points) > checks:
+        points = points[np.linspace(0, len(points) - 1, checks).round().astype(int)]
+
+    for t in points:
+        log_info("Check look-ahead, truncate at " + str(t)[:10] + "...")
+        lookback_period = (t - time_series[0]) // np.timedelta64(1, 'D')
+        cropped_data = readonly_view(call_window(window, data, t, lookback_period))
+        cropped_output = unpack_result(strategy(cropped_data, None))[0]
+        if not isinstance(cropped_output, xr.DataArray) or 'time' not in cropped_output.dims:
+            log_err("ERROR! The vectorized strategy must return xr.DataArray with the dimensions time and asset.")
+            return True
+        cropped_output = cropped_output.drop_vars('field', errors='ignore')
+        with qnlog.Settings(err=False):
+            looks_ahead = qnfl.check_forward_looking(cropped_output, whole_output)
+        if looks_ahead:
+            log_err("WARNING! The strategy looks ahead, the output differs for the data truncated at " + str(t)[:10])
+            return True
+    return False
+
+
+def run_iterations_many(time_series, data, window, start_date, lookback_period, strategies, step,
+                        collect_all_states, mutable_data=False, workers=1, on_start=None):
+    """
+    Runs the iterations of several strategies. Every window is cut once and passed to all strategies.
+    :param strategies: dict of the strategies (data, state) -> output or (output, state)
+    :param on_start: called when the iterations start, after the worker processes are forked (see run_iterations)
+    :return: dict of the outputs, dict of the states (or of the lists of states if collect_all_states is True)
+    """
+    log_info("Run iterations...\n")
+
+    ts = np.sort(time_series)
+    output_time_coord = ts[ts >= start_date][::step]
+
+    window_index = None
+    if window_accepts_index(window):
+        window_index = WindowIndex(data, output_time_coord, lookback_period)
+
+    sys.stdout.flush()
+
+    if workers > 1 and len(output_time_coord) > 1 and can_fork():
+        output_data = run_iterations_parallel(output_time_coord, data, window, lookback_period, strategies,
+                                              mutable_data, workers, window_index, on_start)
+        sys.stderr.flush()
+        if output_data is None:
+            return None, None
+        log_info("Iterations complete.")
+        states = dict((k, [None] * len(output_time_coord) if collect_all_states else None) for k in strategies)
+        return output_data, states
+
+    if on_start is not None:
+        on_start()
+
+    output_data = dict((k, OutputBuffer(output_time_coord)) for k in strategies)
+    states = dict((k, None) for k in strategies)
+    all_states = dict((k, []) for k in strategies)
+
+    with progressbar.ProgressBar(max_value=len(output_time_coord), poll_interval=1) as p:
+        for i, t in enumerate(output_time_coord):
+            tail = call_window(window, data, t, lookback_period, window_index)
+            if not mutable_data:
+                tail = readonly_view(tail)
+            for k, strategy in strategies.items():
+                result = strategy(copy.deepcopy(tail) if mutable_data else tail, copy.deepcopy(states[k]))
+                output, states[k] = unpack_result(result)
+                output = prepare_iteration_output(output, t)
+                if output is None:
+                    log_err("ERROR! Wrong output of the strategy:", k)
+                    return None, None
+                output_data[k].put(i, output)
+                if collect_all_states:
+                    all_states[k].append(states[k])
+            p.update(i + 1)
+
+    sys.stderr.flush()
+    log_info("Iterations complete.")
+
+    output_data = dict((k, v.to_xarray()) for k, v in output_data.items())
+    return output_data, all_states if collect_all_states else states
+
+
+CHECKPOINT_FILE_NAME = "backtest.checkpoint.pickle.gz"
+CHECKPOINT_ROWS_FILE_NAME = "backtest.checkpoint.rows"
+
+
+def write_checkpoint(path, checkpoint):
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, 'wb') as gz:
+        pickle.dump(checkpoint, gz)
+    os.replace(tmp_path, path)  # the previous checkpoint stays valid if the process is killed while writing
+
+
+def read_checkpoint(path, output_time_coord, lookback_period):
+    """
+    Reads the checkpoint if it matches the current iterations.
+    :return: dict or None
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with gzip.open(path, 'rb') as gz:
+            checkpoint = pickle.load(gz)
+    except Exception as e:
+        log_err("WARNING! Can't load the checkpoint.", e)
+        return None
+    if checkpoint['lookback_period'] != lookback_period \
+            or not np.array_equal(checkpoint['output_time_coord'], output_time_coord):
+        log_err("WARNING! The checkpoint doesn't match the backtest parameters or the data and was skipped.")
+        return None
+    return checkpoint
+
+
+def read_checkpoint_rows(output_rows, output_time_coord):
+    """
+    Restores OutputBuffer from the blocks of rows appended at the checkpoints.
+    :param output_rows: qnt.state.StateHistory with the blocks (first row, assets, values)
+    """
+    output_data = OutputBuffer(output_time_coord)
+    for start, assets, values in output_rows:
+        output_data.put_rows(slice(start, start + len(values)), assets, values)
+    return output_data
+
+
+def call_window(window, data, dt, tail, window_index=None):
+    if window_index is None and window_accepts_index(window):
+        window_index = WindowIndex(data, [dt], tail)
+    if window_index is not None:
+        return window(data, dt, tail, window_index)
+    return window(data, dt, tail)
+
+
+def prepare_iteration_output(output, t):
+    """
+    Checks the strategy output for one iteration and cuts the row for the date t.
+    :return: xr.DataArray with the asset dimension or None if the output is wrong
+    """
+    if not isinstance(output, xr.DataArray):
+        log_err("Output is not an xarray DataArray!")
+        return None
+    if set(output.dims) not in [{'asset'}, {'asset', 'time'}]:
+        log_err("Wrong output dimensions. ", output.dims, " Should contain only:", {'asset', 'time'})
+        return None
+    if 'time' in output.dims:
+        output = output.sel(time=t)
+    return output.drop_vars(['field', 'time'], errors='ignore')
+
+
+class OutputBuffer:
+    """
+    Preallocated buffer for the backtest output.
+    The rows are written by the time position and xr.DataArray is built once at the end.
+    The assets are mapped to the columns with a growable index,
+    so the assets which appear in the middle of the backtest are aligned correctly (earlier rows are NaN).
+    """
+
+    def __init__(self, time_coord):
+        self.time_coord = np.asarray(time_coord)
+        self.asset_coord = []
+        self.asset_idx = dict()
+        self.values = np.full((len(self.time_coord), 0), np.nan)
+        self.last_assets = None
+        self.last_columns = None
+
+    def columns(self, assets):
+        """
+        :return: the columns of the assets as slice or index array, new assets are appended to the index
+        """
+        assets = np.asarray(assets)
+        if self.last_assets is not None and len(self.last_assets) == len(assets) \
+                and np.array_equal(self.last_assets, assets):
+            return self.last_columns
+        for a in assets:
+            if a not in self.asset_idx:
+                self.asset_idx[a] = len(self.asset_coord)
+                self.asset_coord.append(a)
+        if len(self.asset_coord) > self.values.shape[1]:
+            capacity = max(len(self.asset_coord), 2 * self.values.shape[1])
+            values = np.full((len(self.time_coord), capacity), np.nan)
+            values[:, :self.values.shape[1]] = self.values
+            self.values = values
+        columns = np.array([self.asset_idx[a] for a in assets], dtype=np.int64)
+        if len(columns) > 0 and np.all(np.diff(columns) == 1):
+            columns = slice(columns[0], columns[-1] + 1)
+        self.last_assets = assets
+        self.last_columns = columns
+        return columns
+
+    def put(self, i, output: xr.DataArray):
+        """
+        Writes the output row (the asset dimension only) for the time position i.
+        """
+        columns = self.columns(output.asset.values)
+        self.values[i, columns] = output.values
+
+    def put_rows(self, rows, assets, values: np.ndarray):
+        """
+        Writes the rows (time positions, slice or index array) for the assets.
+        :param values: 2D array (rows, assets)
+        """
+        columns = self.columns(assets)
+        if isinstance(columns, slice) or isinstance(rows, slice):
+            self.values[rows, columns] = values
+        else:
+            self.values[np.ix_(rows, columns)] = values
+
+    def get_rows(self, start, end):
+        """
+        :return: the assets and the copy of the rows [start, end) (rows, assets)
+        """
+        return np.array(self.asset_coord), self.values[start:end, :len(self.asset_coord)].copy()
+
+    def get_values(self):
+        if self.values.shape[1] == len(self.asset_coord):
+            return self.values
+        return np.ascontiguousarray(self.values[:, :len(self.asset_coord)])
+
+    def to_xarray(self):
+        return xr.DataArray(
+            self.get_values(),
+            coords={'time': self.time_coord, 'asset': np.array(self.asset_coord)},
+            dims=('time', 'asset')
+        )
+
+
+def run_iterations_parallel(output_time_coord, data, window, lookback_period, strategies, mutable_data, workers,
+                            window_index=None, on_start=None):
+    """
+    Runs the iterations of stateless strategies in worker processes.
+    output_time_coord is split into contiguous blocks, one block per worker.
+    Every window is cut once and passed to all strategies.
+    The result is the same as the result of the sequential run.
+    The workers are forked (see can_fork), the run fails if a worker exits without its result.
+    :param strategies: dict of the strategies (data, state) -> output
+    :param on_start: called after the workers are forked (for example, Prefetch.start)
+    :return: dict of the outputs with the same keys or None if a worker failed
+    """
+    blocks = [b for b in np.array_split(output_time_coord, workers) if len(b) > 0]
+    segments = []
+    try:
+        shared = share_data(data, segments)
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        processes = [
+            context.Process(
+                name="backtest_worker#" + str(i),
+                target=run_iterations_worker,
+                args=(i, blocks[i], shared, window, lookback_period, strategies, mutable_data, queue, window_index)
+            ) for i in range(len(blocks))
+        ]
+        for w in processes:
+            w.daemon = True
+            w.start()
+        if on_start is not None:
+            on_start()
+
+        block_results = [None] * len(blocks)
+        failed = False
+        with progressbar.ProgressBar(max_value=len(output_time_coord), poll_interval=1) as p:
+            done = 0
+            finished = 0
+            while finished < len(blocks):
+                msg = get_worker_message(queue, [w for w, r in zip(processes, block_results) if r is None])
+                if msg[0] == 'progress':
+                    done += 1
+                    p.update(done)
+                    continue
+                finished += 1
+                if msg[0] == 'error':
+                    log_err("ERROR! The worker failed:", msg[2])
+                    failed = True
+                    break
+                block_results[msg[1]] = msg[2]
+
+        for w in processes:
+            if failed:
+                w.terminate()
+            w.join()
+    finally:
+        for shm in segments:
+            shm.close()
+            shm.unlink()
+
+    if failed or any(r is None for r in block_results):
+        return None
+
+    output_data = dict((k, OutputBuffer(output_time_coord)) for k in strategies.keys())
+    offset = 0
+    for block_result in block_results:
+        for k, (asset_coord, values) in block_result.items():
+            output_data[k].put_rows(slice(offset, offset + len(values)), asset_coord, values)
+        offset += len(next(iter(block_result.values()))[1])
+    return dict((k, v.to_xarray()) for k, v in output_data.items())
+
+
+def run_iterations_worker(block_idx, block, shared, window, lookback_period, strategies, mutable_data, queue,
+                          window_index=None):
+    segments = []
+    try:
+        data = attach_data(shared, segments)
+        output_data = dict((k, OutputBuffer(block)) for k in strategies.keys())
+        for i, t in enumerate(block):
+            tail = call_window(window, data, t, lookback_period, window_index)
+            if not mutable_data:
+                tail = readonly_view(tail)
+            for k, strategy in strategies.items():
+                output = unpack_result(strategy(copy.deepcopy(tail) if mutable_data else tail, None))[0]
+                output = prepare_iteration_output(output, t)
+                if output is None:
+                    queue.put(('error', block_idx, "wrong output"))
+                    return
+                output_data[k].put(i, output)
+            queue.put(('progress', block_idx))
+        queue.put(('result', block_idx,
+                   dict((k, (v.asset_coord, v.get_values())) for k, v in output_data.items())))
+    except Exception as e:
+        import logging
+        logging.exception("exception in worker")
+        queue.put(('error', block_idx, repr(e)))
+
+
+def share_data(data, segments):
+    """
+    Copies the arrays of the DataSet to shared memory.
+    :param data: DataSet
+    :param segments: list for the created shared memory blocks, the caller has to unlink them
+    :return: picklable description of the DataSet for attach_data
+    """
+    if isinstance(data, xr.DataArray) and data.dtype != object:
+        values = data.values
+        shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        segments.append(shm)
+        np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[...] = values
+        return ('shared', shm.name, values.shape, values.dtype, data.dims, data.coords.to_dataset(),
+                data.name, data.attrs)
+    if isinstance(data, dict):
+        return ('dict', dict((k, share_data(v, segments)) for k, v in data.items()))
+    return ('plain', data)
+
+
+def attach_data(shared, segments):
+    """
+    Restores the DataSet shared by share_data without copying.
+    :param shared: description of the DataSet
+    :param segments: list for the attached shared memory blocks, they have to be kept while the data is used
+    :return: DataSet
+    """
+    if shared[0] == 'dict':
+        return dict((k, attach_data(v, segments)) for k, v in shared[1].items())
+    if shared[0] == 'plain':
+        return shared[1]
+    kind, shm_name, shape, dtype, dims, coords, name, attrs = shared
+    shm = shared_memory.SharedMemory(name=shm_name)
+    segments.append(shm)
+    values = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return xr.DataArray(values, dims=dims, coords=coords.coords, name=name, attrs=attrs)
+
+
+def standard_window(data, max_date: np.datetime64, lookback_period: int, window_index=None):
+    if window_index is not None:
+        return window_index.cut(data, max_date)
     min_date = max_date - np.timedelta64(lookback_period, 'D')
     return data.loc[dict(time=slice(min_date, max_date))]
 
 
+class WindowIndex:
+    """
+    Integer positions of the data windows for the output dates.
+    The positions are calculated once with np.searchsorted, so the window is cut with isel
+    instead of the label-based lookup on every iteration.
+
+    For dict datasets, the positions are calculated for every component with the time dimension.
+    A custom window function receives the index as the 4th argument if it accepts it:
+
+        def window(data, max_date, lookback_period, window_index):
+            start, end = window_index.positions(max_date, 'futures')
+            ...
+    """
+
+    def __init__(self, data: DataSet, dates: np.ndarray, lookback_period: int):
+        self.dates = np.sort(np.asarray(dates).astype('datetime64[ns]'))
+        self.lookback_period = lookback_period
+        if isinstance(data, dict):
+            self.time_coords = dict((k, get_sorted_time_coord(v)) for k, v in data.items())
+        else:
+            self.time_coords = {None: get_sorted_time_coord(data)}
+        self.start_idx = dict()
+        self.end_idx = dict()
+        for k, time_coord in self.time_coords.items():
+            if time_coord is None:
+                continue
+            self.start_idx[k], self.end_idx[k] = calc_window_positions(time_coord, self.dates, lookback_period)
+
+    def positions(self, max_date: np.datetime64, key=None) -> tp.Tuple[int, int]:
+        """
+        :param max_date: the last date of the window
+        :param key: the key of the dict dataset component or None for xr.DataArray
+        :return: (start_idx, end_idx) of the window along the time dimension
+        """
+        if key not in self.start_idx:
+            raise KeyError("The window index has no time positions for " + repr(key))
+        max_date = np.datetime64(max_date, 'ns')
+        i = np.searchsorted(self.dates, max_date)
+        if i < len(self.dates) and self.dates[i] == max_date:
+            return int(self.start_idx[key][i]), int(self.end_idx[key][i])
+        start_idx, end_idx = calc_window_positions(self.time_coords[key], np.array([max_date]), self.lookback_period)
+        return int(start_idx[0]), int(end_idx[0])
+
+    def cut(self, data: DataSet, max_date: np.datetime64, key=None) -> DataSet:
+        """
+        Cuts the window from the data which was used to build the index.
+        Dict components without the time dimension are returned as is.
+        Unsorted data is cut by labels.
+        """
+        if isinstance(data, dict):
+            return dict((k, self.cut(v, max_date, k)) for k, v in data.items())
+        if not isinstance(data, xr.DataArray) or 'time' not in data.dims:
+            return data
+        if key not in self.start_idx:
+            min_date = max_date - np.timedelta64(self.lookback_period, 'D')
+            return data.loc[dict(time=slice(min_date, max_date))]
+        start_idx, end_idx = self.positions(max_date, key)
+        return data.isel(time=slice(start_idx, end_idx))
+
+
+def get_sorted_time_coord(data):
+    """
+    :return: the time coordinate as datetime64[ns] or None if it is missing or unsorted
+    """
+    if not isinstance(data, xr.DataArray) or 'time' not in data.dims:
+        return None
+    time_coord = data.time.values.astype('datetime64[ns]')
+    if len(time_coord) > 1 and np.any(time_coord[1:] < time_coord[:-1]):
+        return None
+    return time_coord
+
+
+def calc_window_positions(time_coord, dates, lookback_period):
+    dates = np.asarray(dates).astype('datetime64[ns]')
+    start_idx = np.searchsorted(time_coord, dates - np.timedelta64(lookback_period, 'D'), side='left')
+    end_idx = np.searchsorted(time_coord, dates, side='right')
+    return start_idx, end_idx
+
+
+def window_accepts_index(window):
+    try:
+        return len(inspect.getfullargspec(window).args) > 3
+    except TypeError:
+        return False
+
+
+def readonly_view(data):
+    """
+    Wraps the data window without copying the underlying arrays and forbids writing to them.
+    Unknown objects are deep copied.
+    :param data: DataSet (xr.DataArray or dict of them)
+    :return: read-only DataSet
+    """
+    if isinstance(data, xr.DataArray):
+        values = data.values.view()
+        values.flags.writeable = False
+        return data.copy(deep=False, data=values)
+    if isinstance(data, dict):
+        return dict((k, readonly_view(v)) for k, v in data.items())
+    if isinstance(data, (tuple, list)):
+        return type(data)(readonly_view(i) for i in data)
+    return copy.deepcopy(data)
+
+
 def extract_time_series(data):
     if type(data) == tuple:
         return data
@@ -590,20 +1950,23 @@ def analyze_results(output, data, kind, build_plots, start=None, check_correlati
         log_err("ERROR! Output is empty!")
         return
 
+    # the market is prepared once for the check and the stats
+    market = qnstat.prepare_market(data)
+
     log_info("Check...")
-    qnout.check(output=output, data=data, kind=kind, check_correlation=check_correlation)
+    qnout.check(output=output, data=data, kind=kind, check_correlation=check_correlation, market=market)
     log_info("---")
     log_info("Align...")
     output = qnout.align(output, data, start)
     log_info("Calc global stats...")
-    stat_global = qnstat.calc_stat(data, output)
+    stat_global = qnstat.calc_stat(market, output)
     stat_global = stat_global.loc[output.time[0]:]
     if not build_plots:
         log_info(stat_global.to_pandas().tail())
         return
     log_info("---")
     log_info("Calc stats per asset...")
-    stat_per_asset = qnstat.calc_stat(data, output, per_asset=True)
+    stat_per_asset = qnstat.calc_stat(market, output, per_asset=True)
     stat_per_asset = stat_per_asset.loc[output.time.values[0]:]
 
     if is_notebook():
@@ -877,7 +2240,9 @@ if __name__ == '__main__':
     #     #     display(crypto)
     #     return {"futures": futures, "crypto": crypto}, futures.time.values
     #
-    # def window(data, max_date: np.datetime64, lookback_period: int):
+    # def window(data, max_date: np.datetime64, lookback_period: int, window_index=None):
+    #     if window_index is not None:
+    #         return window_index.cut(data, max_date)
     #     min_date = max_date - np.timedelta64(lookback_period, 'D')
     #     return {
     #         "futures": data['futures'].sel(time=slice(min_date, max_date)),
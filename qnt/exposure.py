@@ -1,10 +1,14 @@
 import qnt.stats as qnstats
+from qnt.output import SparseOutput
 import xarray as xr
 import numpy as np
 
 
 def drop_bad_days(weights, max_weight = 0.049):
     exposure = qnstats.calc_exposure(weights)
+    if isinstance(weights, SparseOutput):
+        max_exposure = qnstats.calc_max_exposure_sparse(exposure)[0]
+        return weights.filter((max_exposure < max_weight)[weights.row_ids()])
     return weights.where(exposure.max('asset') < max_weight).fillna(0)
 
 
@@ -38,4 +42,7 @@ def mix_weights(primary, secondary, max_weight = 0.049):
 
 
 def cut_big_positions(weights, max_weight = 0.049):
+    if isinstance(weights, SparseOutput):
+        return weights.copy(np.where(abs(weights.values) > max_weight, np.sign(weights.values) * max_weight,
+                                     weights.values))
     return xr.where(abs(weights) > max_weight, np.sign(weights)*max_weight, weights)
@@ -1,13 +1,19 @@
+import numba
 import numpy as np
 import xarray as xr
 import pandas as pd
 import gzip
+import os
+import pickle
+import shutil
 
 from qnt.log import log_info, log_err, Settings as LogSettings
 
 
 def normalize(output, per_asset=False):
     from qnt.data.common import ds
+    if isinstance(output, SparseOutput):
+        return normalize_sparse(output, per_asset)
     output = output.where(np.isfinite(output)).fillna(0)
     if ds.TIME in output.dims:
         output = output.transpose(ds.TIME, ds.ASSET)
@@ -29,6 +35,19 @@ def normalize(output, per_asset=False):
     return output
 
 
+def normalize_sparse(output, per_asset=False):
+    """
+    normalize for SparseOutput
+    """
+    output = output.filter(np.logical_and(np.isfinite(output.values), output.values != 0)).sorted()
+    if per_asset:
+        return output.copy(np.clip(output.values, -1, 1))
+    row_ids = output.row_ids()
+    s = np.bincount(row_ids, weights=abs(output.values), minlength=len(output))
+    s[s < 1] = 1
+    return output.copy(output.values / s[row_ids])
+
+
 def clean(output, data, kind=None, debug=True):
     """
     Checks the output and fix common errors:
@@ -36,7 +55,7 @@ def clean(output, data, kind=None, debug=True):
         - missed dates
         - exposure
         - normalization
-    :param output:
+    :param output: xarray, SparseOutput or OutputStore (it is cleaned as SparseOutput)
     :param data:
     :param kind:
     :return:
@@ -48,6 +67,11 @@ def clean(output, data, kind=None, debug=True):
     if kind is None:
         kind = data.name
 
+    if isinstance(output, OutputStore):
+        output = to_sparse(output)
+    if isinstance(output, SparseOutput):
+        return clean_sparse(output, data, kind)
+
     output = output.drop_vars(ds.FIELD, errors='ignore')
 
     with LogSettings(err2info=True):
@@ -146,9 +170,166 @@ def clean(output, data, kind=None, debug=True):
     return output
 
 
-def check(output, data, kind=None, check_correlation=True):
+def clean_sparse(output, data, kind):
+    """
+    clean for SparseOutput. The masks of the data (close, is_liquid) are dense like the data,
+    the weights stay sparse.
+    """
+    import qnt.stats as qns
+    import qnt.exposure as qne
+    from qnt.data.common import ds, f, track_event
+
+    stock_kinds = ["stocks", "stocks_long", "stocks_nasdaq100", "stocks_s&p500", "crypto_daily", "cryptodaily",
+                   "crypto_daily_long", "crypto_daily_long_short"]
+
+    with LogSettings(err2info=True):
+        log_info("Output cleaning...")
+        track_event("OUTPUT_CLEAN")
+
+        log_info("fix uniq")
+        output = output.take(np.unique(output.time_coord, return_index=True)[1],
+                             np.unique(output.asset_coord, return_index=True)[1])
+
+        log_info("ffill if the current price is None...")
+        output = output.take(np.nonzero(np.isin(output.time_coord, data.coords[ds.TIME].values))[0],
+                             np.nonzero(np.isin(output.asset_coord, data.coords[ds.ASSET].values))[0])
+        output_data = data.sel({ds.TIME: output.time_coord, ds.ASSET: output.asset_coord})
+        finite = np.isfinite(output_data.sel({ds.FIELD: f.CLOSE}).transpose(ds.TIME, ds.ASSET).values)
+        if kind not in ["stocks_nasdaq100", "stocks_s&p500"]:
+            indptr = np.zeros(len(output) + 1, dtype=np.int64)
+            ffill_sparse_nb(output.indptr, output.indices, output.values, finite, indptr,
+                            np.zeros(0, dtype=np.int64), np.zeros(0))
+            indices = np.zeros(indptr[-1], dtype=np.int64)
+            values = np.zeros(indptr[-1])
+            ffill_sparse_nb(output.indptr, output.indices, output.values, finite, indptr, indices, values)
+            output = SparseOutput(output.time_coord, output.asset_coord, indptr, indices, values, output.name)
+            output = output.take(columns=np.arange(len(output.asset_coord)))  # sorts the assets of the rows
+        else:
+            output = output.filter(finite[output.row_ids(), output.indices])
+
+        if kind in stock_kinds:
+            log_info("Check liquidity...")
+            is_liquid = output_data.sel({ds.FIELD: f.IS_LIQUID}).transpose(ds.TIME, ds.ASSET).values
+            non_liquid = is_liquid[output.row_ids(), output.indices] == 0
+            if non_liquid.any():
+                log_info("WARNING! Strategy trades non-liquid assets.")
+                log_info("Fix liquidity...")
+                output = output.filter(np.logical_not(non_liquid))
+            log_info("Ok.")
+
+        log_info("Check missed dates...")
+        if len(output) == 0:
+            log_info("WARNING! Output is empty.")
+        else:
+            missed_dates = qns.find_missed_dates(output, data)
+            if len(missed_dates) > 0:
+                log_info("WARNING! Output contain missed dates.")
+                log_info("Adding missed dates and set zero...")
+                output = SparseOutput(
+                    np.concatenate([output.time_coord, missed_dates]), output.asset_coord,
+                    np.concatenate([output.indptr, np.full(len(missed_dates), output.indptr[-1])]),
+                    output.indices, output.values, output.name
+                ).sorted()
+                if kind in stock_kinds:
+                    # drops the weights of the non-liquid assets and the days and the assets without liquid assets
+                    output_data = data.sel({ds.TIME: output.time_coord, ds.ASSET: output.asset_coord})
+                    liquid = output_data.sel({ds.FIELD: f.IS_LIQUID}).transpose(ds.TIME, ds.ASSET).values > 0
+                    output = output.filter(liquid[output.row_ids(), output.indices])
+                    output = output.take(np.nonzero(liquid.any(axis=1))[0], np.nonzero(liquid.any(axis=0))[0])
+                output = normalize(output)
+            else:
+                log_info("Ok.")
+
+        if kind in ['stocks_long', 'crypto_daily_long']:
+            log_info("Check positive positions...")
+            if (output.values < 0).any():
+                log_info("WARNING! Output contains negative positions. Clean...")
+                output = output.filter(output.values >= 0)
+            else:
+                log_info("Ok.")
+
+        if kind in ["stocks", "stocks_long"]:
+            log_info("Check exposure...")
+            if not qns.check_exposure(output):
+                log_info("Cut big positions...")
+                output = qne.cut_big_positions(output)
+                log_info("Check exposure...")
+                if not qns.check_exposure(output):
+                    log_info("Drop bad days...")
+                    output = qne.drop_bad_days(output)
+
+        if kind == "crypto":
+            log_info("Check BTC...")
+            traded = np.unique(output.indices[output.values != 0])
+            if output.asset_coord[traded].tolist() != ['BTC']:
+                log_info("WARNING! Output contains not only BTC.")
+                log_info("Fixing...")
+                output = output.take(columns=np.nonzero(output.asset_coord == 'BTC')[0])
+            else:
+                log_info("Ok.")
+
+        log_info("Normalization...")
+        output = normalize(output)
+        log_info("Output cleaning is complete.")
+
+    return output
+
+
+@numba.njit
+def ffill_sparse_nb(indptr, indices, values, finite, out_indptr, out_indices, out_values):
+    """
+    The forward fill of the sparse weights where the price is missed (finite is False).
+    The first call with the empty out_indices calculates out_indptr, the second call fills out_indices and out_values.
+    The assets of the rows are not sorted.
+    """
+    assets = finite.shape[1]
+    count_only = len(out_indices) == 0
+    last = np.zeros(assets)
+    in_row = np.zeros(assets, dtype=np.bool_)
+    active = np.zeros(assets, dtype=np.int64)  # the assets with the non-zero last weight
+    active_count = 0
+    next_active = np.zeros(assets, dtype=np.int64)
+    k = 0
+    for t in range(len(indptr) - 1):
+        out_indptr[t] = k
+        for j in range(indptr[t], indptr[t + 1]):
+            in_row[indices[j]] = True
+        next_count = 0
+        for j in range(indptr[t], indptr[t + 1]):
+            a = indices[j]
+            if finite[t, a]:
+                last[a] = values[j]
+            if last[a] != 0:
+                if not count_only:
+                    out_indices[k] = a
+                    out_values[k] = last[a]
+                k += 1
+                next_active[next_count] = a
+                next_count += 1
+        for i in range(active_count):
+            a = active[i]
+            if in_row[a]:
+                continue
+            if finite[t, a]:
+                last[a] = 0
+            else:
+                if not count_only:
+                    out_indices[k] = a
+                    out_values[k] = last[a]
+                k += 1
+                next_active[next_count] = a
+                next_count += 1
+        for j in range(indptr[t], indptr[t + 1]):
+            in_row[indices[j]] = False
+        active, next_active = next_active, active
+        active_count = next_count
+    out_indptr[len(indptr) - 1] = k
+
+
+def check(output, data, kind=None, check_correlation=True, market=None):
     """
     This function checks your output and warn you if it contains errors.
+    :param market: qnt.stats.PreparedMarket of data for the sharpe ratio, it is shared with the other stats
     :return:
     """
     import qnt.stats as qns
@@ -231,7 +412,7 @@ def check(output, data, kind=None, check_correlation=True):
 
                 log_info("Check the sharpe ratio...")
 
-                sr = calc_sharpe_ratio_for_check(data, output, kind, True)
+                sr = calc_sharpe_ratio_for_check(data, output, kind, True, market)
                 log_info("Sharpe Ratio =", sr)
 
                 if sr < 0.7:
@@ -247,13 +428,14 @@ def check(output, data, kind=None, check_correlation=True):
         log_err(e)
 
 
-def calc_sharpe_ratio_for_check(data, output, kind=None, check_dates=True):
+def calc_sharpe_ratio_for_check(data, output, kind=None, check_dates=True, market=None):
     """
     Calculates sharpe ratio for check according to the rules
     :param data:
     :param output:
     :param kind: competition type
     :param check_dates: do you need to check the sharpe ratio dates?
+    :param market: qnt.stats.PreparedMarket of data, the relative return is calculated on it if it is passed
     :return:
     """
     import qnt.stats as qns
@@ -282,19 +464,349 @@ def calc_sharpe_ratio_for_check(data, output, kind=None, check_dates=True):
     fd = pd.Timestamp(data.time.max().values).to_pydatetime()
     log_info("Period: " + str(sd.date()) + " - " + str(fd.date()))
     output_slice = align(output, data.time, sd, fd)
-    rr = qns.calc_relative_return(data, output_slice)
+    if market is None:
+        rr = qns.calc_relative_return(data, output_slice)
+    else:
+        rr = qns.calc_relative_return_batch(market, output_slice.expand_dims('output')).isel(output=0)
     sr = qns.calc_sharpe_ratio_annualized(rr)
     sr = sr.isel(time=-1).values
     return sr
 
 
+class OutputStore:
+    """
+    On-disk chunked store for the backtest output.
+    The rows are appended in the time order and written to the directory in chunks (npy files),
+    so the memory is bounded by the chunk size, not by the length of the history.
+    The assets are mapped to the columns with a growable index like in the in-memory buffer of the backtester:
+    every chunk contains the columns of the assets known at the moment of the flush, the rest is NaN.
+
+    qnt.output.write accepts the store and compresses it chunk by chunk,
+    to_sparse and clean read it chunk by chunk into SparseOutput.
+    """
+
+    INDEX_FILE_NAME = 'index.pickle'
+
+    def __init__(self, path, time_coord, chunk_size=1000, name=None, overwrite=False):
+        """
+        :param path: the directory of the store, it is created if it doesn't exist
+        :param overwrite: if True, the store written before to the directory is removed,
+                          otherwise the existing store raises FileExistsError
+        """
+        self.path = path
+        self.time_coord = np.asarray(time_coord)
+        self.chunk_size = max(int(chunk_size), 1)
+        self.name = name
+        self.asset_coord = []
+        self.asset_idx = dict()
+        self.flushed = 0
+        self.chunk_columns = []
+        self.count = 0
+        self.values = np.full((self.chunk_size, 0), np.nan)
+        os.makedirs(path, exist_ok=True)
+        files = [f for f in os.listdir(path) if f.startswith('chunk.') or f == self.INDEX_FILE_NAME]
+        if len(files) > 0 and not overwrite:
+            raise FileExistsError("The output store already exists: " + path + ", use overwrite=True to replace it.")
+        for f in files:
+            os.remove(os.path.join(path, f))
+
+    @staticmethod
+    def open(path):
+        """
+        Opens the store written before.
+        """
+        with open(os.path.join(path, OutputStore.INDEX_FILE_NAME), 'rb') as f:
+            index = pickle.load(f)
+        store = OutputStore.__new__(OutputStore)
+        store.__dict__.update(index)
+        store.path = path
+        store.asset_idx = dict((a, i) for i, a in enumerate(store.asset_coord))
+        store.count = store.flushed
+        store.values = np.full((store.chunk_size, len(store.asset_coord)), np.nan)
+        return store
+
+    def __len__(self):
+        return self.count
+
+    def columns(self, assets):
+        for a in assets:
+            if a not in self.asset_idx:
+                self.asset_idx[a] = len(self.asset_coord)
+                self.asset_coord.append(a)
+        if len(self.asset_coord) > self.values.shape[1]:
+            capacity = max(len(self.asset_coord), 2 * self.values.shape[1])
+            values = np.full((self.chunk_size, capacity), np.nan)
+            values[:, :self.values.shape[1]] = self.values
+            self.values = values
+        return np.array([self.asset_idx[a] for a in assets], dtype=np.int64)
+
+    def put(self, i, output: xr.DataArray):
+        """
+        Appends the output row (the asset dimension only) for the time position i.
+        """
+        if i != self.count:
+            raise ValueError("The rows must be appended in order: expected " + str(self.count) + ", got " + str(i))
+        columns = self.columns(output.asset.values)
+        self.values[self.count - self.flushed, columns] = output.values
+        self.count += 1
+        if self.count - self.flushed >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the appended rows to the disk.
+        """
+        rows = self.count - self.flushed
+        if rows > 0:
+            chunk = self.values[:rows, :len(self.asset_coord)]
+            np.save(self._chunk_path(len(self.chunk_columns)), chunk)
+            self.chunk_columns.append(len(self.asset_coord))
+            self.flushed = self.count
+            self.values[:] = np.nan
+        index = dict(time_coord=self.time_coord, chunk_size=self.chunk_size, name=self.name,
+                     asset_coord=self.asset_coord, flushed=self.flushed, chunk_columns=self.chunk_columns)
+        with open(os.path.join(self.path, self.INDEX_FILE_NAME), 'wb') as f:
+            pickle.dump(index, f)
+
+    def chunks(self):
+        """
+        Iterates over the written rows chunk by chunk.
+        :return: iterator of 2D arrays (rows, all assets in the order of asset_coord)
+        """
+        for k, columns in enumerate(self.chunk_columns):
+            chunk = np.load(self._chunk_path(k))
+            values = np.full((len(chunk), len(self.asset_coord)), np.nan)
+            values[:, :columns] = chunk
+            yield values
+        rows = self.count - self.flushed
+        if rows > 0:
+            yield self.values[:rows, :len(self.asset_coord)].copy()
+
+    def to_xarray(self):
+        chunks = list(self.chunks())
+        values = np.concatenate(chunks) if len(chunks) > 0 else np.full((0, len(self.asset_coord)), np.nan)
+        return xr.DataArray(
+            values,
+            coords={'time': self.time_coord[:self.count], 'asset': np.array(self.asset_coord)},
+            dims=('time', 'asset'),
+            name=self.name
+        )
+
+    def _chunk_path(self, k):
+        return os.path.join(self.path, 'chunk.' + str(k).zfill(6) + '.npy')
+
+
+class SparseOutput:
+    """
+    Sparse portfolio_history, the weights are stored by day in the CSR format:
+    the non-zero weights of the day time_coord[i] are values[indptr[i]:indptr[i + 1]]
+    for the assets asset_coord[indices[indptr[i]:indptr[i + 1]]], the other weights are zero.
+
+    For the wide universes (stocks) most of the weights are zero. normalize, clean, qnt.stats.check_exposure
+    and write accept the sparse output and process it without the dense (time, asset) array
+    (write builds the dense rows chunk by chunk). qnt.stats.calc_stat accepts it too, but it densifies the weights
+    for the kernels, like the market data which is dense anyway. to_sparse and to_dense convert the output.
+    """
+
+    def __init__(self, time_coord, asset_coord, indptr, indices, values, name=None):
+        self.time_coord = np.asarray(time_coord)
+        self.asset_coord = np.asarray(asset_coord)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.name = name
+
+    @staticmethod
+    def from_xarray(output, chunk_size=1000):
+        """
+        Converts the dense output (time, asset), NaN are zero.
+        The output is converted by the chunks of rows, so the temporary arrays are bounded by the chunk size.
+        """
+        from qnt.data.common import ds
+        output = output.transpose(ds.TIME, ds.ASSET)
+        dense = output.values
+        return SparseOutput.from_chunks((dense[i:i + chunk_size] for i in range(0, len(dense), chunk_size)),
+                                        output.coords[ds.TIME].values, output.coords[ds.ASSET].values, output.name)
+
+    @staticmethod
+    def from_chunks(chunks, time_coord, asset_coord, name=None):
+        """
+        Converts the dense rows (time, asset) given chunk by chunk (OutputStore.chunks), NaN are zero.
+        """
+        counts = []
+        indices = []
+        values = []
+        for chunk in chunks:
+            rows, columns = np.nonzero(np.logical_and(np.isfinite(chunk), chunk != 0))
+            counts.append(np.bincount(rows, minlength=len(chunk)))
+            indices.append(columns)
+            values.append(chunk[rows, columns])
+        if len(counts) == 0:
+            counts, indices, values = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+        return SparseOutput(
+            time_coord, asset_coord,
+            np.concatenate([[0], np.cumsum(np.concatenate(counts))]), np.concatenate(indices),
+            np.concatenate(values), name
+        )
+
+    @staticmethod
+    def from_csr(matrix, time_coord, asset_coord, name=None):
+        """
+        :param matrix: scipy.sparse matrix (time, asset)
+        """
+        matrix = matrix.tocsr()
+        matrix.sort_indices()
+        return SparseOutput(time_coord, asset_coord, matrix.indptr, matrix.indices, matrix.data, name)
+
+    def to_csr(self):
+        """
+        :return: scipy.sparse.csr_matrix (time, asset) which shares the arrays
+        """
+        import scipy.sparse
+        return scipy.sparse.csr_matrix((self.values, self.indices, self.indptr), shape=self.shape)
+
+    def to_xarray(self):
+        chunks = list(self.chunks())
+        values = np.concatenate(chunks) if len(chunks) > 0 else np.zeros(self.shape)
+        return xr.DataArray(
+            values,
+            coords={'time': self.time_coord, 'asset': self.asset_coord},
+            dims=('time', 'asset'),
+            name=self.name
+        )
+
+    def chunks(self, chunk_size=1000):
+        """
+        Iterates over the dense rows chunk by chunk.
+        :return: iterator of 2D arrays (rows, asset)
+        """
+        for i in range(0, len(self), chunk_size):
+            rows = min(chunk_size, len(self) - i)
+            begin, end = self.indptr[i], self.indptr[i + rows]
+            values = np.zeros((rows, len(self.asset_coord)))
+            row_ids = np.repeat(np.arange(rows), np.diff(self.indptr[i:i + rows + 1]))
+            values[row_ids, self.indices[begin:end]] = self.values[begin:end]
+            yield values
+
+    def __len__(self):
+        return len(self.time_coord)
+
+    @property
+    def shape(self):
+        return len(self.time_coord), len(self.asset_coord)
+
+    @property
+    def nnz(self):
+        return len(self.values)
+
+    def row_ids(self):
+        """
+        :return: the rows of the stored weights
+        """
+        return np.repeat(np.arange(len(self)), np.diff(self.indptr))
+
+    def copy(self, values=None, name=None):
+        """
+        :param values: the new values of the stored weights
+        """
+        return SparseOutput(self.time_coord, self.asset_coord, self.indptr, self.indices,
+                            self.values.copy() if values is None else values, self.name if name is None else name)
+
+    def take(self, rows=None, columns=None):
+        """
+        Selects the rows and the columns.
+        :param rows: the positions of the selected days
+        :param columns: the positions of the selected assets, the weights of the other assets are dropped
+        :return: SparseOutput
+        """
+        result = self
+        if rows is not None:
+            rows = np.asarray(rows, dtype=np.int64)
+            lengths = np.diff(self.indptr)[rows]
+            indptr = np.concatenate([[0], np.cumsum(lengths)])
+            entries = np.repeat(self.indptr[rows] - indptr[:-1], lengths) + np.arange(indptr[-1])
+            result = SparseOutput(self.time_coord[rows], self.asset_coord, indptr, self.indices[entries],
+                                  self.values[entries], self.name)
+        if columns is not None:
+            columns = np.asarray(columns, dtype=np.int64)
+            column_map = np.full(len(result.asset_coord), -1)
+            column_map[columns] = np.arange(len(columns))
+            indices = column_map[result.indices]
+            keep = indices >= 0
+            row_ids = result.row_ids()[keep]
+            indices = indices[keep]
+            order = np.lexsort((indices, row_ids))
+            result = SparseOutput(result.time_coord, result.asset_coord[columns],
+                                  np.concatenate([[0], np.cumsum(np.bincount(row_ids, minlength=len(result)))]),
+                                  indices[order], result.values[keep][order], result.name)
+        return result
+
+    def filter(self, mask):
+        """
+        :param mask: the stored weights to keep
+        :return: SparseOutput without the other weights
+        """
+        counts = np.bincount(self.row_ids()[mask], minlength=len(self))
+        return SparseOutput(self.time_coord, self.asset_coord, np.concatenate([[0], np.cumsum(counts)]),
+                            self.indices[mask], self.values[mask], self.name)
+
+    def sorted(self):
+        """
+        :return: SparseOutput with the sorted time and assets
+        """
+        rows = None if np.all(self.time_coord[1:] > self.time_coord[:-1]) \
+            else np.argsort(self.time_coord, kind='stable')
+        columns = None if np.all(self.asset_coord[1:] > self.asset_coord[:-1]) \
+            else np.argsort(self.asset_coord, kind='stable')
+        return self.take(rows, columns)
+
+    def to_numpy(self, asset_coord, dtype=np.float64):
+        """
+        :return: the dense weights (time, asset) for asset_coord, zero for the other assets
+        """
+        asset_idx = dict((a, i) for i, a in enumerate(asset_coord))
+        column_map = np.array([asset_idx.get(a, -1) for a in self.asset_coord], dtype=np.int64)
+        indices = column_map[self.indices] if len(self.indices) > 0 else self.indices
+        keep = indices >= 0
+        values = np.zeros((len(self), len(asset_coord)), dtype)
+        values[self.row_ids()[keep], indices[keep]] = self.values[keep]
+        return values
+
+
+def to_sparse(output):
+    """
+    :return: SparseOutput for the dense output or OutputStore (it is read chunk by chunk)
+    """
+    if isinstance(output, SparseOutput):
+        return output
+    if isinstance(output, OutputStore):
+        return SparseOutput.from_chunks(output.chunks(), output.time_coord[:len(output)],
+                                        np.array(output.asset_coord), output.name)
+    return SparseOutput.from_xarray(output)
+
+
+def to_dense(output):
+    """
+    :return: xarray for SparseOutput
+    """
+    if isinstance(output, SparseOutput):
+        return output.to_xarray()
+    return output
+
+
 def write(output):
     """
     writes output in the file for submission
-    :param output: xarray with daily weights
+    :param output: xarray with daily weights or OutputStore
     """
     import qnt.data.id_translation as idt
     from qnt.data.common import ds, get_env, track_event
+    if isinstance(output, OutputStore):
+        write_stream(output)
+        return
+    if isinstance(output, SparseOutput):
+        write_sparse(output)
+        return
     output = output.copy()
     output.coords[ds.ASSET] = [idt.translate_user_id_to_server_id(id) for id in output.coords[ds.ASSET].values]
     output = normalize(output)
@@ -307,6 +819,123 @@ def write(output):
     track_event("OUTPUT_WRITE")
 
 
+def write_stream(store, path=None):
+    """
+    Writes the output from OutputStore in the same format as write.
+    The chunks are normalized and written one by one, see write_netcdf_gz.
+    :param store: OutputStore
+    :param path: the file, OUTPUT_PATH by default
+    """
+    import qnt.data.id_translation as idt
+    from qnt.data.common import get_env, track_event
+    time_coord = store.time_coord[:len(store)]
+    if len(time_coord) > 1 and not np.all(np.diff(time_coord) > np.timedelta64(0)):
+        log_info("WARNING! The output time is not sorted.")
+        write(store.to_xarray())
+        return
+    asset_coord = np.array([idt.translate_user_id_to_server_id(id) for id in store.asset_coord], dtype=object)
+    order = np.argsort(asset_coord, kind='stable')
+
+    def normalized_chunks():
+        for chunk in store.chunks():
+            chunk = chunk[:, order]
+            chunk[~np.isfinite(chunk)] = 0
+            s = abs(chunk).sum(axis=1)
+            s[s < 1] = 1
+            yield chunk / s[:, np.newaxis]
+
+    if path is None:
+        path = get_env("OUTPUT_PATH", "fractions.nc.gz")
+    log_info("Write output: " + path)
+    write_netcdf_gz(normalized_chunks(), time_coord, asset_coord[order], store.name, path)
+    track_event("OUTPUT_WRITE")
+
+
+def write_sparse(output, path=None, chunk_size=1000):
+    """
+    Writes SparseOutput in the same format as write.
+    The dense rows are written chunk by chunk, see write_netcdf_gz.
+    :param output: SparseOutput
+    :param path: the file, OUTPUT_PATH by default
+    """
+    import qnt.data.id_translation as idt
+    from qnt.data.common import get_env, track_event
+    output = output.copy()
+    output.asset_coord = np.array([idt.translate_user_id_to_server_id(id) for id in output.asset_coord],
+                                  dtype=object)
+    output = normalize(output)
+    if path is None:
+        path = get_env("OUTPUT_PATH", "fractions.nc.gz")
+    log_info("Write output: " + path)
+    write_netcdf_gz(output.chunks(chunk_size), output.time_coord, output.asset_coord, output.name, path)
+    track_event("OUTPUT_WRITE")
+
+
+def write_netcdf_gz(chunks, time_coord, asset_coord, name, path):
+    """
+    Writes the output (time, asset) to a temporary NetCDF file next to path and compresses it block by block,
+    so only one chunk of the rows is kept in memory.
+
+    The time is the record (unlimited) dimension of the file. Every chunk is serialized by xarray
+    with the time encoded for the whole time_coord, so the headers of the chunks are the same
+    and the records of the next chunks are appended to the first chunk. The result is the same as
+    to_netcdf(unlimited_dims=['time']) for the whole output.
+    :param chunks: iterator of 2D arrays (rows, asset) in the order of time_coord
+    """
+    time_var = xr.conventions.encode_cf_variable(xr.Variable('time', np.asarray(time_coord)))
+
+    def to_netcdf(values, start):
+        output = xr.DataArray(
+            values,
+            coords={'time': xr.Variable('time', time_var.values[start:start + len(values)], time_var.attrs),
+                    'asset': asset_coord},
+            dims=('time', 'asset'),
+            name=name
+        )
+        return output.to_netcdf(engine='scipy', unlimited_dims=['time'])
+
+    tmp_path = path + ".tmp.nc"
+    try:
+        with open(tmp_path, 'wb') as out:
+            empty = to_netcdf(np.zeros((0, len(asset_coord))), 0)
+            header_size = len(empty)  # the header and the asset coord
+            rows = 0
+            for chunk in chunks:
+                if len(chunk) == 0:
+                    continue
+                data = to_netcdf(chunk, rows)
+                out.write(data if rows == 0 else data[header_size:])
+                rows += len(chunk)
+            if rows == 0:
+                out.write(empty)
+            # the number of the records, big-endian int32 after the magic bytes (the NetCDF classic format)
+            out.seek(4)
+            out.write(rows.to_bytes(4, 'big'))
+        with open(tmp_path, 'rb') as inp, gzip.open(path, 'wb') as out:
+            shutil.copyfileobj(inp, out, 1024 ** 2)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read(path=None):
+    """
+    reads the output written by write
+    :param path: the file, OUTPUT_PATH by default
+    :return: xarray with daily weights
+    """
+    import qnt.data.id_translation as idt
+    from qnt.data.common import ds, get_env
+    if path is None:
+        path = get_env("OUTPUT_PATH", "fractions.nc.gz")
+    log_info("Read output: " + path)
+    with open(path, 'rb') as inp:
+        data = gzip.decompress(inp.read())
+    output = xr.open_dataarray(data, cache=False, decode_times=True).compute()
+    output.coords[ds.ASSET] = [idt.translate_server_id_to_user_id(id) for id in output.coords[ds.ASSET].values]
+    return output
+
+
 def align(output, time_coord, start=None, end=None):
     """
     Normalizes, aligns the output with the data and cut the piece.
@@ -0,0 +1,52 @@
+"""
+The precision of the big intermediate arrays (time, asset) of qnt.stats and qnt.ta.
+
+float32 halves the memory and the memory bandwidth for the wide universes and the hourly data.
+The accumulators (equity, running sums, moving averages) are float64 in both modes,
+only the stored arrays are float32.
+
+    import qnt.precision as qnprec
+    qnprec.set_dtype(np.float32)  # global
+    with qnprec.Settings(np.float32):  # for the block of code
+        stat = qnstats.calc_stat(data, output, per_asset=True)
+
+set_dtype changes the precision of the process. Settings changes it only for the current thread
+(the context, see contextvars), so the blocks in the different threads don't affect each other.
+"""
+import contextvars
+
+import numpy as np
+
+dtype = np.float64
+context_dtype = contextvars.ContextVar('qnt_precision_dtype', default=None)
+
+
+def set_dtype(value):
+    global dtype
+    dtype = check_dtype(value)
+
+
+def get_dtype():
+    value = context_dtype.get()
+    return dtype if value is None else value
+
+
+def check_dtype(value):
+    value = np.dtype(value).type
+    if value not in (np.float64, np.float32):
+        raise ValueError("Unsupported precision: " + str(value) + ", float64 or float32 expected")
+    return value
+
+
+class Settings(object):
+    def __init__(self, dtype=None):
+        self.dtype = None if dtype is None else check_dtype(dtype)
+
+    def __enter__(self):
+        self.token = None
+        if self.dtype is not None:
+            self.token = context_dtype.set(self.dtype)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.token is not None:
+            context_dtype.reset(self.token)
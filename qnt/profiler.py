@@ -0,0 +1,160 @@
+import contextlib
+import json
+import os
+import time
+import tracemalloc
+
+from qnt.log import log_info, log_err
+
+PROFILE_ENV = "QNT_PROFILE"
+PROFILE_PATH_ENV = "QNT_PROFILE_PATH"
+PROFILE_SAMPLE_ENV = "QNT_PROFILE_SAMPLE"
+
+
+class Profiler:
+    """
+    Records the wall time, the number of calls and the allocated bytes per stage of the backtest
+    (load_data, window, copy, strategy, clean, ...).
+
+    The wall time is recorded for every call. The allocated bytes (the difference of the memory traced
+    by tracemalloc at the end and at the start of the stage, so the nested stages don't affect each other)
+    are recorded only for every `sample_every`-th iteration, the stages outside the iterations
+    are traced only if trace_stages is True: tracemalloc slows down the allocations several times.
+    The timings of the sampled iterations are kept in the report with the iteration date,
+    so the disabled or sampled profiler is cheap enough to leave on.
+    """
+
+    def __init__(self, enabled=True, sample_every=100, trace_stages=False):
+        """
+        :param sample_every: the memory is traced in every sample_every-th iteration
+        :param trace_stages: if True, the memory of the stages outside the iterations is traced too
+        """
+        self.enabled = enabled
+        self.sample_every = max(int(sample_every), 1)
+        self.trace_stages = trace_stages
+        self.stages = dict()
+        self.iterations = []
+        self.sampled = trace_stages
+        self.current_iteration = None
+
+    def start_iteration(self, i, key):
+        if not self.enabled:
+            return
+        self.sampled = i % self.sample_every == 0
+        if self.sampled:
+            self.current_iteration = dict()
+            self.iterations.append({'iteration': str(key)[:10], 'stages': self.current_iteration})
+
+    def end_iteration(self):
+        self.sampled = self.trace_stages
+        self.current_iteration = None
+
+    def stage(self, name):
+        """
+        :return: context manager which measures the stage
+        """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.measure(name)
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        sampled = self.sampled
+        start_tracing = False
+        memory = 0
+        if sampled:
+            start_tracing = not tracemalloc.is_tracing()
+            if start_tracing:
+                tracemalloc.start()
+            memory = tracemalloc.get_traced_memory()[0]
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            t = time.perf_counter() - t
+            allocated = None
+            if sampled:
+                allocated = tracemalloc.get_traced_memory()[0] - memory
+                if start_tracing:
+                    tracemalloc.stop()
+            self.record(name, t, allocated)
+
+    def record(self, name, wall_time, allocated=None):
+        s = self.stages.get(name)
+        if s is None:
+            s = dict(time=0.0, count=0, sampled=0, allocated=0, max_allocated=0)
+            self.stages[name] = s
+        s['time'] += wall_time
+        s['count'] += 1
+        if allocated is not None:
+            s['sampled'] += 1
+            s['allocated'] += allocated
+            s['max_allocated'] = max(s['max_allocated'], allocated)
+        if self.current_iteration is not None:
+            self.current_iteration[name] = dict(time=wall_time, allocated=allocated)
+
+    def report(self):
+        """
+        :return: dict with the totals per stage and the sampled iterations
+        """
+        stages = dict()
+        for name, s in self.stages.items():
+            stages[name] = dict(
+                time=s['time'],
+                count=s['count'],
+                mean_time=s['time'] / s['count'],
+                mean_allocated=s['allocated'] / s['sampled'] if s['sampled'] > 0 else None,
+                max_allocated=s['max_allocated'] if s['sampled'] > 0 else None,
+            )
+        return dict(sample_every=self.sample_every, stages=stages, iterations=self.iterations)
+
+    def write(self, path=None):
+        if path is None:
+            path = os.environ.get(PROFILE_PATH_ENV, "backtest.profile.json")
+        try:
+            with open(path, 'w') as f:
+                json.dump(self.report(), f, indent=1)
+            log_info("Profile report: " + path)
+        except Exception as e:
+            log_err("WARNING! Can't write the profile report.", e)
+
+    def log(self):
+        from tabulate import tabulate
+        total = sum(s['time'] for s in self.stages.values())
+        rows = []
+        for name, s in sorted(self.report()['stages'].items(), key=lambda i: -i[1]['time']):
+            rows.append([
+                name, s['count'], round(s['time'], 3), round(s['time'] / total * 100, 1) if total > 0 else 0,
+                round(s['mean_time'] * 1000, 3),
+                None if s['mean_allocated'] is None else round(s['mean_allocated'] / 1024 ** 2, 2),
+            ])
+        log_info(tabulate(rows, ['stage', 'calls', 'total, s', '%', 'mean, ms', 'mean allocated, MiB']))
+
+    def finish(self):
+        """
+        Logs the table and writes the JSON report if the profiler is enabled.
+        """
+        if not self.enabled:
+            return
+        log_info("---")
+        self.log()
+        self.write()
+
+
+def create(profile=None):
+    """
+    Creates the profiler for the backtest.
+    :param profile: True/False, Profiler or None.
+        None means that the profiler is enabled by the environment variable QNT_PROFILE=1.
+        The sampling interval is set by QNT_PROFILE_SAMPLE (default 100),
+        the path of the JSON report by QNT_PROFILE_PATH (default backtest.profile.json).
+    :return: Profiler (disabled if the profiling is off)
+    """
+    if isinstance(profile, Profiler):
+        return profile
+    if profile is None:
+        profile = os.environ.get(PROFILE_ENV, "").lower() in ("1", "true", "yes")
+    return Profiler(bool(profile), int(os.environ.get(PROFILE_SAMPLE_ENV, 100)))
+
+
+disabled = Profiler(enabled=False)
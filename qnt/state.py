@@ -1,4 +1,5 @@
 import gzip, pickle
+import os
 
 from qnt.data import get_env
 from qnt.log import log_err, log_info
@@ -23,4 +24,67 @@ def read(path=None):
             return res
     except Exception as e:
         log_err("Can't load state.", e)
-        return None
\ No newline at end of file
+        return None
+
+
+class StateHistory:
+    """
+    Append-only on-disk sequence of states.
+    Every state is pickled and compressed separately (length-prefixed record),
+    so any item can be read without loading the others into memory.
+    """
+
+    def __init__(self, path, clear=True):
+        """
+        :param path: the file for the states
+        :param clear: if False, the existing records are kept and indexed
+        """
+        self.path = path
+        self.offsets = []
+        self.end = 0
+        if clear or not os.path.exists(path):
+            open(path, 'wb').close()
+            return
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                size = int.from_bytes(header, 'little')
+                self.offsets.append(self.end)
+                self.end += 8 + size
+                f.seek(self.end)
+
+    def append(self, state):
+        data = gzip.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL), compresslevel=1)
+        with open(self.path, 'r+b') as f:
+            f.seek(self.end)
+            f.write(len(data).to_bytes(8, 'little'))
+            f.write(data)
+            f.truncate()  # drops the records written after the last checkpoint
+        self.offsets.append(self.end)
+        self.end += 8 + len(data)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("state index out of range")
+        with open(self.path, 'rb') as f:
+            return self._read(f, self.offsets[i])
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            for offset in self.offsets[:]:
+                yield self._read(f, offset)
+
+    @staticmethod
+    def _read(f, offset):
+        f.seek(offset)
+        size = int.from_bytes(f.read(8), 'little')
+        return pickle.loads(gzip.decompress(f.read(size)))
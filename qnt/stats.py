@@ -2,6 +2,7 @@ from .data import f, ds, stocks_load_list, get_env, futures_load_list, stocks_lo
 from .data.common import track_event
 from .output import normalize as output_normalize
 from qnt.log import log_info, log_err
+import qnt.precision as qnprec
 import xarray as xr
 import numpy as np
 import pandas as pd
@@ -10,7 +11,9 @@ from urllib import request
 from tabulate import tabulate
 import numba
 import sys, os
-from qnt.output import normalize
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from qnt.output import normalize, SparseOutput
 
 EPS = 10 ** -7
 
@@ -28,6 +31,35 @@ def calc_slippage(data, period_days=14, fract=None, points_per_year=None):
     if points_per_year is None:
         points_per_year = calc_avg_points_per_year(data)
 
+    data = data.transpose(ds.FIELD, ds.TIME, ds.ASSET)
+    time_series = data.coords[ds.TIME].values
+    if np.any(time_series[1:] < time_series[:-1]):
+        data = data.isel({ds.TIME: np.argsort(time_series, kind='stable')})
+
+    points_per_day = calc_points_per_day(points_per_year)
+    daily_period = min(points_per_day, len(data.time))
+    atr_period = min(len(data.time), period_days * points_per_day)
+
+    close, high, low = [np.ascontiguousarray(data.sel({ds.FIELD: i}).values, np.float64)
+                        for i in (f.CLOSE, f.HIGH, f.LOW)]
+    atr = calc_atr_np(close, high, low, daily_period, atr_period)
+    return xr.DataArray(
+        atr * fract,
+        dims=[ds.TIME, ds.ASSET],
+        coords={ds.TIME: data.coords[ds.TIME], ds.ASSET: data.coords[ds.ASSET]}
+    )
+
+
+def calc_slippage_xr(data, period_days=14, fract=None, points_per_year=None):
+    """
+    calc_slippage built from xarray operations, the reference for calc_atr_np.
+    """
+    if fract is None:
+        fract = get_default_slippage(data)
+
+    if points_per_year is None:
+        points_per_year = calc_avg_points_per_year(data)
+
     time_series = np.sort(data.coords[ds.TIME])
     data = data.transpose(ds.FIELD, ds.TIME, ds.ASSET).loc[[f.CLOSE, f.HIGH, f.LOW], time_series, :]
 
@@ -48,6 +80,93 @@ def calc_slippage(data, period_days=14, fract=None, points_per_year=None):
     return dd * fract
 
 
+@numba.njit(error_model='numpy')
+def calc_atr_np(close, high, low, daily_period, atr_period):
+    """
+    The ATR of calc_slippage (time, asset) in one pass over the days.
+    The true range is the max of high - low, |high - prev close| and |prev close - low|
+    (see calc_true_range_nb), then the rolling mean of the true range is forward filled.
+    Like in the xarray version, the windows with NaN values give NaN.
+    """
+    n, assets = close.shape
+    atr = np.empty((n, assets))
+    deques = np.zeros((2, daily_period, assets), np.int64)  # the indices of high maximums and low minimums
+    deques_state = np.zeros((6, assets), np.int64)  # head, length of the deques and NaN counts of high and low
+    tr_ring = np.full((atr_period, assets), np.nan)
+    tr_sum = np.zeros(assets)
+    tr_count = np.zeros(assets, np.int64)
+    last = np.full(assets, np.nan)
+
+    for t in range(n):
+        pos = t % atr_period
+        for a in range(assets):
+            if daily_period == 1:
+                tr = np.nan
+                if t >= 1:
+                    hi = high[t, a]
+                    lo = low[t, a]
+                    cl = close[t - 1, a]
+                    if not (np.isnan(hi) or np.isnan(lo) or np.isnan(cl)):
+                        tr = max(hi - lo, abs(hi - cl), abs(cl - lo))
+            else:
+                tr = calc_true_range_nb(close, high, low, daily_period, t, a, deques, deques_state)
+
+            # rolling mean (like bottleneck.move_mean)
+            old = tr_ring[pos, a]
+            if not np.isnan(tr):
+                if not np.isnan(old):
+                    tr_sum[a] += tr - old
+                else:
+                    tr_sum[a] += tr
+                    tr_count[a] += 1
+            elif not np.isnan(old):
+                tr_sum[a] -= old
+                tr_count[a] -= 1
+            tr_ring[pos, a] = tr
+            if tr_count[a] >= atr_period:
+                last[a] = tr_sum[a] / tr_count[a]
+            atr[t, a] = last[a]
+    return atr
+
+
+@numba.njit
+def calc_true_range_nb(close, high, low, daily_period, t, a, deques, deques_state):
+    """
+    The true range of the day t for the asset a with the daily high and low of the last daily_period points.
+    The rolling max of high and min of low are calculated with the monotonic deques (ring buffers of indices),
+    the deques and their state are updated in place.
+    """
+    for d in range(2):
+        values = high if d == 0 else low
+        sign = 1 if d == 0 else -1
+        queue = deques[d]
+        head = deques_state[d * 3]
+        length = deques_state[d * 3 + 1]
+        nan_count = deques_state[d * 3 + 2]
+        while length[a] > 0 and queue[head[a], a] <= t - daily_period:
+            head[a] = (head[a] + 1) % daily_period
+            length[a] -= 1
+        v = values[t, a]
+        if np.isnan(v):
+            nan_count[a] += 1
+        else:
+            while length[a] > 0 and sign * values[queue[(head[a] + length[a] - 1) % daily_period, a], a] <= sign * v:
+                length[a] -= 1
+            queue[(head[a] + length[a]) % daily_period, a] = t
+            length[a] += 1
+        if t >= daily_period and np.isnan(values[t - daily_period, a]):
+            nan_count[a] -= 1
+
+    if t < daily_period or deques_state[2, a] > 0 or deques_state[5, a] > 0:
+        return np.nan
+    hi = high[deques[0, deques_state[0, a], a], a]
+    lo = low[deques[1, deques_state[3, a], a], a]
+    cl = close[t - daily_period, a]
+    if np.isnan(cl):
+        return np.nan
+    return max(hi - lo, abs(hi - cl), abs(cl - lo))
+
+
 def calc_relative_return(data, portfolio_history,
                          slippage_factor=None, roll_slippage_factor=None,
                          per_asset=False, points_per_year=None):
@@ -62,7 +181,10 @@ def calc_relative_return(data, portfolio_history,
     min_time = target_weights.coords[ds.TIME].min()
 
     slippage = calc_slippage(data, 14, slippage_factor, points_per_year=points_per_year)
-    roll_slippage = calc_slippage(data, 14, roll_slippage_factor, points_per_year=points_per_year)
+    if roll_slippage_factor == slippage_factor:
+        roll_slippage = slippage
+    else:
+        roll_slippage = calc_slippage(data, 14, roll_slippage_factor, points_per_year=points_per_year)
 
     data, target_weights, slippage, roll_slippage = arrange_data(data, target_weights, per_asset, slippage,
                                                                  roll_slippage)
@@ -114,122 +236,228 @@ def calc_relative_return(data, portfolio_history,
     # In `calc_relative_return_np_per_asset`, the algorithm freezes the share count and capital until a new price value emerges.
 
 
-@numba.njit
-def calc_relative_return_np_per_asset(WEIGHT, UNLOCKED, OPEN, CLOSE, SLIPPAGE, DIVS, ROLL, ROLL_SLIPPAGE):
-    shares_count = np.zeros(WEIGHT.shape)
+def calc_relative_return_batch(data, portfolio_histories,
+                               slippage_factor=None, roll_slippage_factor=None,
+                               points_per_year=None, workers=None):
+    """
+    calc_relative_return (per_asset=False) for many portfolios at once.
+    The market side (arrange_data, slippage, OPEN/CLOSE ffill, the masks of the tradeable assets) is prepared once,
+    then the relative returns of all portfolios are calculated by the numba kernel,
+    the blocks of the portfolios are processed in parallel threads.
+    :param data: xarray with historical data or PreparedMarket
+    :param portfolio_histories: xarray (K, time, asset), the first dimension (for example, strategy) enumerates
+                                the portfolios
+    :param workers: threads count, os.cpu_count() if None
+    :return: xarray (K, time) with the relative returns
+    """
+    market = prepare_market(data, points_per_year)
 
-    equity_before_buy = np.zeros(WEIGHT.shape)
-    equity_after_buy = np.zeros(WEIGHT.shape)
-    equity_tonight = np.zeros(WEIGHT.shape)
+    if slippage_factor is None:
+        slippage_factor = get_default_slippage(market)
 
-    for day in range(0, WEIGHT.shape[0]):
-        tradeable_assets = UNLOCKED[day]
+    if roll_slippage_factor is None:
+        roll_slippage_factor = get_default_slippage(market)
+
+    batch_dim = [d for d in portfolio_histories.dims if d not in (ds.TIME, ds.ASSET)]
+    if len(batch_dim) != 1 or len(portfolio_histories.dims) != 3:
+        raise ValueError("portfolio_histories must have the dimensions (K, time, asset)")
+    batch_dim = batch_dim[0]
+    portfolio_histories = portfolio_histories.transpose(batch_dim, ds.TIME, ds.ASSET)
+    ph_time = portfolio_histories.coords[ds.TIME].values
+    if np.any(ph_time[1:] <= ph_time[:-1]):
+        portfolio_histories = portfolio_histories.sortby(ds.TIME)
+        ph_time = portfolio_histories.coords[ds.TIME].values
+    PH = np.ascontiguousarray(portfolio_histories.values, market.dtype)
+
+    time = market.time
+
+    # the target weights are the previous rows of portfolio_history
+    ph_pos, ph_pos_found = market.align_time(ph_time)
+    ph_rows = np.where(ph_pos_found, ph_pos - 1, -1)
+    ph_columns = market.align_assets(portfolio_histories.coords[ds.ASSET].values)
+
+    RR = np.zeros((PH.shape[0], len(time)))
+
+    def calc_block(block):
+        calc_relative_return_batch_np(PH[block], ph_rows, ph_columns, market.UNLOCKED, market.OPEN, market.CLOSE,
+                                      market.slippage(slippage_factor), market.DIVS, market.ROLL,
+                                      market.roll_slippage(roll_slippage_factor), market.OPEN_RAW, market.PREV_CLOSE,
+                                      RR[block])
+
+    map_blocks(calc_block, PH.shape[0], workers)
+
+    RR = xr.DataArray(
+        RR,
+        dims=[batch_dim, ds.TIME],
+        coords={batch_dim: portfolio_histories.coords[batch_dim].values, ds.TIME: time}
+    )
+    if len(ph_time) == 0:
+        return RR.isel({ds.TIME: slice(0, 0)})
+    return RR.loc[:, ph_time[0]:]
 
-        if day == 0:
-            equity_before_buy[0] = 1
-            shares_count[0] = 0
-        else:
-            shares_count[day] = shares_count[day - 1]
-            equity_before_buy[day] = equity_after_buy[day - 1] + (OPEN[day] - OPEN[day - 1] + DIVS[day]) * shares_count[
-                day]
-
-        shares_count[day][tradeable_assets] = equity_before_buy[day][tradeable_assets] * WEIGHT[day][tradeable_assets] / \
-                                              OPEN[day][tradeable_assets]
-        dN = shares_count[day]
-        if day > 0:
-            dN = dN - shares_count[day - 1]
-        step_slippage = SLIPPAGE[day] * np.abs(dN)
-        equity_after_buy[day] = equity_before_buy[day] - step_slippage
-
-        if ROLL is not None and day > 0:
-            partial_shares = np.where(np.sign(shares_count[day]) == np.sign(shares_count[day - 1]),
-                                      np.minimum(np.abs(shares_count[day]), np.abs(shares_count[day - 1])), 0)
-            roll_costs = np.sign(shares_count[day]) * partial_shares * ROLL[day] + partial_shares * ROLL_SLIPPAGE[day]
-            equity_after_buy[day] -= roll_costs
-
-        equity_tonight[day] = equity_after_buy[day] + (CLOSE[day] - OPEN[day]) * shares_count[day]
 
-        non_tradeable_assets = np.logical_not(tradeable_assets)
-        if day == 0:
-            equity_before_buy[0][non_tradeable_assets] = 1
-            equity_after_buy[0][non_tradeable_assets] = 1
-            equity_tonight[0][non_tradeable_assets] = 1
-            shares_count[0][non_tradeable_assets] = 0
+@numba.njit
+def calc_relative_return_np_per_asset(WEIGHT, UNLOCKED, OPEN, CLOSE, SLIPPAGE, DIVS, ROLL, ROLL_SLIPPAGE):
+    RR = np.zeros(WEIGHT.shape)
+    for a in range(WEIGHT.shape[1]):
+        if ROLL is None:
+            calc_relative_return_asset_nb(WEIGHT[:, a], UNLOCKED[:, a], OPEN[:, a], CLOSE[:, a], SLIPPAGE[:, a],
+                                          DIVS[:, a], None, None, RR[:, a])
         else:
-            shares_count[day][non_tradeable_assets] = shares_count[day - 1][non_tradeable_assets]
-            equity_after_buy[day][non_tradeable_assets] = equity_after_buy[day - 1][non_tradeable_assets]
-            equity_before_buy[day][non_tradeable_assets] = equity_before_buy[day - 1][non_tradeable_assets]
-            equity_tonight[day][non_tradeable_assets] = equity_tonight[day - 1][non_tradeable_assets]
-
-    E = equity_tonight
-    Ep = E.copy()
-    for i in range(1, Ep.shape[0]):
-        Ep[i] = E[i - 1]
-    Ep[0] = 1
-    RR = E / Ep - 1
-    RR = np.where(np.isfinite(RR), RR, 0)
+            calc_relative_return_asset_nb(WEIGHT[:, a], UNLOCKED[:, a], OPEN[:, a], CLOSE[:, a], SLIPPAGE[:, a],
+                                          DIVS[:, a], ROLL[:, a], ROLL_SLIPPAGE[:, a], RR[:, a])
     return RR
 
 
+@numba.njit
+def calc_relative_return_asset_nb(WEIGHT, UNLOCKED, OPEN, CLOSE, SLIPPAGE, DIVS, ROLL, ROLL_SLIPPAGE, RR):
+    """
+    calc_relative_return_np_per_asset for one asset, the arguments are the columns of the arrays (time).
+    The relative return is written to RR.
+    """
+    shares_count = 0.
+    equity_after_buy = 1.
+    equity_tonight = 1.
+
+    for day in range(len(WEIGHT)):
+        prev_equity_tonight = equity_tonight
+        # the non-tradeable asset freezes the share count and the equity until a new price value emerges
+        if UNLOCKED[day]:
+            prev_shares_count = shares_count
+            if day == 0:
+                equity_before_buy = 1.
+            else:
+                equity_before_buy = equity_after_buy + (OPEN[day] - OPEN[day - 1] + DIVS[day]) * shares_count
+
+            shares_count = equity_before_buy * WEIGHT[day] / OPEN[day]
+            dN = shares_count
+            if day > 0:
+                dN = dN - prev_shares_count
+            equity_after_buy = equity_before_buy - SLIPPAGE[day] * np.abs(dN)
+
+            if ROLL is not None and day > 0:
+                partial_shares = 0.
+                if np.sign(shares_count) == np.sign(prev_shares_count):
+                    partial_shares = min(abs(shares_count), abs(prev_shares_count))
+                roll_costs = np.sign(shares_count) * partial_shares * ROLL[day] + partial_shares * ROLL_SLIPPAGE[day]
+                equity_after_buy -= roll_costs
+
+            equity_tonight = equity_after_buy + (CLOSE[day] - OPEN[day]) * shares_count
+
+        RR[day] = equity_tonight / prev_equity_tonight - 1
+        if not np.isfinite(RR[day]):
+            RR[day] = 0
+
+
 @numba.njit
 def calc_relative_return_np(WEIGHT, UNLOCKED, OPEN, CLOSE, SLIPPAGE, DIVS, ROLL, ROLL_SLIPPAGE):
-    shares_count = np.zeros(WEIGHT.shape)
+    shares_count = np.zeros(WEIGHT.shape[1])
+    prev_open = np.zeros(WEIGHT.shape[1])
+    equity = np.zeros(3)
+    return calc_relative_return_online_np(WEIGHT, UNLOCKED, OPEN, CLOSE, SLIPPAGE, DIVS, ROLL, ROLL_SLIPPAGE,
+                                          shares_count, prev_open, equity)
+
 
-    equity_before_buy = np.zeros(WEIGHT.shape[0])
-    equity_operable_before_buy = np.zeros(WEIGHT.shape[0])
-    equity_after_buy = np.zeros(WEIGHT.shape[0])
-    equity_tonight = np.zeros(WEIGHT.shape[0])
+@numba.njit
+def calc_relative_return_online_np(WEIGHT, UNLOCKED, OPEN, CLOSE, SLIPPAGE, DIVS, ROLL, ROLL_SLIPPAGE,
+                                   shares_count, prev_open, equity):
+    """
+    The kernel of calc_relative_return_np which continues the calculation from the state of the previous day.
+    The state is updated in place:
+        shares_count - the shares count after the previous day,
+        prev_open - OPEN of the previous day,
+        equity - [the number of the processed days, equity after buy, equity tonight].
+    """
+    RR = np.zeros(WEIGHT.shape[0])
 
-    for day in range(WEIGHT.shape[0]):
-        tradeable_assets = UNLOCKED[day]
+    for i in range(WEIGHT.shape[0]):
+        tradeable_assets = UNLOCKED[i]
         non_tradeable_assets = np.logical_not(tradeable_assets)
+        first_day = equity[0] == 0
+        prev_shares_count = shares_count.copy()
 
-        if day == 0:
-            equity_before_buy[0] = 1
-            shares_count[0] = 0
+        if first_day:
+            equity_before_buy = 1.
+            shares_count[:] = 0
         else:
-            shares_count[day] = shares_count[day - 1]
-            equity_before_buy[day] = equity_after_buy[day - 1] + np.nansum(
-                (OPEN[day] - OPEN[day - 1] + DIVS[day]) * shares_count[day])
+            equity_before_buy = equity[1] + np.nansum((OPEN[i] - prev_open + DIVS[i]) * shares_count)
 
-        w_sum = np.nansum(np.abs(WEIGHT[day]))
+        w_sum = np.nansum(np.abs(WEIGHT[i]))
         w_free_cash = max(1, w_sum) - w_sum
-        w_unlocked = np.nansum(np.abs(WEIGHT[day][tradeable_assets]))
+        w_unlocked = np.nansum(np.abs(WEIGHT[i][tradeable_assets]))
         w_operable = w_unlocked + w_free_cash
 
-        equity_operable_before_buy[day] = equity_before_buy[day] - np.nansum(
-            OPEN[day][non_tradeable_assets] * np.abs(shares_count[day][non_tradeable_assets]))
+        equity_operable_before_buy = equity_before_buy - np.nansum(
+            OPEN[i][non_tradeable_assets] * np.abs(shares_count[non_tradeable_assets]))
 
         if w_operable < EPS:
-            equity_after_buy[day] = equity_before_buy[day]
+            equity_after_buy = equity_before_buy
         else:
-            shares_count[day][tradeable_assets] = equity_operable_before_buy[day] * WEIGHT[day][tradeable_assets] / (
-                    w_operable * OPEN[day][tradeable_assets])
-            dN = shares_count[day][tradeable_assets]
-            if day > 0:
-                dN = dN - shares_count[day - 1][tradeable_assets]
-            step_slippage = np.nansum(SLIPPAGE[day][tradeable_assets] * np.abs(dN))
-            equity_after_buy[day] = equity_before_buy[day] - step_slippage
+            shares_count[tradeable_assets] = equity_operable_before_buy * WEIGHT[i][tradeable_assets] / (
+                    w_operable * OPEN[i][tradeable_assets])
+            dN = shares_count[tradeable_assets]
+            if not first_day:
+                dN = dN - prev_shares_count[tradeable_assets]
+            step_slippage = np.nansum(SLIPPAGE[i][tradeable_assets] * np.abs(dN))
+            equity_after_buy = equity_before_buy - step_slippage
+
+        if ROLL is not None and not first_day:
+            partial_shares = np.where(np.sign(shares_count) == np.sign(prev_shares_count),
+                                      np.minimum(np.abs(shares_count), np.abs(prev_shares_count)), 0)
+            roll_costs = np.sign(shares_count) * partial_shares * ROLL[i] + partial_shares * ROLL_SLIPPAGE[i]
+            equity_after_buy -= np.nansum(roll_costs)
+
+        equity_tonight = equity_after_buy + np.nansum((CLOSE[i] - OPEN[i]) * shares_count)
 
-        if ROLL is not None and day > 0:
-            partial_shares = np.where(np.sign(shares_count[day]) == np.sign(shares_count[day - 1]),
-                                      np.minimum(np.abs(shares_count[day]), np.abs(shares_count[day - 1])), 0)
-            roll_costs = np.sign(shares_count[day]) * partial_shares * ROLL[day] + partial_shares * ROLL_SLIPPAGE[day]
-            equity_after_buy[day] -= np.nansum(roll_costs)
+        # Set shares count to 0 for assets without a price. Reasons: company could've ceased to exist, been acquired, or there's a provider error
+        shares_count[non_tradeable_assets] = 0
 
-        equity_tonight[day] = equity_after_buy[day] + np.nansum((CLOSE[day] - OPEN[day]) * shares_count[day])
+        RR[i] = equity_tonight / (1. if first_day else equity[2]) - 1
+        if not np.isfinite(RR[i]):
+            RR[i] = 0
 
-        # Set shares count to 0 for assets without a price. Reasons: company could've ceased to exist, been acquired, or there's a provider error
-        shares_count[day][non_tradeable_assets] = 0
+        prev_open[:] = OPEN[i]
+        equity[0] += 1
+        equity[1] = equity_after_buy
+        equity[2] = equity_tonight
 
-    E = equity_tonight
-    Ep = np.roll(E, 1)
-    Ep[0] = 1
-    RR = E / Ep - 1
-    RR = np.where(np.isfinite(RR), RR, 0)
     return RR
 
 
+@numba.njit(nogil=True, error_model='numpy')
+def calc_relative_return_batch_np(PH, ph_rows, ph_columns, UNLOCKED, OPEN, CLOSE, SLIPPAGE, DIVS, ROLL, ROLL_SLIPPAGE,
+                                  OPEN_RAW, PREV_CLOSE, RR):
+    """
+    The kernel of calc_relative_return_batch, the weights are arranged row by row.
+    :param PH: the portfolio weights (K, portfolio_history time, portfolio_history asset)
+    :param ph_rows: the row of PH with the target weights for every day, -1 means no weights
+    :param ph_columns: the column of PH for every asset, -1 means no weights
+    :param RR: the relative returns (K, time), written in place
+    """
+    n, assets = OPEN.shape
+    W = np.empty((1, assets))
+    for k in range(PH.shape[0]):
+        shares_count = np.zeros(assets)
+        prev_open = np.zeros(assets)
+        equity = np.zeros(3)
+        for i in range(n):
+            for a in range(assets):
+                W[0, a] = PH[k, ph_rows[i], ph_columns[a]] if ph_rows[i] >= 0 and ph_columns[a] >= 0 else np.nan
+            normalize_np(W)
+            for a in range(assets):
+                W[0, a] = W[0, a] * OPEN_RAW[i, a] / PREV_CLOSE[i, a]
+            normalize_np(W)
+            if ROLL is None:
+                rr = calc_relative_return_online_np(W, UNLOCKED[i:i + 1], OPEN[i:i + 1], CLOSE[i:i + 1],
+                                                    SLIPPAGE[i:i + 1], DIVS[i:i + 1], None, None,
+                                                    shares_count, prev_open, equity)
+            else:
+                rr = calc_relative_return_online_np(W, UNLOCKED[i:i + 1], OPEN[i:i + 1], CLOSE[i:i + 1],
+                                                    SLIPPAGE[i:i + 1], DIVS[i:i + 1], ROLL[i:i + 1],
+                                                    ROLL_SLIPPAGE[i:i + 1], shares_count, prev_open, equity)
+            RR[k, i] = rr[0]
+
+
 def arrange_data(data, target_weights, per_asset, *additional_series):
     """
     arranges data for proper calculations
@@ -341,6 +569,132 @@ def calc_sharpe_ratio_annualized(relative_return, max_periods=None, min_periods=
     return sr
 
 
+def calc_sharpe_ratio_bootstrap(relative_return, samples=10000, block_size=None, points_per_year=None, seed=None,
+                                workers=None):
+    """
+    The distribution of the annualized Sharpe ratio of the whole period estimated with the stationary block
+    bootstrap (Politis & Romano): the resamples consist of the blocks of consecutive days with the random starts
+    and the geometrically distributed lengths (the mean length is block_size), the series is wrapped around.
+
+    The resamples are generated as the index matrices (sample, time) by the blocks of samples,
+    the Sharpe ratios are calculated by the numba kernel, the blocks are processed in parallel threads.
+    All assets are resampled with the same days, so the correlations between the assets are kept.
+    :param relative_return: daily return (time) or (time, asset)
+    :param samples: the number of resamples
+    :param block_size: the mean length of the blocks, len(time) ** (1/3) if None
+    :param seed: the seed of the random generator, the result doesn't depend on workers
+    :param workers: threads count, os.cpu_count() if None
+    :return: annualized Sharpe ratios (sample) or (sample, asset)
+    """
+    if points_per_year is None:
+        points_per_year = calc_avg_points_per_year(relative_return)
+    dims = [ds.TIME] + [d for d in relative_return.dims if d != ds.TIME]
+    if len(dims) > 2:
+        raise ValueError("relative_return must have the dimensions (time) or (time, asset)")
+    relative_return = relative_return.transpose(*dims)
+    RR = np.array(relative_return.values, dtype=np.float64).reshape(len(relative_return.coords[ds.TIME]), -1)
+    RR = RR[np.logical_not(np.isnan(RR).all(axis=1))]
+    n = len(RR)
+    if block_size is None:
+        block_size = max(1, round(n ** (1. / 3)))
+    LOG_RR = np.log(RR + 1)
+
+    SR = np.full((samples, RR.shape[1]), np.nan)
+    # the chunks of 256 resamples have the own random generators
+    chunk_size = 256
+    chunks = -(-samples // chunk_size)
+    seeds = np.random.SeedSequence(seed).spawn(chunks)
+
+    def calc_block(block):
+        for j in range(block.start, min(block.stop, chunks)):
+            i = j * chunk_size
+            count = min(chunk_size, samples - i)
+            idx = calc_stationary_bootstrap_indices(np.random.default_rng(seeds[j]), count, n, block_size)
+            calc_sharpe_ratio_bootstrap_nb(RR, LOG_RR, idx, float(points_per_year), SR[i:i + count])
+
+    if n > 0:
+        map_blocks(calc_block, chunks, workers)
+
+    coords = {'sample': np.arange(samples)}
+    if len(dims) > 1:
+        coords[dims[1]] = relative_return.coords[dims[1]].values
+    return xr.DataArray(SR if len(dims) > 1 else SR[:, 0], dims=['sample'] + dims[1:], coords=coords)
+
+
+def calc_sharpe_ratio_confidence(relative_return, quantiles=(0.025, 0.05, 0.5, 0.95, 0.975), benchmark=0,
+                                 samples=10000, block_size=None, points_per_year=None, seed=None, workers=None):
+    """
+    Summary of calc_sharpe_ratio_bootstrap.
+    :param quantiles: the quantiles of the bootstrapped Sharpe ratio
+    :param benchmark: the annualized Sharpe ratio for the probabilistic Sharpe ratio
+    :return: xarray (field) or (field, asset): sharpe_ratio (the point estimate), mean and std of the bootstrapped
+             Sharpe ratio, the quantiles (the fields are the quantile values) and probabilistic_sharpe_ratio,
+             the share of the resamples with the Sharpe ratio above the benchmark
+    """
+    if points_per_year is None:
+        points_per_year = calc_avg_points_per_year(relative_return)
+    SR = calc_sharpe_ratio_bootstrap(relative_return, samples, block_size, points_per_year, seed, workers)
+    point = calc_sharpe_ratio_annualized(relative_return, points_per_year=points_per_year).isel({ds.TIME: -1}) \
+        .drop_vars(ds.TIME)
+    with np.errstate(invalid='ignore'):
+        psr = (SR > benchmark).sum('sample') / SR.notnull().sum('sample')
+    result = [point, SR.mean('sample'), SR.std('sample')] + \
+             [SR.quantile(q, 'sample').drop_vars('quantile') for q in quantiles] + [psr]
+    return xr.concat(result, pd.Index(
+        [stf.SHARPE_RATIO, 'mean', 'std'] + list(quantiles) + ['probabilistic_sharpe_ratio'],
+        name=ds.FIELD, dtype=object
+    ))
+
+
+def calc_stationary_bootstrap_indices(rng, samples, n, block_size):
+    """
+    :return: the index matrix (sample, time) of the stationary block bootstrap
+    """
+    t = np.arange(n)
+    new_block = rng.random((samples, n)) < 1. / block_size
+    new_block[:, 0] = True
+    block_start = np.maximum.accumulate(np.where(new_block, t, 0), axis=1)
+    starts = rng.integers(0, n, (samples, n))
+    idx = np.take_along_axis(starts, block_start, axis=1)
+    idx += t - block_start
+    idx %= n
+    return idx
+
+
+@numba.njit(nogil=True, error_model='numpy')
+def calc_sharpe_ratio_bootstrap_nb(RR, LOG_RR, idx, points_per_year, SR):
+    """
+    The annualized Sharpe ratios (the same as calc_sharpe_ratio_annualized of the whole period) of the resamples.
+    :param RR: relative returns (time, asset)
+    :param LOG_RR: log(RR + 1)
+    :param idx: the index matrix (sample, time)
+    :param SR: the result (sample, asset)
+    """
+    assets = RR.shape[1]
+    for k in range(idx.shape[0]):
+        mean = np.zeros(assets)
+        m2 = np.zeros(assets)  # the sum of the squared deviations from the mean (Welford's method)
+        ls = np.zeros(assets)
+        c = np.zeros(assets)
+        for i in range(idx.shape[1]):
+            t = idx[k, i]
+            for a in range(assets):
+                r = RR[t, a]
+                if not np.isnan(r):
+                    c[a] += 1
+                    delta = r - mean[a]
+                    mean[a] += delta / c[a]
+                    m2[a] += delta * (r - mean[a])
+                    ls[a] += LOG_RR[t, a]
+        for a in range(assets):
+            if c[a] < 2:
+                SR[k, a] = np.nan
+                continue
+            volatility = np.sqrt(m2[a] / c[a]) * pow(points_per_year, 1. / 2)
+            mean_return = np.exp(ls[a] / c[a]) - 1
+            SR[k, a] = (np.power(mean_return + 1, points_per_year) - 1) / volatility
+
+
 def calc_mean_return(relative_return, max_periods=None, min_periods=1, points_per_year=None):
     """
     :param relative_return: daily return
@@ -515,18 +869,34 @@ def calc_avg_holding_time(portfolio_history,
 
 @numba.njit
 def calc_holding_log_np_nb(weights: np.ndarray) -> np.ndarray:  # , equity: np.ndarray, open: np.ndarray) -> np.ndarray:
-    prev_pos = np.zeros(weights.shape[1])
-    holding_time = np.zeros(weights.shape[1])  # position holding time
     holding_log = np.zeros(weights.shape[0] * 2 * weights.shape[1])  # time, field (position_cost, holding_time), asset
     holding_log = holding_log.reshape(weights.shape[0], 2, weights.shape[1])
+    if weights.shape[0] > 1:
+        prev_pos = np.zeros(weights.shape[1])
+        holding_time = np.zeros(weights.shape[1])  # position holding time
+        holding_log[1:] = calc_holding_log_online_np_nb(weights[:-1], prev_pos, holding_time)
+    return holding_log
+
 
-    for t in range(1, weights.shape[0]):
+@numba.njit
+def calc_holding_log_online_np_nb(positions: np.ndarray, prev_pos: np.ndarray, holding_time: np.ndarray) -> np.ndarray:
+    """
+    The kernel of calc_holding_log_np_nb which continues the calculation from the state of the previous day.
+    :param positions: the weights of the previous day for every day
+    :param prev_pos: the last changed positions, updated in place
+    :param holding_time: the position holding time, updated in place
+    :return: holding log (time, field (position_cost, holding_time), asset)
+    """
+    holding_log = np.zeros(positions.shape[0] * 2 * positions.shape[1])
+    holding_log = holding_log.reshape(positions.shape[0], 2, positions.shape[1])
+
+    for t in range(positions.shape[0]):
         holding_time[:] += 1
-        for a in range(weights.shape[1]):
+        for a in range(positions.shape[1]):
             # price = open[t][a]
             # if not np.isfinite(price):
             #     continue
-            pos = weights[t - 1][a]  # * equity[t] / price
+            pos = positions[t][a]  # * equity[t] / price
             ppos = prev_pos[a]
             if not np.isfinite(pos):
                 continue
@@ -560,7 +930,7 @@ def calc_non_liquid(data, portfolio_history):
 
 
 def find_missed_dates(output, data):
-    out_ts = np.sort(output.coords[ds.TIME].values)
+    out_ts = np.sort(output.time_coord if isinstance(output, SparseOutput) else output.coords[ds.TIME].values)
 
     min_out_ts = min(out_ts)
 
@@ -676,22 +1046,307 @@ class StatFields:
 stf = StatFields
 
 
+class PreparedMarket:
+    """
+    The market side of the statistics prepared once: arrange_data (the assets and the days without data are dropped,
+    the time and the assets are sorted), the contiguous arrays (time, asset) of the prices and the slippage.
+
+    It can be passed instead of data to calc_stat, calc_stat_per_asset and calc_relative_return_batch,
+    so the calls which share the same data share the preparation:
+
+        market = PreparedMarket(data)
+        stats = [calc_stat(market, output) for output in outputs]
+
+    The arrays are copies, so the later changes of data don't affect the prepared market.
+    The arrays (time, asset) are stored with qnt.precision.get_dtype() of the moment of the preparation.
+    """
+
+    def __init__(self, data, points_per_year=None, assets=None, atr=None, last_open=None, last_close=None):
+        """
+        :param data: xarray with historical data
+        :param points_per_year: calculated from data if None, it is used for the slippage
+        :param assets: the fixed assets (used instead of the assets with data)
+        :param atr: the slippage without the factor for the days of data, calculated if None
+        :param last_open: OPEN of the day before data for the forward fill
+        :param last_close: CLOSE of the day before data for the forward fill
+        """
+        if points_per_year is None:
+            points_per_year = calc_avg_points_per_year(data)
+        self.name = data.name
+        self.points_per_year = points_per_year
+        self.dtype = dtype = qnprec.get_dtype()
+        fixed_assets = assets is not None
+
+        data = data.transpose(ds.FIELD, ds.TIME, ds.ASSET)
+        time = data.coords[ds.TIME].values
+        if np.any(time[1:] <= time[:-1]):
+            data = data.sortby(ds.TIME)
+        if assets is None:
+            if np.any(data.coords[ds.ASSET].values[1:] < data.coords[ds.ASSET].values[:-1]):
+                data = data.isel({ds.ASSET: np.argsort(data.coords[ds.ASSET].values, kind='stable')})
+        elif not np.array_equal(data.coords[ds.ASSET].values, assets):
+            data = data.reindex({ds.ASSET: assets})
+        self.data = data
+
+        if atr is None:
+            atr = calc_slippage(data, 14, 1, points_per_year=points_per_year).values
+        values = data.values
+        time = data.coords[ds.TIME].values
+        assets = data.coords[ds.ASSET].values
+
+        # arrange_data
+        is_nan = np.isnan(values)
+        assets_mask = np.full(len(assets), True) if fixed_assets else np.logical_not(is_nan.all(axis=(0, 1)))
+        time_mask = np.logical_not(is_nan[:, :, assets_mask].all(axis=(0, 2)))
+        del is_nan
+        if not time_mask.all():
+            values = values[:, time_mask]
+            atr = atr[time_mask]
+            time = time[time_mask]
+        if not assets_mask.all():
+            values = values[:, :, assets_mask]
+            atr = atr[:, assets_mask]
+            assets = assets[assets_mask]
+        self.time = time
+        self.assets = assets
+        self.fields = data.coords[ds.FIELD].values.tolist()
+
+        def field(name):
+            return np.ascontiguousarray(values[self.fields.index(name)], dtype)
+
+        self.OPEN_RAW = field(f.OPEN)
+        self.CLOSE_RAW = field(f.CLOSE)
+        empty_row = np.full(len(assets), np.nan)
+        OPEN = ffill_np(empty_row if last_open is None else last_open, self.OPEN_RAW)
+        CLOSE = ffill_np(empty_row if last_close is None else last_close, self.CLOSE_RAW)
+        self.PREV_CLOSE = np.concatenate([(empty_row if last_close is None else last_close)[np.newaxis], CLOSE[:-1]])
+        self.PREV_CLOSE = self.PREV_CLOSE.astype(dtype, copy=False)
+        self.last_open = OPEN[-1].astype(np.float64) if len(time) > 0 else last_open
+        self.last_close = CLOSE[-1].astype(np.float64) if len(time) > 0 else last_close
+        self.OPEN = np.where(np.isnan(OPEN), 0, OPEN)
+        self.CLOSE = np.where(np.isnan(CLOSE), 0, CLOSE)
+        del OPEN, CLOSE
+
+        self.DIVS = np.where(np.isnan(field(f.DIVS)), 0, field(f.DIVS)) if f.DIVS in self.fields \
+            else np.zeros(self.OPEN.shape, dtype)
+        self.ROLL = np.where(np.isnan(field(f.ROLL)), 0, field(f.ROLL)) if f.ROLL in self.fields else None
+        self.IS_LIQUID = field(f.IS_LIQUID) if f.IS_LIQUID in self.fields else None
+        self.atr = np.ascontiguousarray(atr, dtype)
+
+        # the assets available for trading (the normalized weights are always finite)
+        self.UNLOCKED = np.logical_and(np.isfinite(self.OPEN_RAW), np.isfinite(self.CLOSE_RAW))
+        self.UNLOCKED = np.logical_and(np.isfinite(self.atr), self.UNLOCKED)
+        self.UNLOCKED = np.logical_and(self.OPEN > EPS, self.UNLOCKED)
+
+        liquid = self.CLOSE_RAW if self.IS_LIQUID is None else self.IS_LIQUID
+        self.liquid_time = time[(liquid > 0).any(axis=1)]
+        self.slippages = dict()
+
+    def slippage(self, slippage_factor):
+        """
+        :return: calc_slippage with the factor (time, asset)
+        """
+        key = ('slippage', slippage_factor)
+        if key not in self.slippages:
+            self.slippages[key] = np.ascontiguousarray(self.atr * slippage_factor)
+        return self.slippages[key]
+
+    def roll_slippage(self, roll_slippage_factor):
+        """
+        :return: the slippage for the contract roll (time, asset), zero for the days without the roll or None
+        """
+        if self.ROLL is None:
+            return None
+        key = ('roll', roll_slippage_factor)
+        if key not in self.slippages:
+            roll_slippage = np.where(self.ROLL != 0, self.atr * roll_slippage_factor, np.nan)
+            self.slippages[key] = np.ascontiguousarray(np.where(np.isnan(roll_slippage), 0, roll_slippage))
+        return self.slippages[key]
+
+    def check_missed_dates(self, ph_time):
+        """
+        find_missed_dates for portfolio_history with the time ph_time
+        """
+        if len(ph_time) == 0:
+            return
+        liquid_time = self.liquid_time[self.liquid_time >= ph_time.min()]
+        if not np.isin(liquid_time, ph_time).all():
+            log_err("WARNING: some dates are missed in the portfolio_history")
+
+    def check_non_liquid(self, positions):
+        """
+        calc_non_liquid for the arranged positions (time, asset)
+        """
+        if self.IS_LIQUID is not None and np.logical_and(self.IS_LIQUID == 0, positions != 0).any():
+            log_err("WARNING: Strategy trades non-liquid assets.")
+
+    def align_time(self, ph_time):
+        """
+        :param ph_time: the sorted time of portfolio_history
+        :return: the rows of portfolio_history for the days of the market and the mask of the found days
+        """
+        ph_pos = np.searchsorted(ph_time, self.time)
+        ph_pos_found = ph_pos < len(ph_time)
+        ph_pos_found[ph_pos_found] = ph_time[ph_pos[ph_pos_found]] == self.time[ph_pos_found]
+        return ph_pos, ph_pos_found
+
+    def align_assets(self, ph_assets):
+        """
+        :return: the columns of portfolio_history for the assets of the market, -1 for the missed assets
+        """
+        asset_idx = dict((a, i) for i, a in enumerate(ph_assets))
+        return np.array([asset_idx.get(a, -1) for a in self.assets], dtype=np.int64)
+
+
+def prepare_market(data, points_per_year=None):
+    """
+    :return: PreparedMarket for data (data itself if it is PreparedMarket)
+    """
+    if isinstance(data, PreparedMarket):
+        if points_per_year is not None and points_per_year != data.points_per_year:
+            raise ValueError("points_per_year differs from points_per_year of the prepared market")
+        return data
+    return PreparedMarket(data, points_per_year)
+
+
 def calc_stat(data, portfolio_history,
               slippage_factor=None, roll_slippage_factor=None,
               min_periods=1, max_periods=None,
-              per_asset=False, points_per_year=None):
+              per_asset=False, points_per_year=None, windows=None):
     """
-    :param data: xarray with historical data, data must be split adjusted
-    :param portfolio_history: portfolio weights set for every day
+    :param data: xarray with historical data, data must be split adjusted.
+                 PreparedMarket may be passed instead, then the calls with the same data share the preparation.
+    :param portfolio_history: portfolio weights set for every day (xarray or qnt.output.SparseOutput),
+                              SparseOutput is converted to the dense (time, asset) weights aligned with data
     :param slippage_factor: slippage
     :param roll_slippage_factor: slippage for contract roll
     :param min_periods: minimal number of days
     :param max_periods: max number of days for rolling
     :param per_asset: calculate stats per asset
+    :param windows: the list of max_periods (None means the whole history), see calc_stat_windows
     :return: xarray with all statistics
     """
     track_event("CALC_STAT")
 
+    if windows is not None:
+        return calc_stat_windows(data, portfolio_history, windows, slippage_factor, roll_slippage_factor,
+                                 min_periods, per_asset, points_per_year)
+
+    if per_asset:
+        return calc_stat_per_asset(data, portfolio_history, slippage_factor, roll_slippage_factor,
+                                   min_periods, max_periods, points_per_year)
+
+    # the fused engine
+    stat = IncrementalStat(slippage_factor, roll_slippage_factor, min_periods, max_periods, points_per_year)
+    return stat.update(data, portfolio_history)
+
+
+def calc_stat_windows(data, portfolio_history, windows,
+                      slippage_factor=None, roll_slippage_factor=None,
+                      min_periods=1, per_asset=False, points_per_year=None):
+    """
+    calc_stat for several max_periods at once, for example, windows=[251, 753, 1255, None] for 1, 3, 5 years
+    and the whole history. The relative returns, the turnover and the holding log are calculated once,
+    the rolling statistics of every window are calculated from them with the prefix sums.
+    per_asset statistics are calculated by calc_stat_per_asset for every window with the shared PreparedMarket.
+    :param windows: the list of max_periods, None means the whole history
+    :return: xarray with all statistics and the additional dimension window
+    """
+    windows = list(windows)
+    market = prepare_market(data, points_per_year)
+
+    if per_asset:
+        stats = [calc_stat_per_asset(market, portfolio_history, slippage_factor, roll_slippage_factor,
+                                     min_periods, w) for w in windows]
+        return xr.concat(stats, pd.Index(windows, name='window', dtype=object))
+
+    engine = IncrementalStat(slippage_factor, roll_slippage_factor, min_periods, None)
+    stat = engine.update(market, portfolio_history)
+    if stat is None:
+        return None
+    daily = engine.daily
+    points_per_year = float(market.points_per_year)
+
+    stats = []
+    for w in windows:
+        if w is None:
+            stats.append(stat)
+            continue
+        mp = min(min_periods, w)
+        res = stat.copy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            _, m2, c = calc_rolling_sums_np(daily['relative_return'], w)
+            V = np.sqrt(m2 / c) * pow(points_per_year, 1. / 2)
+            V = np.where(c >= mp, V, np.nan)
+            s, _, c = calc_rolling_sums_np(np.log(daily['relative_return'] + 1), w)
+            mean_return = np.exp(s / c) - 1
+            MR = np.where(c >= mp, np.power(mean_return + 1, points_per_year) - 1, np.nan)
+            SR = MR / V
+            s, _, c = calc_rolling_sums_np(daily['turnover'], w)
+            T = np.where(np.logical_and(np.isfinite(daily['turnover']), c >= mp), s / c, np.nan)
+            s, _, c = calc_rolling_sums_np(daily['holding_cost_time'], w)
+            s2, _, c2 = calc_rolling_sums_np(daily['holding_cost'], w)
+            HT = np.where(c >= mp, s, np.nan) / np.where(c2 >= mp, s2, np.nan) / engine.points_per_day
+        res.loc[:, stf.VOLATILITY] = V
+        res.loc[:, stf.MEAN_RETURN] = MR
+        res.loc[:, stf.SHARPE_RATIO] = SR
+        res.loc[:, stf.AVG_TURNOVER] = T
+        res.loc[:, stf.AVG_HOLDINGTIME] = HT
+        stats.append(res)
+    return xr.concat(stats, pd.Index(windows, name='window', dtype=object))
+
+
+def calc_stat_batch(data, portfolio_histories,
+                    slippage_factor=None, roll_slippage_factor=None,
+                    min_periods=1, max_periods=None,
+                    points_per_year=None, workers=None):
+    """
+    calc_stat (per_asset=False) for many portfolios at once.
+    The market side is prepared once (PreparedMarket, the slippage arrays), then the portfolios are calculated
+    by the fused engine in parallel threads.
+    :param data: xarray with historical data or PreparedMarket
+    :param portfolio_histories: xarray (K, time, asset), the first dimension (for example, strategy) enumerates
+                                the portfolios
+    :param workers: threads count, os.cpu_count() if None
+    :return: xarray (K, time, field) with the statistics
+    """
+    market = prepare_market(data, points_per_year)
+
+    if slippage_factor is None:
+        slippage_factor = get_default_slippage(market)
+
+    if roll_slippage_factor is None:
+        roll_slippage_factor = get_default_slippage(market)
+
+    batch_dim = [d for d in portfolio_histories.dims if d not in (ds.TIME, ds.ASSET)]
+    if len(batch_dim) != 1 or len(portfolio_histories.dims) != 3:
+        raise ValueError("portfolio_histories must have the dimensions (K, time, asset)")
+    batch_dim = batch_dim[0]
+
+    # the cache of the market is filled before the threads start
+    market.slippage(slippage_factor)
+    market.roll_slippage(roll_slippage_factor)
+
+    stats = [None] * len(portfolio_histories.coords[batch_dim])
+
+    def calc_block(block):
+        for k in range(len(stats))[block]:
+            stats[k] = calc_stat(market, portfolio_histories.isel({batch_dim: k}).drop_vars(batch_dim),
+                                 slippage_factor, roll_slippage_factor, min_periods, max_periods)
+
+    map_blocks(calc_block, len(stats), workers)
+
+    return xr.concat(stats, portfolio_histories.indexes[batch_dim])
+
+
+def calc_stat_xr(data, portfolio_history,
+                 slippage_factor=None, roll_slippage_factor=None,
+                 min_periods=1, max_periods=None,
+                 per_asset=False, points_per_year=None):
+    """
+    calc_stat built from the separate xarray functions (calc_relative_return, calc_equity, ...).
+    It is the reference for the fused engine (IncrementalStat) and calc_stat_per_asset.
+    """
     if points_per_year is None:
         points_per_year = calc_avg_points_per_year(data)
 
@@ -760,6 +1415,712 @@ def calc_stat(data, portfolio_history,
     return stat.transpose(*dims)
 
 
+def calc_stat_per_asset(data, portfolio_history,
+                        slippage_factor=None, roll_slippage_factor=None,
+                        min_periods=1, max_periods=None, points_per_year=None, workers=None):
+    """
+    calc_stat(..., per_asset=True). The data is arranged by PreparedMarket and the statistics are calculated
+    by the numba kernel. The equity curves of the assets are independent, so the blocks of the assets
+    are processed in parallel threads (the kernel releases GIL).
+    SparseOutput is densified to the (time, asset) weights like the market arrays, the result is dense anyway.
+    :param workers: threads count, os.cpu_count() if None
+    :return: xarray with all statistics (time, field, asset)
+    """
+    market = prepare_market(data, points_per_year)
+    points_per_year = market.points_per_year
+
+    if max_periods is None:
+        max_periods = len(market.data.time)
+
+    if slippage_factor is None:
+        slippage_factor = get_default_slippage(market)
+
+    if roll_slippage_factor is None:
+        roll_slippage_factor = get_default_slippage(market)
+
+    time = market.time
+    assets = market.assets
+
+    # normalize(per_asset=True), aligned with data
+    if isinstance(portfolio_history, SparseOutput):
+        portfolio_history = normalize(portfolio_history, per_asset=True)
+        ph_time = portfolio_history.time_coord
+        ph = portfolio_history.to_numpy(assets, market.dtype)
+    else:
+        portfolio_history = portfolio_history.transpose(ds.TIME, ds.ASSET)
+        if np.any(portfolio_history.coords[ds.TIME].values[1:] <= portfolio_history.coords[ds.TIME].values[:-1]):
+            portfolio_history = portfolio_history.sortby(ds.TIME)
+        ph_time = portfolio_history.coords[ds.TIME].values
+        ph = np.array(portfolio_history.values, dtype=market.dtype)
+        ph = np.clip(np.where(np.isfinite(ph), ph, 0), -1, 1)
+        columns = market.align_assets(portfolio_history.coords[ds.ASSET].values)
+        ph = ph[:, columns] if ph.shape[1] > 0 else np.zeros((len(ph_time), len(assets)), market.dtype)
+        ph[:, columns < 0] = 0
+
+    if len(ph_time) == 0:
+        log_err("WARNING! Output is empty.")
+    market.check_missed_dates(ph_time)
+    # the target weights are shifted along the time of portfolio_history
+    ph_shifted = np.concatenate([np.zeros((1, len(assets)), ph.dtype), ph[:-1]])
+    ph_pos, ph_pos_found = market.align_time(ph_time)
+    positions = np.zeros((len(time), len(assets)), market.dtype)
+    positions[ph_pos_found] = ph[ph_pos[ph_pos_found]]
+    target_weights = np.zeros((len(time), len(assets)), market.dtype)
+    target_weights[ph_pos_found] = ph_shifted[ph_pos[ph_pos_found]]
+    del ph, ph_shifted
+
+    market.check_non_liquid(positions)
+
+    # calc_relative_return
+    with np.errstate(divide='ignore', invalid='ignore'):
+        W = target_weights * market.OPEN_RAW / market.PREV_CLOSE
+    W = np.clip(np.where(np.isfinite(W), W, 0), -1, 1)
+    del target_weights
+
+    # the statistics of the relative return start with portfolio_history
+    n = len(time)
+    first_row = n if len(ph_time) == 0 else int(np.searchsorted(time, ph_time.min()))
+    window = min(max_periods, n - first_row)
+    holding_window = min(max_periods, n)
+
+    # the kernel iterates over the assets, so the arrays are transposed to (asset, time)
+    def by_asset(a):
+        return None if a is None else np.ascontiguousarray(a.T)
+
+    arrays = [by_asset(a) for a in (W, market.UNLOCKED, market.OPEN, market.CLOSE, market.slippage(slippage_factor),
+                                    market.DIVS, market.ROLL, market.roll_slippage(roll_slippage_factor), positions,
+                                    market.OPEN_RAW)]
+    del W, positions
+    params = (first_row, 0 if window >= n - first_row else window, min(min_periods, window),
+              min(min_periods, n - first_row), 0 if holding_window >= n else holding_window, min(min_periods, n),
+              float(points_per_year), calc_points_per_day(points_per_year))
+    stat = np.empty((len(assets), 11, n), market.dtype)
+
+    def calc_block(block):
+        calc_stat_per_asset_np(*[None if a is None else a[block] for a in arrays], *params, stat[block])
+
+    map_blocks(calc_block, len(assets), workers, 64)
+
+    return xr.DataArray(
+        stat.transpose(2, 1, 0),
+        dims=[ds.TIME, ds.FIELD, ds.ASSET],
+        coords={ds.TIME: time, ds.FIELD: [
+            stf.EQUITY, stf.RELATIVE_RETURN, stf.VOLATILITY,
+            stf.UNDERWATER, stf.MAX_DRAWDOWN, stf.SHARPE_RATIO,
+            stf.MEAN_RETURN, stf.BIAS, stf.INSTRUMENTS, stf.AVG_TURNOVER, stf.AVG_HOLDINGTIME
+        ], ds.ASSET: assets}
+    )
+
+
+def map_blocks(calc_block, count, workers=None, min_block_size=1):
+    """
+    Splits range(count) into the blocks and calls calc_block(slice) for every block in parallel threads.
+    calc_block should release GIL (numba nogil kernels), the blocks must be independent.
+    The blocks run in the copies of the caller's context (qnt.precision.Settings).
+    :param workers: threads count, os.cpu_count() if None
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    block_size = max(min_block_size, -(-count // (workers * 4)))
+    blocks = [slice(i, i + block_size) for i in range(0, count, block_size)]
+    if workers > 1 and len(blocks) > 1:
+        context = contextvars.copy_context()
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="qnt_stat") as executor:
+            list(executor.map(lambda block: context.copy().run(calc_block, block), blocks))
+    else:
+        for block in blocks:
+            calc_block(block)
+
+
+class IncrementalStat:
+    """
+    Statistics which are extended with the new days without the recalculation of the whole history.
+
+    The object keeps the state of the calculation: the shares count and the equity of the relative return kernel,
+    the running sums of the rolling windows, the equity maximum, the holding log state and the tail of the data
+    for the slippage. update accepts the new rows of data and portfolio_history and returns the statistics
+    for the new days in O(new days). The result matches calc_stat for the whole history
+    with the same points_per_year.
+
+    Limitations:
+        - the assets are fixed by the first data, the weights of the other assets are ignored;
+        - portfolio_history must be aligned with data (the missed days are zero weights);
+        - per_asset statistics are not supported.
+
+    calc_stat calculates avg_holding_time of the last day as if the positions are closed,
+    so the value of the last day is revised by the next update (see get).
+    """
+
+    def __init__(self, slippage_factor=None, roll_slippage_factor=None, min_periods=1, max_periods=None,
+                 points_per_year=None):
+        """
+        :param slippage_factor: slippage
+        :param roll_slippage_factor: slippage for contract roll
+        :param min_periods: minimal number of days
+        :param max_periods: max number of days for rolling, None means the whole history
+        :param points_per_year: calculated from the first data if None
+        """
+        self.slippage_factor = slippage_factor
+        self.roll_slippage_factor = roll_slippage_factor
+        self.min_periods = min_periods
+        self.max_periods = max_periods
+        self.points_per_year = points_per_year
+        self.assets = None
+        self.stat = []
+        self.daily = None
+
+    def _init(self, data):
+        if isinstance(data, PreparedMarket):
+            if self.points_per_year is not None and self.points_per_year != data.points_per_year:
+                raise ValueError("points_per_year differs from points_per_year of the prepared market")
+            self.points_per_year = data.points_per_year
+        if self.points_per_year is None:
+            self.points_per_year = calc_avg_points_per_year(data)
+        if self.slippage_factor is None:
+            self.slippage_factor = get_default_slippage(data)
+        if self.roll_slippage_factor is None:
+            self.roll_slippage_factor = get_default_slippage(data)
+
+        if isinstance(data, PreparedMarket):
+            self.assets = data.assets
+            self.has_roll = data.ROLL is not None
+        else:
+            self.assets = np.sort(data.dropna(ds.ASSET, how='all').coords[ds.ASSET].values)
+            self.has_roll = f.ROLL in data.coords[ds.FIELD].values
+        self.points_per_day = calc_points_per_day(self.points_per_year)
+        # calc_slippage needs daily_period + atr_period rows before the new day
+        self.tail_size = self.points_per_day * 15
+        self.last_time = None
+        self.last_ph_time = None
+        self.min_time = None
+
+        n = len(self.assets)
+        self.data_tail = None
+        self.last_atr = np.full(n, np.nan)
+        self.last_open = np.full(n, np.nan)
+        self.last_close = np.full(n, np.nan)
+        self.last_ph = np.zeros(n)
+        self.instruments = np.zeros(n, dtype=np.bool_)
+        self.prev_positions = np.zeros((2, n))  # the weights of the day before the previous day and the previous day
+        self.prev_open_raw = np.zeros(n)
+
+        self.shares_count = np.zeros(n)
+        self.kernel_open = np.zeros(n)
+        self.kernel_equity = np.zeros(3)
+        self.equity = np.array([1., -np.inf, np.inf])  # equity, equity maximum, max drawdown
+
+        window = 0 if self.max_periods is None else self.max_periods
+        self.log_return_sums = _RollingSums(window)
+        self.return_sums = _RollingSums(window)
+        self.turnover_sums = _RollingSums(window)
+        self.holding_cost_time_sums = _RollingSums(window)
+        self.holding_cost_sums = _RollingSums(window)
+
+        self.holding_prev_pos = np.zeros(n)
+        self.holding_time = np.zeros(n)
+        self.holding_weights = np.zeros((0, n))
+        self.holding_rows = 0
+        self.holding_committed = 0
+
+    def update(self, data, portfolio_history):
+        """
+        Extends the statistics.
+        :param data: xarray with the historical data, the days after the last update are used.
+                     PreparedMarket is accepted by the first update.
+        :param portfolio_history: portfolio weights for the new days (xarray or qnt.output.SparseOutput),
+                                  SparseOutput is densified to the (new days, asset) weights for the kernel
+        :return: xarray with the statistics for the new days
+        """
+        if self.assets is None:
+            self._init(data)
+        elif isinstance(data, PreparedMarket):
+            raise ValueError("PreparedMarket is accepted only by the first update")
+
+        if isinstance(data, PreparedMarket):
+            market = data
+            self.last_atr = market.atr[-1] if len(market.time) > 0 else self.last_atr
+            self.data_tail = market.data.loc[[f.CLOSE, f.HIGH, f.LOW]] \
+                .isel({ds.TIME: slice(-self.tail_size, None)}).reindex({ds.ASSET: self.assets}).copy()
+            if len(market.data.coords[ds.TIME]) == 0:
+                return None
+            self.last_time = market.data.coords[ds.TIME].values[-1]
+        else:
+            data = data.transpose(ds.FIELD, ds.TIME, ds.ASSET)
+            if not np.array_equal(data.coords[ds.ASSET].values, self.assets):
+                data = data.reindex({ds.ASSET: self.assets})
+            time = data.coords[ds.TIME].values
+            if np.any(time[1:] <= time[:-1]):
+                data = data.sortby(ds.TIME)
+                time = data.coords[ds.TIME].values
+            if self.last_time is not None and time[0] <= self.last_time:
+                data = data.isel({ds.TIME: time > self.last_time})
+                time = data.coords[ds.TIME].values
+            if len(time) == 0:
+                return None
+            atr = self._update_atr(data)
+            self.last_time = time[-1]
+            market = PreparedMarket(data, self.points_per_year, assets=self.assets, atr=atr,
+                                    last_open=self.last_open, last_close=self.last_close)
+        self.last_open = market.last_open
+        self.last_close = market.last_close
+
+        # normalized along the assets of portfolio_history before the alignment with data
+        if isinstance(portfolio_history, SparseOutput):
+            portfolio_history = normalize(portfolio_history)
+            ph_time = portfolio_history.time_coord
+            ph = portfolio_history.to_numpy(self.assets, market.dtype)
+        else:
+            portfolio_history = portfolio_history.transpose(ds.TIME, ds.ASSET)
+            ph_time = portfolio_history.coords[ds.TIME].values
+            if np.any(ph_time[1:] <= ph_time[:-1]):
+                portfolio_history = portfolio_history.sortby(ds.TIME)
+                ph_time = portfolio_history.coords[ds.TIME].values
+            ph = normalize_np(np.array(portfolio_history.values, dtype=market.dtype))
+            columns = market.align_assets(portfolio_history.coords[ds.ASSET].values)
+            ph = ph[:, columns] if ph.shape[1] > 0 else np.full((len(ph_time), len(self.assets)), np.nan, market.dtype)
+            ph[:, columns < 0] = np.nan
+
+        if len(ph_time) == 0:
+            if self.min_time is None:
+                log_err("WARNING! Output is empty.")
+        else:
+            market.check_missed_dates(ph_time)
+            if self.min_time is None:
+                self.min_time = ph_time.min()
+
+        time = market.time
+        n = len(time)
+        if n == 0:
+            return None
+        ph_pos, ph_pos_found = market.align_time(ph_time)
+        weights = np.full((n, len(self.assets)), np.nan, market.dtype)
+        weights[ph_pos_found] = ph[ph_pos[ph_pos_found]]
+        weights = normalize_np(weights)
+
+        market.check_non_liquid(weights)
+
+        # the target weights are shifted along the time of portfolio_history
+        ph_rows = ph_time <= self.last_time
+        if self.last_ph_time is not None:
+            ph_rows = np.logical_and(ph_rows, ph_time > self.last_ph_time)
+        ph_shifted = np.concatenate([self.last_ph[np.newaxis], ph[ph_rows]])
+        if ph_rows.any():
+            self.last_ph = ph_shifted[-1]
+            self.last_ph_time = ph_time[ph_rows][-1]
+        target_weights = np.full((n, len(self.assets)), np.nan, market.dtype)
+        target_weights[ph_pos_found] = ph_shifted[:-1][np.searchsorted(ph_time[ph_rows], time[ph_pos_found])]
+        target_weights = normalize_np(target_weights)
+
+        # calc_relative_return
+        W = normalize_np(target_weights * market.OPEN_RAW / market.PREV_CLOSE)
+        del target_weights
+
+        ROLL = None
+        ROLL_SLIPPAGE = None
+        if self.has_roll:
+            ROLL = np.zeros(W.shape, W.dtype) if market.ROLL is None else market.ROLL
+            ROLL_SLIPPAGE = np.zeros(W.shape, W.dtype) if market.ROLL is None \
+                else market.roll_slippage(self.roll_slippage_factor)
+
+        started = np.full(n, False) if self.min_time is None else time >= self.min_time
+        min_periods = self.min_periods if self.max_periods is None else min(self.min_periods, self.max_periods)
+
+        stat = np.empty((n, 11))
+        turnover = np.full(n, np.nan)
+        stat[:, :10] = calc_stat_online_np(
+            W, market.UNLOCKED, market.OPEN, market.CLOSE, market.slippage(self.slippage_factor), market.DIVS,
+            ROLL, ROLL_SLIPPAGE, weights, market.OPEN_RAW, started,
+            min_periods, float(self.points_per_year),
+            self.shares_count, self.kernel_open, self.kernel_equity, self.equity,
+            self.prev_positions, self.prev_open_raw, self.instruments,
+            self.return_sums.ring, self.return_sums.state, self.log_return_sums.ring, self.log_return_sums.state,
+            self.turnover_sums.ring, self.turnover_sums.state, turnover
+        )
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stat[:, 10], holding_cost_time, holding_cost = self._update_holding_time(weights, min_periods)
+        # the daily values of the rolling statistics, calc_stat_windows calculates the other windows from them
+        self.daily = dict(relative_return=stat[:, 1], turnover=turnover,
+                          holding_cost_time=holding_cost_time, holding_cost=holding_cost)
+
+        stat = xr.DataArray(
+            stat,
+            dims=[ds.TIME, ds.FIELD],
+            coords={ds.TIME: time, ds.FIELD: [
+                stf.EQUITY, stf.RELATIVE_RETURN, stf.VOLATILITY,
+                stf.UNDERWATER, stf.MAX_DRAWDOWN, stf.SHARPE_RATIO,
+                stf.MEAN_RETURN, stf.BIAS, stf.INSTRUMENTS, stf.AVG_TURNOVER, stf.AVG_HOLDINGTIME
+            ]}
+        )
+        self.stat.append(stat)
+        return stat
+
+    def get(self):
+        """
+        :return: xarray with all statistics
+        """
+        if len(self.stat) == 0:
+            return None
+        if len(self.stat) > 1:
+            self.stat = [xr.concat(self.stat, ds.TIME)]
+        return self.stat[0]
+
+    def _update_atr(self, data):
+        """
+        calc_slippage without the factor for the new days, calculated on the tail of the data
+        """
+        src = data.loc[[f.CLOSE, f.HIGH, f.LOW]]
+        if self.data_tail is not None:
+            src = xr.concat([self.data_tail, src], ds.TIME)
+        atr = calc_slippage(src, 14, 1, points_per_year=self.points_per_year).values[-len(data.coords[ds.TIME]):]
+        atr = np.ascontiguousarray(atr)
+        atr = ffill_np(self.last_atr, atr)
+        self.last_atr = atr[-1]
+        self.data_tail = src.isel({ds.TIME: slice(-self.tail_size, None)}).copy()
+        return atr
+
+    def _update_holding_time(self, weights, min_periods):
+        """
+        calc_avg_holding_time for the new days and the daily cost_time and cost of the holding log.
+        The log of the last day is calculated with the zero position of the previous day (like in calc_stat)
+        and it isn't added to the running sums, the next update calculates it again with the real positions.
+        """
+        first_row = self.holding_rows - len(self.holding_weights)
+        positions = np.concatenate([self.holding_weights, weights])
+        rows = self.holding_rows + len(weights)
+        last_final_row = max(rows - 2, 0)
+
+        logs = []
+        if self.holding_committed == 0:
+            logs.append(np.zeros((1, 2, len(self.assets))))  # the first day
+        logs.append(calc_holding_log_online_np_nb(
+            positions[max(self.holding_committed, 1) - 1 - first_row:last_final_row - first_row],
+            self.holding_prev_pos, self.holding_time))
+        if rows > 1:
+            logs.append(calc_holding_log_online_np_nb(np.zeros((1, len(self.assets))),
+                                                      self.holding_prev_pos.copy(), self.holding_time.copy()))
+        log = np.concatenate(logs)
+
+        cost = log[:, 0].sum(axis=1)
+        cost_time = cost * ((log[:, 0] * log[:, 1]).sum(axis=1) / cost)
+
+        final = last_final_row + 1 - self.holding_committed
+        s, _, c = self.holding_cost_time_sums.push(cost_time[:final])
+        s2, _, c2 = self.holding_cost_sums.push(cost[:final])
+        if rows > 1:
+            ls, _, lc = self.holding_cost_time_sums.peek(cost_time[-1])
+            ls2, _, lc2 = self.holding_cost_sums.peek(cost[-1])
+            s, c = np.append(s, ls), np.append(c, lc)
+            s2, c2 = np.append(s2, ls2), np.append(c2, lc2)
+
+        HT = np.where(c >= min_periods, s, np.nan) / np.where(c2 >= min_periods, s2, np.nan) / self.points_per_day
+        if len(HT) > len(weights):
+            # revises the last day of the previous update
+            self.stat[-1][-1, -1] = HT[0]
+            HT, cost_time, cost = HT[1:], cost_time[1:], cost[1:]
+
+        self.holding_weights = positions[-2:]
+        self.holding_rows = rows
+        self.holding_committed = last_final_row + 1
+        return HT, cost_time, cost
+
+
+class _RollingSums:
+    """
+    The running sums of the rolling window (window=0 means the expanding window)
+    """
+
+    def __init__(self, window):
+        self.ring = np.full(window, np.nan)
+        self.state = np.zeros(4)  # see push_rolling_nb
+
+    def push(self, values):
+        return calc_rolling_sums_nb(np.asarray(values, np.float64), self.ring, self.state)
+
+    def peek(self, value):
+        return calc_rolling_sums_nb(np.array([value], np.float64), self.ring.copy(), self.state.copy())
+
+
+def calc_rolling_sums_np(values, window):
+    """
+    calc_rolling_sums_nb for the whole series.
+    :param values: the values, NaN values are skipped
+    :param window: the rolling window, 0 means the expanding window
+    :return: the sums, the sums of the squared deviations from the mean and the counts of the finite values
+             for every value
+    """
+    return calc_rolling_sums_nb(np.asarray(values, np.float64), np.full(window, np.nan), np.zeros(4))
+
+
+@numba.njit
+def calc_rolling_sums_nb(values, ring, state):
+    """
+    :param values: the new values, NaN values are skipped
+    :param ring: the values of the rolling window, updated in place
+    :param state: see push_rolling_nb, updated in place
+    :return: the sums, the sums of the squared deviations from the mean and the counts of the finite values
+             for every new value
+    """
+    sums = np.zeros(len(values))
+    deviations = np.zeros(len(values))
+    counts = np.zeros(len(values))
+    for i in range(len(values)):
+        push_rolling_nb(values[i], ring, state)
+        sums[i] = state[1]
+        deviations[i] = state[2]
+        counts[i] = state[3]
+    return sums, deviations, counts
+
+
+@numba.njit(error_model='numpy')
+def calc_stat_online_np(WEIGHT, UNLOCKED, OPEN, CLOSE, SLIPPAGE, DIVS, ROLL, ROLL_SLIPPAGE, POSITIONS, OPEN_RAW, STARTED,
+                        min_periods, points_per_year,
+                        shares_count, prev_open, kernel_equity, equity,
+                        prev_positions, prev_open_raw, instruments,
+                        return_ring, return_state, log_return_ring, log_return_state, turnover_ring, turnover_state,
+                        TURNOVER):
+    """
+    Fused kernel of calc_stat (without avg_holding_time) which continues the calculation from the state.
+    :param WEIGHT...ROLL_SLIPPAGE: the arranged arrays for calc_relative_return_online_np
+    :param POSITIONS: the arranged portfolio weights (time, asset)
+    :param OPEN_RAW: open prices with NaN
+    :param STARTED: the days after the start of portfolio_history
+    :param equity: [equity, equity maximum, max drawdown], updated in place
+    :param prev_positions: POSITIONS of the 2 previous days, updated in place
+    :param prev_open_raw: OPEN_RAW of the previous day, updated in place
+    :param instruments: the assets which were traded, updated in place
+    :param TURNOVER: the turnover of every day (NaN before the start), filled in place
+    :return: (time, field) - equity, relative_return, volatility, underwater, max_drawdown, sharpe_ratio,
+             mean_return, bias, instruments, avg_turnover
+    """
+    first_day = kernel_equity[0] == 0
+    RR = calc_relative_return_online_np(WEIGHT, UNLOCKED, OPEN, CLOSE, SLIPPAGE, DIVS, ROLL, ROLL_SLIPPAGE,
+                                        shares_count, prev_open, kernel_equity)
+    if first_day and len(RR) > 0:
+        prev_open_raw[:] = OPEN_RAW[0]
+
+    stat = np.full((len(RR), 10), np.nan)
+    for i in range(len(RR)):
+        if STARTED[i]:
+            rr = RR[i]
+            ep = equity[0]
+            equity[0] = equity[0] * (rr + 1)
+            equity[1] = max(equity[1], equity[0])
+            uw = equity[0] / equity[1] - 1
+            equity[2] = min(equity[2], uw)
+            stat[i, 0] = equity[0]
+            stat[i, 1] = rr
+            stat[i, 3] = uw
+            stat[i, 4] = equity[2]
+        else:
+            rr = np.nan
+
+        push_rolling_nb(rr, return_ring, return_state)
+        push_rolling_nb(np.log(rr + 1), log_return_ring, log_return_state)
+        m2, c = return_state[2], return_state[3]
+        if c >= min_periods:
+            stat[i, 2] = np.sqrt(m2 / c) * pow(points_per_year, 1. / 2)
+        s, c = log_return_state[1], log_return_state[3]
+        if c >= min_periods:
+            mean_return = np.exp(s / c) - 1
+            stat[i, 6] = np.power(mean_return + 1, points_per_year) - 1
+        stat[i, 5] = stat[i, 6] / stat[i, 2]
+
+        w_sum = 0.
+        w_abs_sum = 0.
+        for a in range(POSITIONS.shape[1]):
+            w_sum += POSITIONS[i, a]
+            w_abs_sum += abs(POSITIONS[i, a])
+            if POSITIONS[i, a] != 0:
+                instruments[a] = True
+        bias = w_sum / w_abs_sum
+        stat[i, 7] = bias if np.isfinite(bias) else 0
+        stat[i, 8] = instruments.sum()
+
+        turnover = np.nan
+        if STARTED[i]:
+            turnover = 0.
+            for a in range(POSITIONS.shape[1]):
+                t = abs(prev_positions[1, a] - prev_positions[0, a] * ep * OPEN_RAW[i, a] / (
+                        prev_open_raw[a] * equity[0]))
+                if not np.isnan(t):
+                    turnover += t
+        TURNOVER[i] = turnover
+        push_rolling_nb(turnover, turnover_ring, turnover_state)
+        if STARTED[i] and turnover_state[3] >= min_periods:
+            stat[i, 9] = turnover_state[1] / turnover_state[3]
+
+        prev_positions[0] = prev_positions[1]
+        prev_positions[1] = POSITIONS[i]
+        prev_open_raw[:] = OPEN_RAW[i]
+    return stat
+
+
+@numba.njit
+def push_rolling_nb(v, ring, state):
+    """
+    Pushes the value to the rolling window.
+    :param state: [position in the ring, sum, sum of the squared deviations from the mean, count], updated in place.
+                  The squared deviations are updated with Welford's method, so the variance (state[2] / state[3])
+                  doesn't lose the precision when the mean is large relative to the deviations.
+    """
+    window = len(ring)
+    if window > 0:
+        pos = int(state[0])
+        old = ring[pos]
+        if np.isfinite(old):
+            mean = state[1] / state[3]
+            state[1] -= old
+            state[3] -= 1
+            if state[3] > 0:
+                state[2] = max(state[2] - (old - mean) * (old - state[1] / state[3]), 0.)
+            else:
+                state[1] = 0.
+                state[2] = 0.
+        ring[pos] = v
+        state[0] = (pos + 1) % window
+    if np.isfinite(v):
+        mean = state[1] / state[3] if state[3] > 0 else 0.
+        state[1] += v
+        state[3] += 1
+        state[2] += (v - mean) * (v - state[1] / state[3])
+
+
+@numba.njit
+def normalize_np(weights):
+    """
+    qnt.output.normalize for the array (time, asset), in place
+    """
+    for t in range(weights.shape[0]):
+        s = 0.
+        for a in range(weights.shape[1]):
+            if not np.isfinite(weights[t, a]):
+                weights[t, a] = 0
+            s += abs(weights[t, a])
+        if s < 1:
+            s = 1
+        for a in range(weights.shape[1]):
+            weights[t, a] = weights[t, a] / s
+    return weights
+
+
+@numba.njit
+def ffill_np(last, values):
+    """
+    forward fill along the first axis which continues the last row
+    """
+    res = np.empty(values.shape, values.dtype)
+    prev = last.copy()
+    for t in range(values.shape[0]):
+        for a in range(values.shape[1]):
+            if not np.isnan(values[t, a]):
+                prev[a] = values[t, a]
+            res[t, a] = prev[a]
+    return res
+
+
+@numba.njit(nogil=True, error_model='numpy')
+def calc_stat_per_asset_np(WEIGHT, UNLOCKED, OPEN, CLOSE, SLIPPAGE, DIVS, ROLL, ROLL_SLIPPAGE, POSITIONS, OPEN_RAW,
+                           first_row, window, min_periods, turnover_min_periods, holding_window, holding_min_periods,
+                           points_per_year, points_per_day, stat):
+    """
+    The kernel of calc_stat_per_asset.
+    :param WEIGHT...ROLL_SLIPPAGE: the arranged arrays for calc_relative_return_asset_nb (asset, time)
+    :param POSITIONS: the arranged portfolio weights (asset, time)
+    :param OPEN_RAW: open prices with NaN (asset, time)
+    :param first_row: the first row after the start of portfolio_history
+    :param window: the rolling window of the relative return statistics, 0 means the expanding window
+    :param holding_window: the rolling window of avg_holding_time, 0 means the expanding window
+    :param stat: the result (asset, field, time) - equity, relative_return, volatility, underwater, max_drawdown,
+                 sharpe_ratio, mean_return, bias, instruments, avg_turnover, avg_holding_time
+    """
+    assets, n = WEIGHT.shape
+    stat[:] = np.nan
+
+    for a in range(assets):
+        RR = np.zeros(n)
+        if ROLL is None:
+            calc_relative_return_asset_nb(WEIGHT[a], UNLOCKED[a], OPEN[a], CLOSE[a], SLIPPAGE[a], DIVS[a],
+                                          None, None, RR)
+        else:
+            calc_relative_return_asset_nb(WEIGHT[a], UNLOCKED[a], OPEN[a], CLOSE[a], SLIPPAGE[a], DIVS[a],
+                                          ROLL[a], ROLL_SLIPPAGE[a], RR)
+        s = stat[a]
+
+        return_ring = np.full(window, np.nan)
+        return_state = np.zeros(4)
+        log_return_ring = np.full(window, np.nan)
+        log_return_state = np.zeros(4)
+        turnover_ring = np.full(window, np.nan)
+        turnover_state = np.zeros(4)
+        equity = 1.
+        equity_max = -np.inf
+        max_drawdown = np.inf
+        for i in range(first_row, n):
+            rr = RR[i]
+            prev_equity = equity
+            equity = equity * (rr + 1)
+            equity_max = max(equity_max, equity)
+            uw = equity / equity_max - 1
+            max_drawdown = min(max_drawdown, uw)
+            s[0, i] = equity
+            s[1, i] = rr
+            s[3, i] = uw
+            s[4, i] = max_drawdown
+
+            push_rolling_nb(rr, return_ring, return_state)
+            push_rolling_nb(np.log(rr + 1), log_return_ring, log_return_state)
+            m2, c = return_state[2], return_state[3]
+            if c >= min_periods:
+                s[2, i] = np.sqrt(m2 / c) * pow(points_per_year, 1. / 2)
+            rs, c = log_return_state[1], log_return_state[3]
+            if c >= min_periods:
+                mean_return = np.exp(rs / c) - 1
+                s[6, i] = np.power(mean_return + 1, points_per_year) - 1
+            s[5, i] = s[6, i] / s[2, i]
+
+            w = POSITIONS[a, i - 1] if i > 0 else 0.
+            wp = POSITIONS[a, i - 2] if i > 1 else 0.
+            prev_open = OPEN_RAW[a, i - 1] if i > 0 else OPEN_RAW[a, 0]
+            push_rolling_nb(abs(w - wp * prev_equity * OPEN_RAW[a, i] / (prev_open * equity)),
+                            turnover_ring, turnover_state)
+            if turnover_state[3] >= turnover_min_periods:
+                s[9, i] = turnover_state[1] / turnover_state[3]
+
+        s[7] = POSITIONS[a]
+        s[8] = 1
+
+        # calc_avg_holding_time, the position of the day before the last day is zero (avoids NaN for buy-and-hold)
+        cost_time_ring = np.full(holding_window, np.nan)
+        cost_time_state = np.zeros(4)
+        cost_ring = np.full(holding_window, np.nan)
+        cost_state = np.zeros(4)
+        prev_pos = 0.
+        holding_time = 0.
+        for i in range(n):
+            cost = 0.
+            duration = 0.
+            if i > 0:
+                holding_time += 1
+                pos = 0. if i == n - 1 else POSITIONS[a, i - 1]
+                dpos = pos - prev_pos
+                if np.isfinite(pos) and abs(dpos) >= EPS:
+                    if prev_pos > 0 > dpos or prev_pos < 0 < dpos:  # opposite change direction
+                        if abs(dpos) > abs(prev_pos):
+                            cost = abs(prev_pos)
+                            duration = holding_time
+                            holding_time = 0
+                        else:
+                            cost = abs(dpos)
+                            duration = holding_time
+                    elif pos != 0:
+                        holding_time = holding_time * abs(prev_pos) / abs(pos)
+                    prev_pos = pos
+            push_rolling_nb(cost * duration, cost_time_ring, cost_time_state)
+            push_rolling_nb(cost, cost_ring, cost_state)
+            if cost_state[3] >= holding_min_periods:
+                s[10, i] = cost_time_state[1] / cost_state[1] / points_per_day
+
+
 def calc_sector_distribution(portfolio_history, timeseries=None, kind=None):
     """
     :param portfolio_history: portfolio weights set for every day
@@ -963,26 +2324,42 @@ def check_exposure(portfolio_history,
     :param check_period: period for checking
     :return:
     """
-    portfolio_history = portfolio_history.loc[{ds.TIME: np.sort(portfolio_history.coords[ds.TIME])}]
-
-    exposure = calc_exposure(portfolio_history)
-    max_exposure = exposure.max(ds.ASSET)
+    if isinstance(portfolio_history, SparseOutput):
+        portfolio_history = portfolio_history.sorted()
+        exposure = calc_exposure(portfolio_history)
+        max_exposure, max_exposure_entry = calc_max_exposure_sparse(exposure)
+        max_exposure = xr.DataArray(max_exposure, dims=[ds.TIME], coords={ds.TIME: exposure.time_coord})
+        found = max_exposure_entry >= 0
+        max_exposure_asset = np.full(len(exposure), None, dtype=object)
+        max_exposure_asset[found] = exposure.asset_coord[exposure.indices[max_exposure_entry[found]]]
+        max_exposure_asset = xr.DataArray(max_exposure_asset, dims=[ds.TIME], coords={ds.TIME: exposure.time_coord})
+        excess = np.bincount(exposure.row_ids(), weights=np.maximum(exposure.values - soft_limit, 0),
+                             minlength=len(exposure))
+        excess = xr.DataArray(excess, dims=[ds.TIME], coords={ds.TIME: exposure.time_coord})
+    else:
+        portfolio_history = portfolio_history.loc[{ds.TIME: np.sort(portfolio_history.coords[ds.TIME])}]
+        exposure = calc_exposure(portfolio_history)
+        max_exposure = exposure.max(ds.ASSET)
+        max_exposure_asset = None
+        excess = exposure - soft_limit
+        excess = excess.where(excess > 0, 0).sum(ds.ASSET)
 
     max_exposure_over_limit = max_exposure.where(max_exposure > soft_limit).dropna(ds.TIME)
     if len(max_exposure_over_limit) > 0:
-        max_exposure_asset = exposure.sel({ds.TIME: max_exposure_over_limit.coords[ds.TIME]}).idxmax(ds.ASSET)
+        if max_exposure_asset is None:
+            max_exposure_asset = exposure.sel({ds.TIME: max_exposure_over_limit.coords[ds.TIME]}).idxmax(ds.ASSET)
+        else:
+            max_exposure_asset = max_exposure_asset.sel({ds.TIME: max_exposure_over_limit.coords[ds.TIME]})
         log_info("Positions with max exposure over the limit:")
         pos = xr.concat([max_exposure_over_limit, max_exposure_asset], pd.Index(['exposure', 'asset'], name='field'))
         log_info(pos.to_pandas().T)
 
-    periods = min(avg_period, len(portfolio_history.coords[ds.TIME]))
+    periods = min(avg_period, len(max_exposure.coords[ds.TIME]))
 
     bad_days = xr.where(max_exposure > soft_limit, 1.0, 0.0)
     bad_days_proportion = bad_days[-check_period:].rolling(dim={ds.TIME: periods}).mean()
     days_ok = xr.where(bad_days_proportion > days_tolerance, 1, 0).sum().values == 0
 
-    excess = exposure - soft_limit
-    excess = excess.where(excess > 0, 0).sum(ds.ASSET)
     excess = excess[-check_period:].rolling(dim={ds.TIME: periods}).mean()
     excess_ok = xr.where(excess > excess_tolerance, 1, 0).sum().values == 0
 
@@ -1002,9 +2379,29 @@ def check_exposure(portfolio_history,
 def calc_exposure(portfolio_history):
     """
     Calculates exposure per position (range: 0..1)
-    :param portfolio_history:
+    :param portfolio_history: xarray or SparseOutput
     :return:
     """
+    if isinstance(portfolio_history, SparseOutput):
+        row_ids = portfolio_history.row_ids()
+        sum = np.bincount(row_ids, weights=abs(portfolio_history.values), minlength=len(portfolio_history))
+        sum = np.where(sum > EPS, sum, 1)  # prevents div by zero
+        return portfolio_history.copy(abs(portfolio_history.values) / sum[row_ids])
     sum = abs(portfolio_history).sum(ds.ASSET)
     sum = sum.where(sum > EPS, 1)  # prevents div by zero
     return abs(portfolio_history) / sum
+
+
+def calc_max_exposure_sparse(exposure):
+    """
+    :param exposure: calc_exposure of SparseOutput
+    :return: the max exposure of every day and the stored entry with the max exposure (-1 for the empty days)
+    """
+    nonempty = np.diff(exposure.indptr) > 0
+    # the rows stay grouped, the entries of every row are sorted by the exposure descending
+    order = np.lexsort((-exposure.values, exposure.row_ids()))
+    max_entry = np.full(len(exposure), -1, dtype=np.int64)
+    max_entry[nonempty] = order[exposure.indptr[:-1][nonempty]]
+    max_exposure = np.zeros(len(exposure))
+    max_exposure[nonempty] = exposure.values[max_entry[nonempty]]
+    return max_exposure, max_entry
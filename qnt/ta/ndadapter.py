@@ -2,6 +2,7 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 import typing as tp
+import qnt.precision as qnprec
 
 NdType = tp.Union[np.ndarray, pd.DataFrame, xr.DataArray, pd.Series]
 NdTupleType = tp.Union[
@@ -27,15 +28,25 @@ def nd_universal_adapter(d1_function, nd_args: NdTupleType, plain_args: tuple) -
 
 
 def nd_np_adapter(d1_function, nd_args: tp.Tuple[np.ndarray], plain_args: tuple) -> np.ndarray:
+    # the kernels calculate in float64, the result is stored with the precision of qnt.precision
+    dtype = qnprec.get_dtype()
     shape = nd_args[0].shape
     if len(shape) == 1:
-        args = nd_args + plain_args
-        return d1_function(*args)
+        args = writeable_args(nd_args) + plain_args
+        return d1_function(*args).astype(dtype, copy=False)
     nd_args_2d = tuple(a.reshape(-1, shape[-1]) for a in nd_args)
-    result2d = np.array([d1_function(*(a[i] for a in nd_args_2d), *plain_args) for i in range(nd_args_2d[0].shape[0])])
+    result2d = np.empty(nd_args_2d[0].shape, dtype)
+    for i in range(nd_args_2d[0].shape[0]):
+        result2d[i] = d1_function(*writeable_args(tuple(a[i] for a in nd_args_2d)), *plain_args)
     return result2d.reshape(shape)
 
 
+def writeable_args(nd_args: tp.Tuple[np.ndarray]) -> tp.Tuple[np.ndarray]:
+    # numba functions with explicit signatures don't accept read-only arrays (see qnt.backtester.readonly_view)
+    # and float32 arrays, the rows are converted one by one
+    return tuple(a if a.flags.writeable and a.dtype == np.float64 else a.astype(np.float64) for a in nd_args)
+
+
 def nd_pd_df_adapter(d1_function, nd_args: tp.Tuple[pd.DataFrame], plain_args: tuple) -> pd.DataFrame:
     np_nd_args = tuple(a.to_numpy().transpose() for a in nd_args)
     np_result = nd_np_adapter(d1_function, np_nd_args, plain_args)
@@ -69,6 +80,7 @@ def nd_to_1d_universal_adapter(np_function, nd_args: NdTupleType, plain_args: tu
 
 
 def nd_to_1d_np_adapter(np_function, nd_args: tp.Tuple[np.ndarray], plain_args: tuple) -> np.ndarray:
+    nd_args = writeable_args(nd_args)
     args = nd_args + plain_args
     return np_function(*args)
 
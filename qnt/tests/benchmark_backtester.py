@@ -0,0 +1,97 @@
+"""
+Benchmark for qnt.backtester.run_iterations on synthetic data (no network access needed).
+
+Every mode runs in a separate process, so the peak RSS values are comparable.
+
+    python benchmark_backtester.py [years] [assets] [lookback_period]
+"""
+import multiprocessing
+import resource
+import sys
+import time
+import os
+
+os.environ.setdefault('API_KEY', "default")
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import qnt.backtester as qnbt
+import qnt.profiler as qnprof
+import qnt.log as qnlog
+
+
+def make_data(years, assets):
+    time_coord = pd.date_range('2005-01-01', periods=int(years * 365), freq='D').values
+    rnd = np.random.RandomState(42)
+    values = np.empty((5, len(time_coord), assets))
+    values[3] = np.cumprod(1 + rnd.normal(0, 0.01, (len(time_coord), assets)), axis=0) * 100
+    values[0] = values[3] * 0.999
+    values[1] = values[3] * 1.01
+    values[2] = values[3] * 0.99
+    values[4] = 1
+    return xr.DataArray(
+        values,
+        dims=['field', 'time', 'asset'],
+        coords={
+            'field': ['open', 'high', 'low', 'close', 'is_liquid'],
+            'time': time_coord,
+            'asset': ['A' + str(i) for i in range(assets)],
+        }
+    )
+
+
+def strategy(data):
+    close = data.sel(field='close')
+    return xr.where(close.isel(time=-1) > close.mean('time'), 1, -1)
+
+
+def label_window(data, max_date, lookback_period):
+    min_date = max_date - np.timedelta64(lookback_period, 'D')
+    return data.loc[dict(time=slice(min_date, max_date))]
+
+
+def run_mode(kwargs, years, assets, lookback_period, queue):
+    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stderr.fileno())  # hides the progress bar
+    data = make_data(years, assets)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_date = data.time.values[lookback_period]
+    iterations = len(data.time.values[data.time.values >= start_date])
+    kwargs = dict(kwargs)
+    window = kwargs.pop('window', qnbt.standard_window)
+    t = time.time()
+    with qnlog.Settings(info=False, err=False):
+        qnbt.run_iterations(data.time.values, data, window, start_date, lookback_period,
+                            lambda d, s: strategy(d), 1, False, **kwargs)
+    t = time.time() - t
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((iterations, t, rss_before, rss_after))
+
+
+def measure(name, kwargs, years, assets, lookback_period):
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=run_mode, args=(kwargs, years, assets, lookback_period, queue))
+    p.start()
+    iterations, t, rss_before, rss_after = queue.get()
+    p.join()
+    return [name, iterations, round(t, 2), round(t / iterations * 1000, 3),
+            round(rss_before / 1024, 1), round(rss_after / 1024, 1)]
+
+
+def main(years=15, assets=500, lookback_period=365):
+    from tabulate import tabulate
+    modes = [
+        ('deepcopy (mutable_data=True)', dict(mutable_data=True)),
+        ('read-only views, label-based window', dict(mutable_data=False, window=label_window)),
+        ('read-only views', dict(mutable_data=False)),
+        ('read-only views, profiler', dict(mutable_data=False, profiler=qnprof.Profiler())),
+        ('read-only views, workers=' + str(os.cpu_count()), dict(mutable_data=False, workers=os.cpu_count())),
+    ]
+    rows = [measure(name, kwargs, years, assets, lookback_period) for name, kwargs in modes]
+    headers = ['mode', 'iterations', 'total, s', 'per iteration, ms', 'RSS after load, MiB', 'peak RSS, MiB']
+    print(tabulate(rows, headers))
+
+
+if __name__ == '__main__':
+    main(*(int(a) for a in sys.argv[1:]))
@@ -72,6 +72,26 @@ def load_data_and_create_data_array(filename, dims, transpose_order):
     return xr.DataArray(values, dims=dims, coords=coords)
 
 
+def create_random_data(days=300, assets=5, seed=1):
+    rnd = np.random.RandomState(seed)
+    close = np.cumprod(1 + rnd.normal(0, 0.02, (days, assets)), axis=0) * 100
+    close[rnd.rand(days, assets) < 0.05] = np.nan
+    close[:30, 2] = np.nan
+    open = close * (1 + rnd.normal(0, 0.005, (days, assets)))
+    divs = np.where(rnd.rand(days, assets) < 0.02, 0.5, 0)
+    roll = np.where(rnd.rand(days, assets) < 0.03, 0.1, 0)
+    values = np.stack([open, close * 1.01, close * 0.99, close, np.ones_like(close), divs, roll])
+    values[:, days // 2] = np.nan
+    data = xr.DataArray(values, dims=['field', 'time', 'asset'], coords={
+        'field': ['open', 'high', 'low', 'close', 'is_liquid', 'divs', 'roll'],
+        'time': pd.date_range('2020-01-01', periods=days),
+        'asset': ['A' + str(i) for i in range(assets)],
+    })
+    weights = xr.DataArray(np.round(rnd.normal(size=(days, assets))), dims=['time', 'asset'],
+                           coords={'time': data.time, 'asset': data.asset})
+    return data, weights
+
+
 class TestBaseStatistic(unittest.TestCase):
 
     def test_relative_return_border_case_per_asset(self):
@@ -1186,6 +1206,246 @@ class TestBaseStatistic(unittest.TestCase):
                         'pandas_version': '1.4.0',
                         'primaryKey': ['time']}}, stat_head)
 
+    def test_incremental_stat(self):
+        import qnt.log as qnlog
+        data, weights = create_random_data()
+        weights = weights.isel(time=slice(20, None))
+        cuts = [21, 22, 60, 61, 149, 151, 152, 299, 300]
+
+        for max_periods in [None, 50]:
+            with qnlog.Settings(err=False):
+                stat = qnstats.IncrementalStat(points_per_year=251, max_periods=max_periods)
+                prev = 0
+                for cut in cuts:
+                    new_data = data.isel(time=slice(prev, cut))
+                    new_stat = stat.update(new_data, weights.sel(time=slice(new_data.time[0], new_data.time[-1])))
+                    self.assertEqual(new_stat.time.values.tolist(),
+                                     new_data.dropna('time', how='all').time.values.tolist())
+                    expected = qnstats.calc_stat(data.isel(time=slice(0, cut)),
+                                                 weights.sel(time=slice(None, data.time[cut - 1])),
+                                                 points_per_year=251, max_periods=max_periods)
+                    result = stat.get()
+                    self.assertEqual(result.time.values.tolist(), expected.time.values.tolist())
+                    self.assertEqual(result.field.values.tolist(), expected.field.values.tolist())
+                    np.testing.assert_allclose(result.values, expected.values, rtol=0, atol=1e-9)
+                    prev = cut
+
+    def test_calc_rolling_sums(self):
+        # the large mean relative to the deviations breaks the variance from the raw sums of squares
+        values = 1000 + np.random.RandomState(4).normal(0, 1e-3, 5000)
+        values[[10, 2000, 2001]] = np.nan
+        for window in [0, 50]:
+            s, m2, c = qnstats.calc_rolling_sums_np(values, window)
+            rolling = pd.Series(values).rolling(window if window > 0 else len(values), min_periods=1)
+            np.testing.assert_allclose(c, rolling.count().values)
+            np.testing.assert_allclose(s, rolling.sum().values, rtol=1e-12)
+            np.testing.assert_allclose(np.sqrt(m2 / c), rolling.std(ddof=0).values, rtol=1e-4, atol=1e-9)
+
+    def test_calc_slippage(self):
+        for points_per_year, nan_share in [(251, 0.02), (251 * 24, 0.0005)]:
+            data, _ = create_random_data(500, 5)
+            data = data.fillna(1).where(np.random.RandomState(2).rand(*data.shape) > nan_share)
+            result = qnstats.calc_slippage(data, 14, 0.05, points_per_year=points_per_year)
+            expected = qnstats.calc_slippage_xr(data, 14, 0.05, points_per_year=points_per_year)
+            self.assertEqual(result.dims, expected.dims)
+            self.assertTrue(np.isfinite(result.values).any())
+            np.testing.assert_allclose(result.values, expected.values, rtol=1e-12, atol=0)
+
+    def test_calc_relative_return_batch(self):
+        data, weights = create_random_data()
+        weights = weights.isel(time=slice(20, None))
+        rnd = np.random.RandomState(7)
+        portfolio_histories = xr.concat([weights * rnd.normal(size=len(weights.asset)) for k in range(3)],
+                                        pd.Index(['a', 'b', 'c'], name='strategy'))
+        for data in [data, data.drop_sel(field='roll')]:
+            result = qnstats.calc_relative_return_batch(data, portfolio_histories, points_per_year=251, workers=2)
+            self.assertEqual(result.dims, ('strategy', 'time'))
+            for k in result.strategy.values:
+                expected = qnstats.calc_relative_return(data, portfolio_histories.sel(strategy=k),
+                                                        points_per_year=251)
+                self.assertEqual(result.time.values.tolist(), expected.time.values.tolist())
+                np.testing.assert_allclose(result.sel(strategy=k).values, expected.values, rtol=0, atol=1e-12)
+
+    def test_calc_stat_batch(self):
+        import qnt.log as qnlog
+        data, weights = create_random_data()
+        weights = weights.isel(time=slice(20, None))
+        rnd = np.random.RandomState(7)
+        portfolio_histories = xr.concat([weights * rnd.normal(size=len(weights.asset)) for k in range(3)],
+                                        pd.Index(['a', 'b', 'c'], name='strategy'))
+        with qnlog.Settings(err=False):
+            result = qnstats.calc_stat_batch(data, portfolio_histories, points_per_year=251, workers=2)
+            self.assertEqual(result.dims, ('strategy', 'time', 'field'))
+            for k in result.strategy.values:
+                expected = qnstats.calc_stat(data, portfolio_histories.sel(strategy=k), points_per_year=251)
+                np.testing.assert_array_equal(result.sel(strategy=k).values, expected.values)
+
+    def test_calc_stat_fused(self):
+        import qnt.log as qnlog
+        data, weights = create_random_data()
+        weights = weights.isel(time=slice(20, None))
+        for max_periods in [None, 50]:
+            with qnlog.Settings(err=False):
+                result = qnstats.calc_stat(data, weights, points_per_year=251, max_periods=max_periods)
+                expected = qnstats.calc_stat_xr(data, weights, points_per_year=251, max_periods=max_periods)
+            self.assertEqual(result.time.values.tolist(), expected.time.values.tolist())
+            self.assertEqual(result.field.values.tolist(), expected.field.values.tolist())
+            np.testing.assert_allclose(result.values, expected.values, rtol=0, atol=1e-9)
+
+    def test_calc_stat_per_asset(self):
+        import qnt.log as qnlog
+        data, weights = create_random_data()
+        weights = weights.isel(time=slice(20, None)) / 3
+        for data in [data, data.drop_sel(field='roll')]:
+            for max_periods in [None, 50]:
+                with qnlog.Settings(err=False):
+                    result = qnstats.calc_stat(data, weights, per_asset=True, points_per_year=251,
+                                               max_periods=max_periods)
+                    expected = qnstats.calc_stat_xr(data, weights, per_asset=True, points_per_year=251,
+                                                    max_periods=max_periods)
+                self.assertEqual(result.dims, expected.dims)
+                self.assertEqual(result.time.values.tolist(), expected.time.values.tolist())
+                self.assertEqual(result.asset.values.tolist(), expected.asset.values.tolist())
+                np.testing.assert_allclose(result.values, expected.values, rtol=0, atol=1e-9)
+
+    def test_prepared_market(self):
+        import qnt.log as qnlog
+        import qnt.output as qnout
+        data, weights = create_random_data()
+        weights = weights.isel(time=slice(20, None))
+        market = qnstats.PreparedMarket(data, 251)
+        with qnlog.Settings(err=False):
+            for output in [weights, weights * 0.5]:
+                for per_asset in [False, True]:
+                    result = qnstats.calc_stat(market, output, per_asset=per_asset)
+                    expected = qnstats.calc_stat(data, output, per_asset=per_asset, points_per_year=251)
+                    self.assertEqual(result.dims, expected.dims)
+                    self.assertEqual(result.time.values.tolist(), expected.time.values.tolist())
+                    np.testing.assert_array_equal(result.values, expected.values)
+
+            stat = qnstats.IncrementalStat()
+            stat.update(qnstats.PreparedMarket(data.isel(time=slice(None, 150)), 251),
+                        weights.sel(time=slice(None, data.time[149])))
+            stat.update(data.isel(time=slice(150, None)), weights.sel(time=slice(data.time[150], None)))
+            expected = qnstats.calc_stat(data, weights, points_per_year=251)
+            np.testing.assert_allclose(stat.get().values, expected.values, rtol=0, atol=1e-9)
+            self.assertRaises(ValueError, stat.update, market, weights)
+
+            sr = qnout.calc_sharpe_ratio_for_check(data, weights, 'futures', False, qnstats.prepare_market(data))
+            expected = qnout.calc_sharpe_ratio_for_check(data, weights, 'futures', False)
+            np.testing.assert_allclose(sr, expected, rtol=1e-9)
+        self.assertRaises(ValueError, qnstats.calc_stat, market, weights, points_per_year=252)
+
+    def test_calc_stat_windows(self):
+        import qnt.log as qnlog
+        data, weights = create_random_data()
+        weights = weights.isel(time=slice(20, None))
+        windows = [20, 50, None]
+        with qnlog.Settings(err=False):
+            for per_asset in [False, True]:
+                result = qnstats.calc_stat(data, weights, per_asset=per_asset, points_per_year=251, min_periods=5,
+                                           windows=windows)
+                self.assertEqual(result.coords['window'].values.tolist(), windows)
+                for window in windows:
+                    expected = qnstats.calc_stat(data, weights, per_asset=per_asset, points_per_year=251,
+                                                 min_periods=5, max_periods=window)
+                    self.assertEqual(result.sel(window=window).dims, expected.dims)
+                    np.testing.assert_allclose(result.sel(window=window).values, expected.values, rtol=0, atol=1e-9)
+
+    def test_calc_sharpe_ratio_bootstrap(self):
+        rnd = np.random.RandomState(3)
+        rr = xr.DataArray(rnd.normal(0.001, 0.01, (500, 2)), dims=['time', 'asset'],
+                          coords={'time': pd.date_range('2020-01-01', periods=500), 'asset': ['a', 'b']})
+        expected = qnstats.calc_sharpe_ratio_annualized(rr, points_per_year=251).isel(time=-1)
+
+        # every resample of the single block is the rotation of the series
+        rotations = qnstats.calc_sharpe_ratio_bootstrap(rr, 10, block_size=1e12, points_per_year=251, seed=1)
+        self.assertEqual(rotations.dims, ('sample', 'asset'))
+        np.testing.assert_allclose(rotations.values, np.tile(expected.values, (10, 1)), rtol=1e-9)
+
+        result = qnstats.calc_sharpe_ratio_bootstrap(rr, 1000, points_per_year=251, seed=1, workers=1)
+        np.testing.assert_array_equal(
+            result.values, qnstats.calc_sharpe_ratio_bootstrap(rr, 1000, points_per_year=251, seed=1, workers=3))
+
+        confidence = qnstats.calc_sharpe_ratio_confidence(rr, quantiles=[0.05, 0.95], samples=1000,
+                                                          points_per_year=251, seed=1)
+        np.testing.assert_allclose(confidence.sel(field='sharpe_ratio').values, expected.values)
+        self.assertTrue((confidence.sel(field=0.05) < expected).all())
+        self.assertTrue((confidence.sel(field=0.95) > expected).all())
+        np.testing.assert_allclose(confidence.sel(field='probabilistic_sharpe_ratio').values,
+                                   (result > 0).mean('sample').values)
+
+    def test_float32_precision(self):
+        import qnt.log as qnlog
+        import qnt.precision as qnprec
+        import qnt.ta as qnta
+        data, weights = create_random_data()
+        weights = weights.isel(time=slice(20, None)) / 3
+        portfolio_histories = xr.concat([weights, weights * 0.5], pd.Index(['a', 'b'], name='strategy'))
+
+        def calc_stats():
+            with qnlog.Settings(err=False):
+                incremental = qnstats.IncrementalStat(points_per_year=251)
+                incremental.update(data.isel(time=slice(None, 150)), weights.sel(time=slice(None, data.time[149])))
+                incremental.update(data.isel(time=slice(150, None)), weights.sel(time=slice(data.time[150], None)))
+                return [
+                    qnstats.calc_stat(data, weights, points_per_year=251),
+                    qnstats.calc_stat(data, weights, per_asset=True, points_per_year=251),
+                    qnstats.calc_relative_return_batch(data, portfolio_histories, points_per_year=251),
+                    incremental.get(),
+                ]
+
+        close, high, low = data.sel(field='close'), data.sel(field='high'), data.sel(field='low')
+        ta_functions = [
+            lambda: qnta.sma(close, 10), lambda: qnta.ema(close, 10), lambda: qnta.lwma(close, 10),
+            lambda: qnta.rsi(close, 14), lambda: qnta.macd(close)[2], lambda: qnta.trix(close, 10),
+            lambda: qnta.atr(high, low, close, 14), lambda: qnta.stochastic_k(high, low, close, 14),
+            lambda: qnta.obv(close, data.sel(field='is_liquid')),
+        ]
+
+        expected = calc_stats() + [fn() for fn in ta_functions]
+        with qnprec.Settings(np.float32):
+            result = calc_stats() + [fn() for fn in ta_functions]
+        self.assertEqual(qnprec.get_dtype(), np.float64)
+
+        # the accumulators are float64, only the stored arrays are float32
+        self.assertEqual([r.dtype for r in result[:4]], [np.float64, np.float32, np.float64, np.float64])
+        self.assertTrue(all(r.dtype == np.float32 for r in result[4:]))
+        for r, e in zip(result, expected):
+            self.assertEqual(r.dims, e.dims)
+            self.assertEqual(r.time.values.tolist(), e.time.values.tolist())
+            np.testing.assert_array_equal(np.isnan(r.values), np.isnan(e.values))
+            np.testing.assert_allclose(r.values, e.values, rtol=1e-4, atol=1e-4)
+
+        self.assertRaises(ValueError, qnprec.set_dtype, np.float16)
+
+        # Settings is local for the thread, set_dtype is global
+        import threading
+        barrier = threading.Barrier(2)
+        dtypes = dict()
+
+        def run(dtype):
+            with qnprec.Settings(dtype):
+                barrier.wait()
+                dtypes[dtype] = qnta.sma(close, 10).dtype
+                barrier.wait()
+
+        threads = [threading.Thread(target=run, args=(dtype,)) for dtype in (np.float32, np.float64)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(dtypes, {np.float32: np.float32, np.float64: np.float64})
+
+        qnprec.set_dtype(np.float32)
+        try:
+            thread = threading.Thread(target=lambda: dtypes.update(global_dtype=qnprec.get_dtype()))
+            thread.start()
+            thread.join()
+            self.assertEqual(dtypes['global_dtype'], np.float32)
+        finally:
+            qnprec.set_dtype(np.float64)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -95,6 +95,27 @@ def load_data_and_create_data_array(filename, dims, transpose_order):
     return xr.DataArray(values, dims=dims, coords=coords)
 
 
+def create_synthetic_data(days=200, assets=4):
+    time_coord = pd.date_range('2020-01-01', periods=days, freq='D').values
+    rnd = np.random.RandomState(42)
+    close = np.cumprod(1 + rnd.normal(0, 0.01, (days, assets)), axis=0) * 100
+    values = np.stack([close * 0.999, close * 1.01, close * 0.99, close, np.ones_like(close)])
+    return xr.DataArray(
+        values,
+        dims=['field', 'time', 'asset'],
+        coords={
+            'field': ['open', 'high', 'low', 'close', 'is_liquid'],
+            'time': time_coord,
+            'asset': ['A' + str(i) for i in range(assets)],
+        }
+    )
+
+
+def calculate_weights_sma(data):
+    close = data.sel(field='close')
+    return xr.where(qnta.sma(close, 20).isel(time=-1) < close.isel(time=-1), 1, -1)
+
+
 schema_global = {'fields': [{'name': 'time', 'type': 'datetime'},
                             {'name': 'equity', 'type': 'number'},
                             {'name': 'relative_return', 'type': 'number'},
@@ -1040,6 +1061,642 @@ class TestBaseStatistic(unittest.TestCase):
                        'volatility': 0.5480091762}],
              'schema': schema_global}, json.loads(stat_tail))
 
+    def test_run_iterations_readonly(self):
+        import qnt.backtester as qnbt
+        data = create_synthetic_data()
+        start_date = data.time.values[100]
+
+        def run(strategy, mutable_data):
+            return qnbt.run_iterations(data.time.values, data, qnbt.standard_window, start_date, 60,
+                                       lambda d, s: strategy(d), 1, False, mutable_data)[0]
+
+        weights_copy = run(calculate_weights_sma, True)
+        weights_view = run(calculate_weights_sma, False)
+        self.assertTrue(weights_copy.equals(weights_view))
+
+        def mutating_strategy(data):
+            data.loc[dict(field='close')] = 0
+            return data.sel(field='close').isel(time=-1)
+
+        with self.assertRaises(ValueError):
+            run(mutating_strategy, False)
+        run(mutating_strategy, True)
+        self.assertGreater(data.sel(field='close').min().item(), 0)
+
+    def test_run_iterations_parallel(self):
+        import qnt.backtester as qnbt
+        data = create_synthetic_data()
+        start_date = data.time.values[100]
+
+        def run(workers):
+            return qnbt.run_iterations(data.time.values, data, qnbt.standard_window, start_date, 60,
+                                       lambda d, s: calculate_weights_sma(d), 1, False, False, workers)[0]
+
+        weights_sequential = run(1)
+        weights_parallel = run(3)
+        self.assertTrue(weights_sequential.identical(weights_parallel))
+
+        def crash(d, s):
+            if d.time.values[-1] == data.time.values[150]:
+                os._exit(3)  # the worker is killed without the error message
+            return calculate_weights_sma(d)
+
+        self.assertEqual(qnbt.run_iterations(data.time.values, data, qnbt.standard_window, start_date, 60,
+                                             crash, 1, False, False, 3), (None, None))
+        models = qnbt.train_models_parallel(lambda d: os._exit(3), data, qnbt.standard_window, 60,
+                                            data.time.values[100:104], 2)
+        self.assertIsNone(models)
+
+    def test_run_iterations_checkpoint(self):
+        import tempfile
+        import qnt.backtester as qnbt
+        data = create_synthetic_data()
+        start_date = data.time.values[100]
+        calls = []
+        crash_at = []
+
+        class Crash(Exception):
+            pass
+
+        def strategy(data, state):
+            if len(calls) in crash_at:
+                raise Crash()
+            calls.append(data.time.values[-1])
+            state = (state or 0) + 1
+            return calculate_weights_sma(data), state
+
+        def run(checkpoint_dir):
+            return qnbt.run_iterations(data.time.values, data, qnbt.standard_window, start_date, 60,
+                                       strategy, 1, False, checkpoint_dir=checkpoint_dir, checkpoint_every=20)
+
+        expected_weights, expected_state = run(None)
+        calls.clear()
+
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            crash_at.append(55)
+            with self.assertRaises(Crash):
+                run(checkpoint_dir)
+            # the checkpoints append the new rows, the whole output isn't rewritten
+            checkpoint = qnbt.read_checkpoint(os.path.join(checkpoint_dir, qnbt.CHECKPOINT_FILE_NAME),
+                                              expected_weights.time.values, 60)
+            self.assertIsNone(checkpoint['output_data'])
+            self.assertEqual([len(rows[2]) for rows in checkpoint['output_rows']], [20, 20])
+
+            # the resumed run appends its rows to the same checkpoint
+            crash_at.append(30)
+            calls.clear()
+            with self.assertRaises(Crash):
+                run(checkpoint_dir)
+            crash_at.clear()
+            calls.clear()
+            weights, state = run(checkpoint_dir)
+            self.assertEqual(len(calls), 100 - 60)
+            self.assertEqual(os.listdir(checkpoint_dir), [])
+
+        self.assertEqual(state, expected_state)
+        self.assertTrue(weights.identical(expected_weights))
+
+    def test_run_iterations_profiler(self):
+        import tracemalloc
+        import qnt.backtester as qnbt
+        import qnt.profiler as qnprof
+        data = create_synthetic_data()
+        profiler = qnprof.Profiler(sample_every=10)
+        qnbt.run_iterations(data.time.values, data, qnbt.standard_window, data.time.values[100], 60,
+                            lambda d, s: calculate_weights_sma(d), 1, False, profiler=profiler)
+        report = profiler.report()
+        self.assertEqual(set(report['stages']), {'window', 'copy', 'strategy', 'unpack_result'})
+        for s in report['stages'].values():
+            self.assertEqual(s['count'], 100)
+            self.assertGreater(s['time'], 0)
+            self.assertGreater(s['max_allocated'], 0)
+        self.assertEqual(len(report['iterations']), 10)
+        self.assertEqual(report['iterations'][1]['iteration'], str(data.time.values[110])[:10])
+
+        # the stages outside the iterations are traced only with trace_stages, the nested stages don't reset
+        # the memory of the enclosing stage
+        for trace_stages in [False, True]:
+            profiler = qnprof.Profiler(trace_stages=trace_stages)
+            with profiler.stage('outer'):
+                outer = np.ones(1024 ** 2)
+                with profiler.stage('inner'):
+                    inner = np.ones(1024 ** 2)
+            stages = profiler.report()['stages']
+            if trace_stages:
+                self.assertGreaterEqual(stages['outer']['max_allocated'], outer.nbytes + inner.nbytes)
+                self.assertGreaterEqual(stages['inner']['max_allocated'], inner.nbytes)
+            else:
+                self.assertIsNone(stages['outer']['max_allocated'])
+            self.assertFalse(tracemalloc.is_tracing())
+
+        os.environ[qnprof.PROFILE_ENV] = "1"
+        try:
+            self.assertTrue(qnprof.create().enabled)
+        finally:
+            del os.environ[qnprof.PROFILE_ENV]
+        self.assertFalse(qnprof.create().enabled)
+
+    def test_run_iterations_states_path(self):
+        import tempfile
+        import qnt.backtester as qnbt
+        import qnt.state as qnstate
+        data = create_synthetic_data()
+        start_date = data.time.values[100]
+        crash_at = []
+
+        class Crash(Exception):
+            pass
+
+        def strategy(tail, state):
+            if crash_at and tail.time.values[-1] == data.time.values[crash_at[0]]:
+                raise Crash()
+            count = 1 if state is None else state['count'] + 1
+            return calculate_weights_sma(tail), {'last': tail.sel(field='close').isel(time=-1), 'count': count}
+
+        def run(states_path, checkpoint_dir=None):
+            return qnbt.run_iterations(data.time.values, data, qnbt.standard_window, start_date, 60, strategy, 1, True,
+                                       checkpoint_dir=checkpoint_dir, checkpoint_every=20, states_path=states_path)[1]
+
+        expected = run(None)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            states_path = os.path.join(tmp_dir, 'states.bin')
+            states = run(states_path)
+            self.assertIsInstance(states, qnstate.StateHistory)
+            self.assertEqual(len(states), len(expected))
+            self.assertEqual(states[-1]['count'], 100)
+            self.assertTrue(states[5]['last'].equals(expected[5]['last']))
+            self.assertEqual([s['count'] for s in states[10:13]], [11, 12, 13])
+            self.assertEqual([s['count'] for s in qnstate.StateHistory(states_path, clear=False)], list(range(1, 101)))
+
+            crash_at.append(155)
+            with self.assertRaises(Crash):
+                run(states_path, tmp_dir)
+            crash_at.clear()
+            states = run(states_path, tmp_dir)
+            self.assertEqual([s['count'] for s in qnstate.StateHistory(states_path, clear=False)], list(range(1, 101)))
+            self.assertEqual(states[-1]['count'], 100)
+
+    def test_run_iterations_new_assets(self):
+        import qnt.backtester as qnbt
+        data = create_synthetic_data()
+        start_date = data.time.values[100]
+        new_asset_date = data.time.values[150]
+
+        def strategy(data, state):
+            weights = calculate_weights_sma(data)
+            if data.time.values[-1] >= new_asset_date:
+                weights = xr.concat([weights, xr.full_like(weights.isel(asset=0), 2).assign_coords(asset='B')],
+                                    'asset')
+                weights = weights.isel(asset=slice(None, None, -1))
+            return weights
+
+        weights = qnbt.run_iterations(data.time.values, data, qnbt.standard_window, start_date, 60,
+                                      strategy, 1, False)[0]
+        self.assertEqual(weights.asset.values.tolist(), ['A0', 'A1', 'A2', 'A3', 'B'])
+        self.assertTrue(weights.sel(asset='B', time=slice(None, new_asset_date - 1)).isnull().all())
+        self.assertTrue((weights.sel(asset='B', time=slice(new_asset_date, None)) == 2).all())
+
+        expected = qnbt.run_iterations(data.time.values, data, qnbt.standard_window, start_date, 60,
+                                       lambda d, s: calculate_weights_sma(d), 1, False)[0]
+        self.assertTrue(weights.sel(asset=expected.asset.values).equals(expected))
+
+        weights_parallel = qnbt.run_iterations(data.time.values, data, qnbt.standard_window, start_date, 60,
+                                               strategy, 1, False, workers=3)[0]
+        self.assertTrue(weights_parallel.equals(weights))
+
+    def test_run_iterations_output_store(self):
+        import gzip
+        import tempfile
+        import qnt.backtester as qnbt
+        import qnt.output as qnout
+        data = create_synthetic_data()
+        start_date = data.time.values[100]
+        new_asset_date = data.time.values[150]
+        crash_at = []
+
+        class Crash(Exception):
+            pass
+
+        def strategy(data, state):
+            if crash_at and data.time.values[-1] == crash_at[0]:
+                raise Crash()
+            weights = calculate_weights_sma(data)
+            if data.time.values[-1] >= new_asset_date:
+                weights = xr.concat([weights, xr.full_like(weights.isel(asset=0), 2).assign_coords(asset='B')],
+                                    'asset')
+            return weights
+
+        def run(**kwargs):
+            return qnbt.run_iterations(data.time.values, data, qnbt.standard_window, start_date, 60,
+                                       strategy, 1, False, **kwargs)[0]
+
+        expected = run()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store_path = os.path.join(tmp_dir, 'store')
+            store = run(output_store=store_path, output_chunk_size=16)
+            self.assertIsInstance(store, qnout.OutputStore)
+            self.assertEqual(len(store), 100)
+            self.assertEqual(len(list(store.chunks())), 7)
+            self.assertTrue(store.to_xarray().equals(expected))
+            self.assertTrue(qnout.OutputStore.open(store_path).to_xarray().equals(expected))
+
+            self.assertRaises(FileExistsError, run, output_store=store_path)
+
+            crash_at.append(data.time.values[175])
+            with self.assertRaises(Crash):
+                run(output_store=store_path, output_chunk_size=16, checkpoint_dir=tmp_dir, checkpoint_every=20,
+                    output_store_overwrite=True)
+            crash_at.clear()
+            store = run(output_store=store_path, output_chunk_size=16, checkpoint_dir=tmp_dir, checkpoint_every=20)
+            self.assertTrue(store.to_xarray().equals(expected))
+
+            os.environ['OUTPUT_PATH'] = os.path.join(tmp_dir, 'fractions.nc.gz')
+            try:
+                qnout.write(expected)
+                expected_file = qnout.read()
+                with gzip.open(os.environ['OUTPUT_PATH'], 'rb') as f:
+                    expected_bytes = f.read()
+                qnout.write(store)
+                output_file = qnout.read()
+                with gzip.open(os.environ['OUTPUT_PATH'], 'rb') as f:
+                    output_bytes = f.read()
+            finally:
+                del os.environ['OUTPUT_PATH']
+            self.assertTrue(output_file.equals(expected_file))
+            # the store is written with the record (unlimited) time dimension
+            expected_file = xr.open_dataarray(expected_bytes)
+            expected_bytes = xr.DataArray(expected_file.values, dims=('time', 'asset'),
+                                          coords={'time': expected_file.time.values,
+                                                  'asset': expected_file.asset.values}) \
+                .to_netcdf(engine='scipy', unlimited_dims=['time'])
+            self.assertEqual(output_bytes, expected_bytes)
+
+    def test_sparse_output(self):
+        import tempfile
+        import qnt.log as qnlog
+        data = create_synthetic_data(200, 30)
+        rnd = np.random.RandomState(5)
+        data.loc['close'] = data.sel(field='close').where(rnd.rand(200, 30) > 0.05)
+        data.loc['is_liquid'] = xr.where(rnd.rand(200, 30) > 0.1, 1.0, 0.0)
+        weights = np.where(rnd.rand(200, 31) < 0.1, rnd.normal(size=(200, 31)), 0)
+        weights[rnd.rand(200, 31) < 0.01] = np.nan
+        weights = xr.DataArray(weights, dims=['time', 'asset'],
+                               coords={'time': data.time, 'asset': list(data.asset.values) + ['B']})
+        weights = weights.isel(time=rnd.permutation(np.setdiff1d(np.arange(10, 200), [50, 51])))
+
+        sparse = qnout.to_sparse(weights)
+        self.assertIsInstance(sparse, qnout.SparseOutput)
+        self.assertTrue(qnout.to_dense(sparse).equals(weights.fillna(0)))
+
+        def assert_equal(sparse, dense):
+            sparse = qnout.to_dense(sparse)
+            self.assertEqual(sparse.time.values.tolist(), dense.time.values.tolist())
+            self.assertEqual(sparse.asset.values.tolist(), dense.asset.values.tolist())
+            np.testing.assert_allclose(sparse.values, dense.values, rtol=0, atol=1e-12)
+
+        assert_equal(qnout.normalize(sparse), qnout.normalize(weights))
+        with qnlog.Settings(info=False, err=False):
+            for kind in ['stocks', 'stocks_nasdaq100', 'futures']:
+                assert_equal(qnout.clean(sparse, data, kind), qnout.clean(weights, data, kind))
+            for per_asset in [False, True]:
+                np.testing.assert_allclose(qnstats.calc_stat(data, sparse, per_asset=per_asset).values,
+                                           qnstats.calc_stat(data, weights, per_asset=per_asset).values,
+                                           rtol=0, atol=1e-12)
+            uniform = xr.full_like(weights, 0.02).fillna(0.02)
+            for output, expected in [(weights, False), (uniform, True)]:
+                self.assertEqual(qnstats.check_exposure(qnout.to_sparse(output)), expected)
+                self.assertEqual(qnstats.check_exposure(output), expected)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.environ['OUTPUT_PATH'] = os.path.join(tmp_dir, 'fractions.nc.gz')
+            try:
+                qnout.write(weights)
+                expected = qnout.read()
+                qnout.write(sparse)
+                result = qnout.read()
+                qnout.write_sparse(sparse, chunk_size=7)
+                chunked = qnout.read()
+            finally:
+                del os.environ['OUTPUT_PATH']
+        assert_equal(result, expected)
+        assert_equal(chunked, expected)
+
+    def test_train_models_parallel(self):
+        import qnt.backtester as qnbt
+        data = create_synthetic_data()
+        test_ts = data.time.values[100:]
+        retrain_windows = qnbt.calc_retrain_windows(test_ts, 30)
+        self.assertEqual(retrain_windows, [(0, 30), (30, 60), (60, 90), (90, 100)])
+
+        def train(data):
+            return data.sel(field='close').mean('time')
+
+        dates = [test_ts[t_i] for t_i, end_i in retrain_windows]
+        models = qnbt.train_models_parallel(train, data, qnbt.standard_window, 60, dates, 3)
+        for t, model in zip(dates, models):
+            self.assertTrue(model.identical(train(qnbt.standard_window(data, t, 60))))
+
+    def test_model_cache(self):
+        import tempfile
+        import qnt.backtester as qnbt
+        data = create_synthetic_data()
+        calls = []
+
+        def train(data):
+            calls.append(data.time.values[-1])
+            return data.sel(field='close').mean('time')
+
+        dates = data.time.values[100::30]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            def run(version, workers=1, max_size=1024 ** 3):
+                cache = qnbt.ModelCache(cache_dir, version, max_size)
+                if workers > 1:
+                    models = qnbt.train_models_parallel(train, data, qnbt.standard_window, 60, dates, workers, cache)
+                else:
+                    models = [qnbt.train_model(train, qnbt.standard_window(data, t, 60), cache) for t in dates]
+                return models, cache
+
+            models, cache = run("v1")
+            self.assertEqual((cache.hits, cache.misses, len(calls)), (0, 4, 4))
+            cached_models, cache = run("v1")
+            self.assertEqual((cache.hits, cache.misses, len(calls)), (4, 0, 4))
+            for m, c in zip(models, cached_models):
+                self.assertTrue(m.identical(c))
+            cached_models, cache = run("v1", workers=2)
+            self.assertEqual((cache.hits, cache.misses), (4, 0))
+
+            run("v2", max_size=1)
+            self.assertEqual(len(calls), 8)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_prefetch(self):
+        import threading
+        import qnt.backtester as qnbt
+        started = threading.Event()
+        release = threading.Event()
+
+        def load(x, y=0):
+            started.set()
+            release.wait(10)
+            return x + y, threading.current_thread()
+
+        future = qnbt.prefetch(load, 1, y=2)
+        self.assertTrue(started.wait(10))
+        self.assertFalse(future.done())
+        release.set()
+        result, thread = future.result()
+        self.assertEqual(result, 3)
+        self.assertIsNot(thread, threading.current_thread())
+
+        with self.assertRaises(ZeroDivisionError):
+            qnbt.prefetch(lambda: 1 / 0).result()
+
+        deferred = qnbt.Prefetch(lambda x: (x, threading.current_thread()), 4)
+        self.assertFalse(deferred.done())
+        result, thread = deferred.result()
+        self.assertEqual(result, 4)
+        self.assertIsNot(thread, threading.current_thread())
+
+        # on_start is called after the workers are forked
+        import multiprocessing
+        data = create_synthetic_data()
+        workers = []
+        qnbt.run_iterations(data.time.values, data, qnbt.standard_window, data.time.values[100], 60,
+                            lambda d, s: calculate_weights_sma(d), 1, False, workers=2,
+                            on_start=lambda: workers.append(len(multiprocessing.active_children())))
+        self.assertEqual(workers, [2])
+
+    def test_window_index(self):
+        import qnt.backtester as qnbt
+        data = create_synthetic_data()
+        crypto = create_synthetic_data(150).isel(time=slice(None, None, 2))
+        dataset = {'futures': data, 'crypto': crypto, 'params': [1, 2]}
+        dates = data.time.values[60::3]
+        window_index = qnbt.WindowIndex(dataset, dates, 30)
+
+        for t in list(dates) + [data.time.values[61], np.datetime64('2021-01-01')]:
+            tail = qnbt.standard_window(dataset, t, 30, window_index)
+            min_date = t - np.timedelta64(30, 'D')
+            self.assertTrue(tail['futures'].equals(data.sel(time=slice(min_date, t))))
+            self.assertTrue(tail['crypto'].equals(crypto.sel(time=slice(min_date, t))))
+            self.assertEqual(tail['params'], [1, 2])
+
+        start_date = data.time.values[100]
+        window_calls = []
+
+        def window(data, max_date, lookback_period, window_index):
+            window_calls.append(window_index)
+            return qnbt.standard_window(data, max_date, lookback_period, window_index)
+
+        weights_index = qnbt.run_iterations(data.time.values, data, window, start_date, 60,
+                                            lambda d, s: calculate_weights_sma(d), 1, False)[0]
+
+        def label_window(data, max_date, lookback_period):
+            return data.loc[dict(time=slice(max_date - np.timedelta64(lookback_period, 'D'), max_date))]
+
+        weights_labels = qnbt.run_iterations(data.time.values, data, label_window, start_date, 60,
+                                             lambda d, s: calculate_weights_sma(d), 1, False)[0]
+        self.assertTrue(weights_index.identical(weights_labels))
+        self.assertEqual(len(set(id(i) for i in window_calls)), 1)
+
+    def test_backtest_incremental(self):
+        import tempfile
+        import qnt.backtester as qnbt
+        import qnt.data.common as qndc
+        data = create_synthetic_data()
+        tails = []
+
+        def load_data(tail):
+            tails.append(tail)
+            d = data.sel(time=slice(None, np.datetime64(qndc.MAX_DATE_LIMIT)))
+            return d.isel(time=slice(-tail, None))
+
+        def strategy(data, state):
+            state = (state or 0) + 1
+            return calculate_weights_sma(data), state
+
+        expected, expected_state = qnbt.run_iterations(data.time.values, data, qnbt.standard_window,
+                                                       data.time.values[100], 60, strategy, 1, False)
+        expected = qnout.clean(expected, data, "stocks_nasdaq100")
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            os.environ['OUTPUT_PATH'] = os.path.join(output_dir, 'fractions.nc.gz')
+            os.environ['OUT_STATE_PATH'] = os.path.join(output_dir, 'state.out.pickle.gz')
+            try:
+                qnout.write(expected.sel(time=slice(None, data.time.values[179])))
+                previous_stat = qnstats.IncrementalStat(points_per_year=251)
+                previous_stat.update(data.sel(time=slice(None, data.time.values[179])),
+                                     expected.sel(time=slice(None, data.time.values[179])))
+                weights, state, stat = qnbt.backtest_incremental(
+                    competition_type="stocks_nasdaq100",
+                    strategy=strategy,
+                    previous_state=80,
+                    previous_stat=previous_stat,
+                    load_data=load_data,
+                    lookback_period=60,
+                    end_date=data.time.values[-1],
+                )
+                self.assertTrue(qnout.read().equals(weights))
+            finally:
+                del os.environ['OUTPUT_PATH']
+                del os.environ['OUT_STATE_PATH']
+
+        self.assertEqual(tails, [20 + 60 + 1])
+        self.assertEqual(state, expected_state)
+        self.assertTrue(np.allclose(weights.values, expected.transpose('time', 'asset').values))
+        self.assertIs(stat, previous_stat)
+        expected_stat = qnstats.calc_stat(data, expected, points_per_year=251)
+        self.assertEqual(stat.get().time.values.tolist(), expected_stat.time.values.tolist())
+        np.testing.assert_allclose(stat.get().values, expected_stat.values, rtol=0, atol=1e-9)
+
+    def test_backtest_many(self):
+        import qnt.backtester as qnbt
+        data = create_synthetic_data()
+        start_date = data.time.values[100]
+        tails = []
+
+        def load_data(tail):
+            tails.append(tail)
+            return data
+
+        def calculate_weights_momentum(data):
+            close = data.sel(field='close')
+            return xr.where(close.isel(time=-1) > close.isel(time=-20), 1, 0)
+
+        def calculate_weights_state(data, state):
+            state = (state or 0) + 1
+            return calculate_weights_sma(data) * -1, state
+
+        def run(strategies, workers):
+            return qnbt.backtest_many(
+                competition_type="stocks_nasdaq100",
+                strategies=strategies,
+                load_data=load_data,
+                lookback_period=60,
+                start_date=start_date,
+                end_date=data.time.values[-1],
+                workers=workers,
+            )
+
+        strategies = {'sma': calculate_weights_sma, 'momentum': calculate_weights_momentum}
+        outputs, states, stats = run(dict(strategies, state=calculate_weights_state), 1)
+        self.assertEqual(len(tails), 1)
+        self.assertEqual(stats.strategy.values.tolist(), ['sma', 'momentum', 'state'])
+        self.assertEqual(states, {'sma': None, 'momentum': None, 'state': 100})
+        self.assertTrue(np.allclose(outputs['sma'].values, -outputs['state'].values))
+        for name, strategy in strategies.items():
+            expected = qnbt.run_iterations(data.time.values, data, qnbt.standard_window, start_date, 60,
+                                           lambda d, s: strategy(d), 1, False)[0]
+            expected = qnout.clean(expected, data, "stocks_nasdaq100")
+            self.assertTrue(np.allclose(outputs[name].values, expected.transpose(*outputs[name].dims).values))
+            expected_stat = qnstats.calc_stat(data, expected).loc[start_date:]
+            self.assertTrue(np.allclose(stats.sel(strategy=name).values, expected_stat.values, equal_nan=True))
+
+        outputs_parallel, states_parallel, stats_parallel = run(strategies, 2)
+        for name in strategies.keys():
+            self.assertTrue(outputs_parallel[name].equals(outputs[name]))
+
+    def test_backtest_vectorized(self):
+        import tempfile
+        import qnt.backtester as qnbt
+        data = create_synthetic_data()
+        start_date = data.time.values[100]
+        calls = []
+
+        def strategy(data):
+            calls.append(len(data.time))
+            close = data.sel(field='close')
+            return xr.where(qnta.sma(close, 20) < close, 1, -1)
+
+        def look_ahead_strategy(data):
+            calls.append(len(data.time))
+            close = data.sel(field='close')
+            return xr.where(close.shift(time=-1) > close, 1, -1).fillna(0)
+
+        def run(strategy):
+            calls.clear()
+            with tempfile.TemporaryDirectory() as output_dir:
+                os.environ['OUTPUT_PATH'] = os.path.join(output_dir, 'fractions.nc.gz')
+                try:
+                    return qnbt.backtest(
+                        competition_type="stocks_nasdaq100",
+                        lookback_period=60,
+                        start_date=start_date,
+                        end_date=data.time.values[-1],
+                        strategy=strategy,
+                        load_data=lambda tail: data,
+                        analyze=False,
+                        single_load=True,
+                        mode="vectorized",
+                        lookahead_checks=3,
+                    )
+                finally:
+                    del os.environ['OUTPUT_PATH']
+
+        weights = run(strategy)
+        self.assertEqual(len(calls), 2 + 1 + 3)  # last pass, first pass, whole data, checks
+        expected = qnbt.run_iterations(data.time.values, data, qnbt.standard_window, start_date, 60,
+                                       lambda d, s: calculate_weights_sma(d), 1, False)[0]
+        expected = qnout.clean(expected, data, "stocks_nasdaq100")
+        self.assertTrue(np.allclose(weights.transpose(*expected.dims).values, expected.values))
+
+        run(look_ahead_strategy)
+        self.assertEqual(len(calls), 2 + 1 + 1 + 100)  # the look-ahead is found at the first check
+
+    def test_backtest_single_load(self):
+        import tempfile
+        import qnt.backtester as qnbt
+        data = create_synthetic_data()
+        start_date = data.time.values[100]
+        tails = []
+
+        def load_data(tail):
+            tails.append(tail)
+            return data
+
+        expected = qnbt.run_iterations(data.time.values, data, qnbt.standard_window, start_date, 60,
+                                       lambda d, s: calculate_weights_sma(d), 1, False)[0]
+        expected = qnout.clean(expected, data, "stocks_nasdaq100")
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            os.environ['OUTPUT_PATH'] = os.path.join(output_dir, 'fractions.nc.gz')
+            try:
+                weights = qnbt.backtest(
+                    competition_type="stocks_nasdaq100",
+                    lookback_period=60,
+                    start_date=start_date,
+                    end_date=data.time.values[-1],
+                    strategy=calculate_weights_sma,
+                    load_data=load_data,
+                    analyze=False,
+                    single_load=True,
+                )
+                written = qnout.read()
+                sparse = qnbt.backtest(
+                    competition_type="stocks_nasdaq100",
+                    lookback_period=60,
+                    start_date=start_date,
+                    end_date=data.time.values[-1],
+                    strategy=calculate_weights_sma,
+                    load_data=load_data,
+                    analyze=False,
+                    single_load=True,
+                    output_store=os.path.join(output_dir, 'store'),
+                    output_chunk_size=16,
+                )
+                sparse_written = qnout.read()
+            finally:
+                del os.environ['OUTPUT_PATH']
+
+        self.assertEqual(len(tails), 2)
+        self.assertTrue(np.allclose(weights.transpose(*expected.dims).values, expected.values))
+        self.assertIsInstance(sparse, qnout.SparseOutput)
+        dense = qnout.to_dense(sparse)
+        self.assertEqual(dense.time.values.tolist(), expected.time.values.tolist())
+        self.assertEqual(dense.asset.values.tolist(), expected.asset.values.tolist())
+        np.testing.assert_allclose(dense.values, expected.values, rtol=0, atol=1e-12)
+        np.testing.assert_allclose(sparse_written.values, written.values, rtol=0, atol=1e-12)
+
     def test_futures_backtest(self):
         import xarray as xr
         import qnt.ta as qnta